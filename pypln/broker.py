@@ -1,97 +1,274 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-from multiprocessing import Process, Pipe, cpu_count
-from os import kill, getpid
+import json
+import uuid
+from hashlib import md5
+from multiprocessing import cpu_count
+from os import getpid
 from time import sleep, time
-from signal import SIGKILL
+from distutils.spawn import find_executable
 import zmq
-from pymongo import Connection
+from pymongo.errors import BulkWriteError, OperationFailure
 from gridfs import GridFS
 from bson.objectid import ObjectId
 from pypln import workers
 from pypln.client import ManagerClient
-from pypln.utils import get_host_info, get_outgoing_ip, get_process_info
+from pypln.concurrency import ConcurrencyController
+from pypln.payload import SharedPayload, load_payloads, share_big_values
+from pypln.planner import get_stamp
+from pypln.pool import WorkerPool
+from pypln.stores import connect
+from pypln.stores.cache import FieldCache
+from pypln.stores.chunks import ChunkReader
+from pypln.stores.corpus import CorpusCursor
+from pypln.stores.spill import (LazyDocument, spill_big_values, is_reference,
+                                put_chunk, chunked_reference,
+                                referenced_files, delete_stale_files)
+from pypln.utils import (get_host_info, get_outgoing_ip, get_process_info,
+                         get_resource_usage, pipeline_workers,
+                         pipeline_leaves, with_defaults)
 
 
+# codes of MongoDB errors of updates that make a document too big
+document_too_large_errors = (10334, 17419, 17420)
+
 class Job(object):
     def __init__(self, message):
         self.job_id = message['job id']
         self.document_id = message['document']
         self.worker = message['worker']
-        self.parent_connection = None
-        self.child_connection = None
+        # a fused job runs a whole pipeline tree in the same process
+        self.pipeline = None
+        self.workers = [self.worker]
+        # workers whose results are stored: intermediate results of fused
+        # jobs are only kept in memory
+        self.final_workers = [self.worker]
+        if message.get('fused'):
+            self.pipeline = {'worker': self.worker,
+                             'after': message.get('after', [])}
+            self.workers = pipeline_workers(self.pipeline)
+            self.final_workers = pipeline_leaves(self.pipeline)
         self.start_time = None
+        self.end_time = None
+        self.cpu_time_at_start = 0
         self.process = None
         self.pid = None
+        self.cache_key = None
+        self.cached_result = None
+        # fingerprints of the input fields (and of the cached result), used
+        # to stamp the results (see `pypln.planner`)
+        self.fingerprints = {}
+        self.cached_fingerprints = {}
+        self.contents_md5 = None
+        self.payloads = []
+        # GridFS files (and their total size) of each field that a chunked
+        # worker already sent
+        self.chunks = {}
+        self.chunks_length = {}
 
     def __repr__(self):
         return ('<Job(worker={}, document_id={}, job_id={}, pid={}, '
-                'start_time={})>'.format(self.worker, self.document_id,
+                'start_time={})>'.format('+'.join(self.workers),
+                                         self.document_id,
                                          self.job_id, self.pid,
                                          self.start_time))
 
-    def start(self):
-        parent_connection, child_connection = Pipe()
-        self.parent_connection = parent_connection
-        self.child_connection = child_connection
-        #TODO: is there any way to *do not* connect stdout/stderr?
-        self.process = Process(target=workers.wrapper, args=(child_connection, ))
+    def start(self, process):
+        '''Run this job on `process`, a `pypln.pool.WorkerProcess`'''
+        self.process = process
         self.start_time = time()
-        self.process.start()
-        self.pid = self.process.pid
+        self.pid = process.pid
+        # processes are reused, so CPU time is counted from here
+        usage = get_resource_usage(self.pid)
+        if usage is not None:
+            self.cpu_time_at_start = usage['cpu time']
+
+    def set_result(self, result):
+        '''Finish the job with a cached result, without starting a process'''
+        self.start_time = time()
+        self.cached_result = result
 
     def send(self, message):
-        self.parent_connection.send(message)
+        self.process.send(message)
 
     def get_result(self):
-        return self.parent_connection.recv()
+        '''Return ``(status, value)``
 
-    def finished(self):
-        return self.parent_connection.poll()
+        `status` is 'result', 'chunk' (a partial result), 'error' or 'died'.
+        '''
+        if self.process is None:
+            return 'result', self.cached_result
+        try:
+            return self.process.recv()
+        except EOFError:
+            return 'died', 'Worker process died'
+
+    def requires(self):
+        '''Return the fields needed by any of the job's workers'''
+        fields = set()
+        for name in self.workers:
+            fields.update(workers.available[name]['requires'])
+        return list(fields)
+
+    def provides(self):
+        '''Return the fields to be stored: provided by the final workers'''
+        fields = set()
+        for name in self.final_workers:
+            fields.update(workers.available[name]['provides'])
+        return list(fields)
+
+    def get_resource_usage(self):
+        usage = {'duration': time() - self.start_time}
+        if self.process is not None:
+            process_usage = get_resource_usage(self.pid)
+            if process_usage is not None:
+                usage['cpu time'] = process_usage['cpu time'] - \
+                                    self.cpu_time_at_start
+                usage['resident memory'] = process_usage['resident memory']
+        return usage
 
-    def end(self):
-        self.parent_connection.close()
-        self.child_connection.close()
-        self.process.join()
+    def finished(self):
+        if self.process is None:
+            return self.cached_result is not None
+        return self.process.poll()
 
 class ManagerBroker(ManagerClient):
     #TODO: should use pypln.stores instead of pymongo directly
     #TODO: use log4mongo
     def __init__(self, api_host_port, broadcast_host_port, logger=None,
-                 logger_name='ManagerBroker', poll_time=50):
+                 logger_name='ManagerBroker',
+                 max_jobs_per_worker=None, max_jobs_per_process=1000,
+                 max_process_memory=None, payload_threshold=1024 * 1024,
+                 write_batch_size=100, write_interval=0.1,
+                 spill_threshold=4 * 1024 * 1024, job_timeout=None,
+                 job_cpu_timeout=None, job_max_memory=None,
+                 limits_check_interval=1, adaptive_concurrency=True,
+                 max_jobs=None, field_cache_size=64 * 1024 * 1024,
+                 preload_workers=True, max_update_size=12 * 1024 * 1024):
         ManagerClient.__init__(self, logger=logger, logger_name=logger_name)
         self.api_host_port = api_host_port
         self.broadcast_host_port = broadcast_host_port
         self.jobs = []
         self.max_jobs = cpu_count()
-        self.poll_time = poll_time
+        # with adaptive concurrency `max_jobs` changes with the load of the
+        # node, between 1 and `max_jobs` argument (default: 4 * CPUs)
+        self.controller = None
+        if adaptive_concurrency:
+            self.controller = ConcurrencyController(max_jobs=max_jobs)
+            self.max_jobs = self.controller.limit
+        elif max_jobs is not None:
+            self.max_jobs = max_jobs
+        self.capabilities = self.get_capabilities(max_jobs_per_worker or {})
+        self.poller = zmq.Poller()
+        self.job_channels = {}
+        self.max_jobs_per_process = max_jobs_per_process
+        self.max_process_memory = max_process_memory
+        # inputs and results bigger than this (in bytes) are not pickled
+        # through the pipes, they go through shared memory
+        self.payload_threshold = payload_threshold
+        # results are written in bulk, after `write_batch_size` jobs finish or
+        # `write_interval` seconds. 'job finished' is only sent to the manager
+        # after the result is written, so a crash can't lose results
+        self.write_batch_size = write_batch_size
+        self.write_interval = write_interval
+        self.unflushed_jobs = []
+        # result fields bigger than this (in bytes) are stored in GridFS, so
+        # documents don't hit MongoDB's 16MB limit; so are the biggest
+        # fields of a result if together they are bigger than
+        # `max_update_size`. Fields of other jobs may still make the document
+        # too big: then all the fields of the result are stored in GridFS
+        self.spill_threshold = spill_threshold
+        self.max_update_size = max_update_size
+        self.deleted_files = 0
+        self.database_round_trips_saved = 0
+        # results of finished jobs are kept in memory (up to
+        # `field_cache_size` bytes), so the next workers of a pipeline that
+        # run on this node read only their fingerprints from MongoDB
+        self.field_cache = None
+        if field_cache_size is not None:
+            self.field_cache = FieldCache(field_cache_size)
+        # default limits for jobs of workers that don't define theirs in
+        # __meta__ ('timeout', 'cpu timeout' and 'max memory'); a job that
+        # exceeds them is killed and reported as failed to the manager
+        self.default_limits = {'timeout': job_timeout,
+                               'cpu timeout': job_cpu_timeout,
+                               'max memory': job_max_memory}
+        self.limits_check_interval = limits_check_interval
+        self.last_limits_check = 0
+        self.failed_jobs = 0
+        self.pool = None
+        # without preload, worker modules are imported by each process when
+        # it runs its first job of that worker
+        self.preload_workers = preload_workers
+        self.warm_up_times = {}
         self.last_time_saved_monitoring_information = 0
+        self.last_time_sent_request = 0
+        self.broker_id = uuid.uuid4().hex
+        self.cache_hits = 0
+        self.cache_misses = 0
         self.logger.info('Broker started')
 
+    def get_capabilities(self, max_jobs_per_worker):
+        '''Return how many jobs of each worker this node can run at once
+
+        A worker is only available if all the executables it needs are
+        installed on this node.
+        '''
+        capabilities = {}
+        for name, worker in workers.available.iteritems():
+            if all(find_executable(executable) is not None
+                   for executable in worker['executables']):
+                default = self.max_jobs
+                if self.controller is not None:
+                    default = self.controller.max_jobs
+                capabilities[name] = max_jobs_per_worker.get(name, default)
+            else:
+                self.logger.info('Worker "{}" is not available on this node'\
+                                 .format(name))
+        return capabilities
+
+    def free_slots_per_worker(self):
+        free_slots = self.max_jobs - len(self.jobs)
+        running = {}
+        for job in self.jobs:
+            running[job.worker] = running.get(job.worker, 0) + 1
+        limits = self.capabilities
+        if self.controller is not None:
+            limits = self.controller.worker_limits(self.capabilities, running)
+        return {name: max(0, min(free_slots, slots - running.get(name, 0)))
+                for name, slots in limits.iteritems()}
+
     def request(self, message):
-        self.manager_api.send_json(message)
+        # every request identifies this broker, so it also renews the leases
+        # of the jobs we are running
+        message['broker'] = self.broker_id
+        self.send_api_request(message)
+        self.last_time_sent_request = time()
         self.logger.info('[API] Request to manager: {}'.format(message))
 
     def get_reply(self):
-        message = self.manager_api.recv_json()
+        message = self.get_api_reply()
         self.logger.info('[API] Reply from manager: {}'.format(message))
         return message
 
     def connect_to_database(self):
         conf = self.config['db']
-        self.mongo_connection = Connection(conf['host'], conf['port'])
-        self.db = self.mongo_connection[conf['database']]
-        if 'username' in conf and 'password' in conf and conf['username'] and \
-           conf['password']:
-               self.db.authenticate(conf['username'], conf['password'])
+        self.mongo_connection, self.db = connect(conf)
         self.collection = self.db[conf['collection']]
         self.monitoring_collection = self.db[conf['monitoring collection']]
         self.gridfs = GridFS(self.db, conf['gridfs collection'])
+        # to find the files of values that are overwritten
+        self.gridfs_files = self.db[conf['gridfs collection']].files
+        self.gridfs_files.ensure_index([('document', 1), ('field', 1)])
+        self.cache_collection = self.db[conf['result cache collection']]
+        self.corpora_collection = self.db[conf['corpora collection']]
+        self.checkpoint_collection = self.db[conf['checkpoint collection']]
 
     def get_configuration(self):
         self.request({'command': 'get configuration'})
-        self.config = self.get_reply()
+        # the manager may be older than this broker
+        self.config = with_defaults(self.get_reply())
 
     def connect_to_manager(self):
         self.logger.info('Trying to connect to manager...')
@@ -107,8 +284,27 @@ class ManagerBroker(ManagerClient):
         broker_process = get_process_info(getpid())
         broker_process['type'] = 'broker'
         broker_process['active workers'] = len(self.jobs)
+        broker_process['cache hits'] = self.cache_hits
+        broker_process['cache misses'] = self.cache_misses
+        broker_process['recycled processes'] = self.pool.recycled
+        broker_process['warm up times'] = self.warm_up_times
+        broker_process['database round trips saved'] = \
+                self.database_round_trips_saved
+        broker_process['failed jobs'] = self.failed_jobs
+        broker_process['deleted files'] = self.deleted_files
+        broker_process['max jobs'] = self.max_jobs
+        if self.field_cache is not None:
+            broker_process['field cache hits'] = self.field_cache.hits
+            broker_process['field cache misses'] = self.field_cache.misses
+            broker_process['field cache evictions'] = \
+                    self.field_cache.evictions
+            broker_process['field cache size'] = self.field_cache.size
+            broker_process['field cache invalidations'] = \
+                    self.field_cache.invalidations
         processes = [broker_process]
         for job in self.jobs:
+            if job.pid is None: # result came from cache
+                continue
             process = get_process_info(job.pid)
             if process is not None: # worker process not finished yet
                 process['worker'] = job.worker
@@ -123,80 +319,638 @@ class ManagerBroker(ManagerClient):
 
     def start(self):
         self.started_at = time()
+        # heavy resources are loaded once and shared copy-on-write with the
+        # processes, that are forked before any socket or database connection
+        # is created, so they don't inherit them
+        if self.preload_workers:
+            self.warm_up_times = workers.preload(self.capabilities.keys())
+        for worker, duration in self.warm_up_times.iteritems():
+            self.logger.info('Worker "{}" warmed up in {:.3f}s'\
+                             .format(worker, duration))
+        self.pool = WorkerPool(self.max_jobs, self.max_jobs_per_process,
+                               self.max_process_memory, self.payload_threshold)
         self.connect_to_manager()
         self.manager_broadcast.setsockopt(zmq.SUBSCRIBE, 'new job')
+        self.poller.register(self.manager_broadcast, zmq.POLLIN)
         self.get_configuration()
         self.connect_to_database()
         self.save_monitoring_information()
         self.run()
 
-    def start_job(self, job):
+    def get_cache_key(self, worker, data, contents_md5=None):
+        '''Return the result cache key of running `worker` on `data`
+
+        The key depends on the worker's version and on the fields it
+        requires, so a result is reused only when the worker would get
+        exactly the same input. File contents are represented by their MD5
+        (`contents_md5`), which GridFS already stores.
+        '''
+        required_fields = workers.available[worker]['requires']
+        input_data = {key: data.get(key) for key in required_fields}
+        if contents_md5 is not None:
+            input_data['contents'] = contents_md5
+        input_hash = md5(json.dumps(input_data, sort_keys=True,
+                                    default=str)).hexdigest()
+        version = workers.available[worker]['version']
+        return '{}:{}:{}'.format(worker, version, input_hash)
+
+    def get_cached_result(self, job):
+        '''Return the result of a job with the same input (or None)
+
+        The cache entry points to the document that holds the result, so
+        results are not stored twice in MongoDB. Documents store the cache
+        key of each worker's result in '_cache keys', so results that were
+        overwritten since the entry was created are not used.
+        '''
+        entry = self.cache_collection.find_one({'_id': job.cache_key})
+        if entry is None:
+            return None
+        provides = workers.available[job.worker]['provides']
+        fields = provides + ['_fingerprints', '_cache keys']
+        document = self.collection.find_one({'_id': entry['document']},
+                                            fields=fields)
+        if document is None or \
+           any(key not in document for key in provides) or \
+           document.get('_cache keys', {}).get(job.worker) != job.cache_key:
+            return None
+        # the result may be a reference to GridFS, whose fingerprint is not
+        # the one of the value
+        fingerprints = document.get('_fingerprints', {})
+        job.cached_fingerprints = {key: fingerprints[key] for key in provides
+                                   if key in fingerprints}
+        # values in GridFS are copied: files are deleted when the value of
+        # their own document is overwritten
+        return LazyDocument(document, self.gridfs).resolve(provides)
+
+    def prefetch_documents(self, jobs):
+        '''Get input documents of all `jobs` in one query, return a dict
+
+        The dict maps document ids (as strings) to the documents, which have
+        the fields needed by any of the jobs.
+        '''
+        document_jobs = [job for job in jobs
+                         if workers.available[job.worker]['from'] == 'document']
+        if not document_jobs:
+            return {}
+        fields = set(['_id', 'meta', '_fingerprints'])
+        for job in document_jobs:
+            fields.update(job.requires())
+        document_ids = list(set(ObjectId(job.document_id)
+                                for job in document_jobs))
+        documents = self.collection.find({'_id': {'$in': document_ids}},
+                                         fields=list(fields))
+        self.database_round_trips_saved += len(document_jobs) - 1
+        return {str(document['_id']): document for document in documents}
+
+    def get_cached_document(self, job):
+        '''Return the input of a job from the field cache (or None)'''
+        if self.field_cache is None or \
+           workers.available[job.worker]['from'] != 'document':
+            return None
+        required_fields = job.requires()
+        fingerprint_keys = ['_fingerprints.' + key for key in required_fields]
+        document = self.field_cache.get_fields(job.document_id,
+                                               required_fields +
+                                               fingerprint_keys)
+        if document is not None:
+            document['_id'] = ObjectId(job.document_id)
+            document['_fingerprints'] = {key: document.pop('_fingerprints.' +
+                                                           key)
+                                         for key in required_fields}
+        return document
+
+    def validate_cached_documents(self, cached_documents):
+        '''Drop cached documents whose fields changed in the database
+
+        Another broker may have written the same fields, so the fingerprints
+        of the cached fields are compared with the ones stored in the
+        documents, fetched (only them) in one query. Stale entries are
+        removed from the field cache and their jobs get their input from the
+        database.
+        '''
+        if not cached_documents:
+            return
+        document_ids = list(set(document['_id']
+                                for document in cached_documents.values()))
+        documents = self.collection.find({'_id': {'$in': document_ids}},
+                                         fields=['_fingerprints'])
+        stored = {document['_id']: document.get('_fingerprints', {})
+                  for document in documents}
+        for job, document in cached_documents.items():
+            fingerprints = stored.get(document['_id'], {})
+            fields = document['_fingerprints'].keys()
+            if any(fingerprints.get(key) != document['_fingerprints'][key]
+                   for key in fields):
+                fingerprint_keys = ['_fingerprints.' + key for key in fields]
+                self.field_cache.invalidate(job.document_id,
+                                            fields + fingerprint_keys)
+                del cached_documents[job]
+
+    def start_job(self, job, document=None):
         worker_input = workers.available[job.worker]['from']
         data = {}
         if worker_input == 'document':
-            required_fields = workers.available[job.worker]['requires']
-            fields = set(['_id', 'meta'] + required_fields)
-            data = self.collection.find({'_id': ObjectId(job.document_id)},
-                                        fields=fields)[0]
+            required_fields = job.requires()
+            fields = set(['_id', 'meta', '_fingerprints'] + required_fields)
+            if document is None:
+                data = self.collection.find({'_id': ObjectId(job.document_id)},
+                                            fields=fields)[0]
+            else:
+                data = {key: document[key] for key in fields
+                        if key in document}
+            job.fingerprints = data.pop('_fingerprints', {})
+            if job.pipeline is None:
+                job.cache_key = self.get_cache_key(job.worker, data)
+            if job.pipeline is None and \
+               workers.available[job.worker]['chunked']:
+                # the worker reads values stored in GridFS chunk by chunk
+                data = {key: ChunkReader(self.config['db'], value)
+                             if is_reference(value) else value
+                        for key, value in data.iteritems()}
+            else:
+                data = LazyDocument(data, self.gridfs).resolve(required_fields)
         elif worker_input == 'gridfs-file':
             file_data = self.gridfs.get(ObjectId(job.document_id))
             data = {'_id': ObjectId(job.document_id),
                     'length': file_data.length,
                     'md5': file_data.md5,
                     'name': file_data.name,
-                    'upload_date': file_data.upload_date,
-                    'contents': file_data.read()}
-        #TODO: what if input is a corpus?
+                    'upload_date': file_data.upload_date}
+            job.contents_md5 = file_data.md5
+            if job.pipeline is None:
+                job.cache_key = self.get_cache_key(job.worker, data,
+                                                   file_data.md5)
+        elif worker_input == 'corpus':
+            # the worker's process reads the documents itself, in batches
+            corpus_id = ObjectId(job.document_id)
+            data = {'_id': corpus_id,
+                    'corpus': CorpusCursor(self.config['db'], corpus_id,
+                                           job.requires(), job.job_id)}
+
+        cached_result = None
+        if job.cache_key is not None:
+            cached_result = self.get_cached_result(job)
+        if cached_result is not None:
+            self.cache_hits += 1
+            job.set_result(cached_result)
+            self.logger.debug('Using cached result of worker "{}" for '
+                              'document "{}"'.format(job.worker,
+                                                     job.document_id))
+            return
+        self.cache_misses += 1
 
-        job.start()
-        job.send((job.worker, data))
+        if worker_input == 'document':
+            data = share_big_values(data, self.payload_threshold)
+        elif worker_input == 'gridfs-file':
+            if self.payload_threshold is not None and \
+               file_data.length > self.payload_threshold:
+                # the file is copied chunk by chunk, never entirely in memory
+                data['contents'] = SharedPayload.from_file(file_data)
+            else:
+                data['contents'] = file_data.read()
+        job.payloads = [value for value in data.values()
+                        if isinstance(value, SharedPayload)]
+        job.start(self.pool.acquire())
+        # the main loop is woken up when the worker sends its result
+        self.job_channels[job.process.fileno()] = job
+        self.poller.register(job.process.fileno(), zmq.POLLIN)
+        job.send((job.pipeline or job.worker, data))
         self.logger.debug('Started worker "{}" for document "{}" (PID: {})'\
                           .format(job.worker, job.document_id,
                                   job.pid))
 
     def get_a_job(self):
-        for i in range(self.max_jobs - len(self.jobs)):
-            self.request({'command': 'get job'})
-            message = self.get_reply()
-            #TODO: if manager stops and doesn't answer, broker will stop here
-            if 'worker' in message and message['worker'] is None:
-                break # Don't have a job, stop asking
-            elif 'worker' in message and 'document' in message and \
-                    message['worker'] in workers.available:
-                job = Job(message)
-                self.jobs.append(job)
-                self.start_job(job)
+        free_slots = self.max_jobs - len(self.jobs)
+        if free_slots <= 0:
+            return
+        self.request({'command': 'get jobs', 'count': free_slots,
+                      'workers': self.free_slots_per_worker()})
+        message = self.get_reply()
+        #TODO: if manager stops and doesn't answer, broker will stop here
+        new_jobs = []
+        for job_message in message.get('jobs', []):
+            if 'worker' not in job_message or 'document' not in job_message:
+                self.logger.info('Ignoring malformed job: {}'\
+                                 .format(job_message))
+                continue
+            job = Job(job_message)
+            if any(name not in self.capabilities for name in job.workers):
+                self.logger.info('Rejecting job: {}'.format(job_message))
+                self.request({'command': 'reject job',
+                              'job id': job_message['job id']})
+                self.get_reply()
             else:
-                self.logger.info('Ignoring malformed job: {}'.format(message))
-                #TODO: send a 'rejecting job' request to Manager
-
-    def manager_has_job(self):
-        if self.manager_broadcast.poll(self.poll_time):
-            message = self.manager_broadcast.recv()
-            self.logger.info('[Broadcast] Received from manager: {}'\
-                             .format(message))
-            #TODO: what if broker subscribe to another thing?
-            return True
-        else:
-            return False
+                new_jobs.append(job)
+        cached_documents = {}
+        for job in new_jobs:
+            document = self.get_cached_document(job)
+            if document is not None:
+                cached_documents[job] = document
+        self.validate_cached_documents(cached_documents)
+        documents = self.prefetch_documents([job for job in new_jobs
+                                             if job not in cached_documents])
+        for job in new_jobs:
+            self.jobs.append(job)
+            document = cached_documents.get(job, None)
+            if document is None:
+                document = documents.get(job.document_id)
+            self.start_job(job, document)
+
+    def time_to_next_task(self):
+        '''Return seconds until monitoring, heartbeat or a flush are due'''
+        now = time()
+        next_monitoring = self.last_time_saved_monitoring_information + \
+                          self.config['monitoring interval']
+        next_heartbeat = self.last_time_sent_request + \
+                         self.config['heartbeat interval']
+        next_task = min(next_monitoring, next_heartbeat)
+        if self.jobs:
+            next_task = min(next_task, self.last_limits_check + \
+                                       self.limits_check_interval)
+        if self.unflushed_jobs:
+            next_flush = self.unflushed_jobs[0][0].end_time + \
+                         self.write_interval
+            next_task = min(next_task, next_flush)
+        return max(0, next_task - now)
 
-    def finished_jobs(self):
-        return [job for job in self.jobs if job.finished()]
+    def wait_for_events(self):
+        '''Block until manager broadcasts, a job finishes or a task is due
+
+        Return a tuple ``(manager_has_job, finished_jobs)``. The manager
+        broadcast socket and the channels of all running jobs are waited on
+        together, so finished jobs are handled as soon as they finish and an
+        idle broker does not use CPU.
+        '''
+        finished_jobs = [job for job in self.jobs if job.process is None]
+        timeout = 0 if finished_jobs else self.time_to_next_task() * 1000
+        events = dict(self.poller.poll(timeout))
+        manager_has_job = False
+        if self.manager_broadcast in events:
+            # several announcements are answered by only one 'get jobs'
+            while self.manager_broadcast.poll(0):
+                message = self.manager_broadcast.recv()
+                self.logger.info('[Broadcast] Received from manager: {}'\
+                                 .format(message))
+                #TODO: what if broker subscribe to another thing?
+            manager_has_job = True
+        for channel in events:
+            if channel in self.job_channels:
+                finished_jobs.append(self.job_channels[channel])
+        return manager_has_job, finished_jobs
 
     def full_of_jobs(self):
         return len(self.jobs) >= self.max_jobs
 
     def kill_processes(self):
-        for job in self.jobs:
-            try:
-                kill(job.pid, SIGKILL)
-            except OSError:
-                pass
+        if self.pool is not None:
+            self.pool.kill()
 
     def should_save_monitoring_information_now(self):
         time_difference = time() - self.last_time_saved_monitoring_information
         return time_difference >= self.config['monitoring interval']
 
+    def should_send_heartbeat_now(self):
+        time_difference = time() - self.last_time_sent_request
+        return time_difference >= self.config['heartbeat interval']
+
+    def send_heartbeat(self):
+        jobs = self.jobs + [job for job, result in self.unflushed_jobs]
+        self.request({'command': 'heartbeat',
+                      'jobs': [job.job_id for job in jobs]})
+        self.get_reply()
+
+    def save_result(self, job, result):
+        '''Buffer the result of a finished job to be written in bulk'''
+        self.unflushed_jobs.append((job, result))
+        if len(self.unflushed_jobs) >= self.write_batch_size:
+            self.flush_results()
+
+    def should_flush_results_now(self):
+        if not self.unflushed_jobs:
+            return False
+        # there is nothing to wait for when no other job is running
+        oldest_job = self.unflushed_jobs[0][0]
+        return not self.jobs or \
+               time() - oldest_job.end_time >= self.write_interval
+
+    def flush_results(self):
+        '''Write buffered results in bulk, then tell manager jobs finished
+
+        Writes are idempotent (if the broker dies before telling the manager
+        the jobs are requeued and their results are written again). Jobs
+        whose results could not be written (a document bigger than MongoDB
+        allows, for example) are reported as failed; the others finish.
+        '''
+        if not self.unflushed_jobs:
+            return
+        bulk = self.collection.initialize_unordered_bulk_op()
+        # jobs of the bulk operations, in order: errors refer to their index
+        bulk_jobs = []
+        updates = {}
+        failed = {}
+        # fields written by each job and the files their values refer to
+        written = {}
+        for job, result in self.unflushed_jobs:
+            worker_input = workers.available[job.worker]['from']
+            worker_output = workers.available[job.worker]['to']
+            document_id = ObjectId(job.document_id)
+            fingerprints = {}
+            result = spill_big_values(result, self.gridfs,
+                                      self.spill_threshold, fingerprints,
+                                      document_id, self.max_update_size)
+            written[job] = ([(document_id, key) for key in result],
+                            set(file_id for value in result.itervalues()
+                                for file_id in referenced_files(value)))
+            fingerprints.update(job.cached_fingerprints)
+            if worker_output == 'document':
+                versions = self.get_versions(job, fingerprints)
+                # fused jobs are not cached, their results have no key
+                cache_keys = {worker: job.cache_key
+                              for worker in job.final_workers}
+                if self.field_cache is not None:
+                    for key, fingerprint in fingerprints.iteritems():
+                        self.field_cache.put(job.document_id,
+                                             '_fingerprints.' + key,
+                                             fingerprint)
+            if worker_input in ('document', 'gridfs-file') and \
+               worker_output == 'document':
+                update = {'_fingerprints.' + key: fingerprint
+                          for key, fingerprint in fingerprints.iteritems()}
+                update.update({'_versions.' + worker: stamp
+                               for worker, stamp in versions.iteritems()})
+                update.update({'_cache keys.' + worker: key
+                               for worker, key in cache_keys.iteritems()})
+                update.update(result)
+                operation = bulk.find({'_id': document_id})
+                if worker_input == 'gridfs-file':
+                    # documents are created from their files; other fields
+                    # (results of the next workers, corpora) are kept when a
+                    # file is processed again
+                    operation = operation.upsert()
+                operation.update_one({'$set': update})
+                bulk_jobs.append(job)
+                updates[job] = (update, worker_input == 'gridfs-file')
+            elif worker_input == worker_output == 'corpus':
+                # corpus jobs are rare, they don't need a bulk operation
+                try:
+                    self.corpora_collection.update({'_id': document_id},
+                                                   {'$set': result}, w=1)
+                except OperationFailure as exception:
+                    failed[job] = str(exception)
+                    continue
+                self.checkpoint_collection.remove({'_id': job.job_id})
+                # the state of the checkpoint may be stored in GridFS
+                written[job][0].append((job.job_id, 'state'))
+            #TODO: what if we have other combinations of input/output?
+        # acknowledged writes, so results are stored before 'job finished'
+        if bulk_jobs:
+            try:
+                bulk.execute({'w': 1})
+            except BulkWriteError as exception:
+                for error in exception.details['writeErrors']:
+                    job = bulk_jobs[error['index']]
+                    if error.get('code') in document_too_large_errors:
+                        update, upsert = updates[job]
+                        new_files = self.save_spilled(job, update, upsert)
+                        if new_files is not None:
+                            written[job][1].update(new_files)
+                            continue
+                    failed[job] = error['errmsg']
+            self.database_round_trips_saved += len(bulk_jobs) - 1
+        self.save_cache_entries([job for job, result in self.unflushed_jobs
+                                 if job not in failed])
+        written_fields = []
+        kept_files = set()
+        for job, (fields, files) in written.iteritems():
+            if job in failed:
+                self.discard_result(job, fields, files)
+            else:
+                written_fields.extend(fields)
+                kept_files.update(files)
+        # only after the new values are stored
+        self.deleted_files += delete_stale_files(self.gridfs,
+                                                 self.gridfs_files,
+                                                 written_fields, kept_files)
+        self.logger.info('Saved results of {} jobs'\
+                         .format(len(self.unflushed_jobs) - len(failed)))
+        for job, result in self.unflushed_jobs:
+            duration = job.end_time - job.start_time
+            if job in failed:
+                self.failed_jobs += 1
+                self.logger.info('Job failed: {} ({})'.format(job,
+                                                              failed[job]))
+                message = {'command': 'job failed', 'job id': job.job_id,
+                           'error': failed[job],
+                           'resource usage': {'duration': duration}}
+            else:
+                message = {'command': 'job finished', 'job id': job.job_id,
+                           'duration': duration}
+                if job.process is None:
+                    message['cached'] = True
+            self.request(message)
+            self.get_reply()
+        self.unflushed_jobs = []
+
+    def save_spilled(self, job, update, upsert=False):
+        '''Write a result again with all its values stored in GridFS
+
+        Used when the document would be bigger than MongoDB allows. Return
+        the ids of the new files, or None if it still can't be written.
+        '''
+        document_id = ObjectId(job.document_id)
+        values = {key: update[key] for key in job.provides()
+                  if key in update and not is_reference(update[key])}
+        spilled = spill_big_values(values, self.gridfs, 0,
+                                   document_id=document_id)
+        new_files = set(file_id for value in spilled.itervalues()
+                        for file_id in referenced_files(value))
+        update = dict(update)
+        update.update(spilled)
+        try:
+            self.collection.update({'_id': document_id}, {'$set': update},
+                                   upsert=upsert, w=1)
+        except OperationFailure:
+            for file_id in new_files:
+                self.gridfs.delete(file_id)
+            return None
+        return new_files
+
+    def save_cache_entries(self, jobs):
+        '''Point the result cache to the documents with the results of jobs
+
+        The cache is only an optimization: entries that can't be written are
+        not an error.
+        '''
+        cache_bulk = self.cache_collection.initialize_unordered_bulk_op()
+        cache_writes = 0
+        for job in jobs:
+            if job.cache_key is not None and job.process is not None:
+                entry = {'_id': job.cache_key,
+                         'document': ObjectId(job.document_id)}
+                cache_bulk.find({'_id': job.cache_key}).upsert()\
+                          .replace_one(entry)
+                cache_writes += 1
+        if not cache_writes:
+            return
+        try:
+            cache_bulk.execute({'w': 1})
+        except BulkWriteError as exception:
+            self.logger.info('Could not save {} result cache entries'\
+                             .format(len(exception.details['writeErrors'])))
+        self.database_round_trips_saved += cache_writes - 1
+
+    def discard_result(self, job, fields, files):
+        '''Forget the result of a job that could not be written'''
+        for file_id in files:
+            self.gridfs.delete(file_id)
+        if self.field_cache is not None:
+            keys = [key for document_id, key in fields]
+            self.field_cache.invalidate(job.document_id, keys +
+                                        ['_fingerprints.' + key
+                                         for key in keys])
+
+    def get_versions(self, job, fingerprints):
+        '''Return the stamps of the results of a job, by worker
+
+        `fingerprints` has the fingerprints of the job's result, the ones of
+        its input are in the job. All the workers of a fused job are
+        stamped: intermediate results are not stored, so their fingerprints
+        are missing here as they are in the document (see
+        `pypln.planner.stale_pipelines`).
+        '''
+        all_fingerprints = dict(job.fingerprints)
+        all_fingerprints.update(fingerprints)
+        return {worker: get_stamp(worker, all_fingerprints, job.contents_md5)
+                for worker in job.workers}
+
+    def save_chunk(self, job, partial_result):
+        '''Store a partial result of a chunked worker in GridFS'''
+        provides = workers.available[job.worker]['provides']
+        for key, value in partial_result.iteritems():
+            if key not in provides:
+                continue
+            file_id, length = put_chunk(self.gridfs, key, value,
+                                        ObjectId(job.document_id))
+            job.chunks.setdefault(key, []).append(file_id)
+            job.chunks_length[key] = job.chunks_length.get(key, 0) + length
+
+    def stop_job(self, job, kill=False):
+        '''Give back the job's process and clean up its payloads'''
+        for payload in job.payloads:
+            payload.remove()
+        if job.process is not None:
+            # fused jobs don't tell much about any of their workers
+            if self.controller is not None and job.pipeline is None:
+                self.controller.record(job.worker, job.get_resource_usage())
+            del self.job_channels[job.process.fileno()]
+            self.poller.unregister(job.process.fileno())
+            if kill:
+                self.pool.discard(job.process)
+            else:
+                self.pool.release(job.process)
+
+    def adjust_concurrency(self):
+        '''Update `max_jobs`, return True if it grew'''
+        old_max_jobs = self.max_jobs
+        self.max_jobs = self.controller.update(len(self.jobs))
+        if self.max_jobs != old_max_jobs:
+            self.logger.info('Running up to {} jobs'.format(self.max_jobs))
+            self.pool.resize(self.max_jobs)
+        return self.max_jobs > old_max_jobs
+
+    def get_limits(self, job):
+        '''Return the limits of a job
+
+        For fused jobs, timeouts are the sum of the timeouts of their workers
+        and the memory limit is the biggest one (None if any is None).
+        '''
+        limits = {}
+        for name, default in self.default_limits.iteritems():
+            values = []
+            for worker in job.workers:
+                limit = workers.available[worker][name]
+                values.append(default if limit is None else limit)
+            if None in values:
+                limits[name] = None
+            elif name == 'max memory':
+                limits[name] = max(values)
+            else:
+                limits[name] = sum(values)
+        return limits
+
+    def check_limits(self):
+        '''Kill jobs that exceed their time or memory limits
+
+        Return True if any job was killed.
+        '''
+        self.last_limits_check = time()
+        killed = False
+        for job in list(self.jobs):
+            if job.process is None:
+                continue
+            limits = self.get_limits(job)
+            if all(limit is None for limit in limits.values()):
+                continue
+            usage = job.get_resource_usage()
+            error = None
+            if limits['timeout'] is not None and \
+               usage['duration'] > limits['timeout']:
+                error = 'Timeout ({}s)'.format(limits['timeout'])
+            elif limits['cpu timeout'] is not None and \
+                 usage.get('cpu time', 0) > limits['cpu timeout']:
+                error = 'CPU timeout ({}s)'.format(limits['cpu timeout'])
+            elif limits['max memory'] is not None and \
+                 usage.get('resident memory', 0) > limits['max memory']:
+                error = 'Memory limit ({} bytes)'.format(limits['max memory'])
+            if error is not None:
+                self.fail_job(job, error, usage, kill=True)
+                killed = True
+        return killed
+
+    def fail_job(self, job, error, usage=None, kill=False):
+        if usage is None:
+            usage = job.get_resource_usage()
+        self.stop_job(job, kill=kill)
+        for file_ids in job.chunks.values():
+            for file_id in file_ids:
+                self.gridfs.delete(file_id)
+        self.jobs.remove(job)
+        self.failed_jobs += 1
+        self.logger.info('Job failed: {} ({})'.format(job, error))
+        self.request({'command': 'job failed', 'job id': job.job_id,
+                      'error': error, 'resource usage': usage})
+        self.get_reply()
+
+    def finish_job(self, job):
+        '''Handle a message from the job's process
+
+        Return True if the job is not running anymore (it finished or
+        failed), False if it only sent a partial result.
+        '''
+        status, result = job.get_result()
+        if status == 'chunk':
+            self.save_chunk(job, load_payloads(result))
+            return False
+        elif status != 'result':
+            # if the process died it can't be reused
+            self.fail_job(job, result, kill=status == 'died')
+            return True
+        result = load_payloads(result)
+        for key, file_ids in job.chunks.iteritems():
+            result[key] = chunked_reference(file_ids, job.chunks_length[key])
+        job.end_time = time()
+        self.stop_job(job)
+        self.logger.info('Job finished: {}'.format(job))
+        update_keys = job.provides()
+        for key in result.keys():
+            if key not in update_keys:
+                del result[key]
+            elif self.field_cache is not None:
+                self.field_cache.put(job.document_id, key, result[key])
+        self.jobs.remove(job)
+        self.save_result(job, result)
+        return True
+
     def run(self):
         self.logger.info('Entering main loop')
         try:
@@ -204,41 +958,30 @@ class ManagerBroker(ManagerClient):
             while True:
                 if self.should_save_monitoring_information_now():
                     self.save_monitoring_information()
-                if not self.full_of_jobs() and self.manager_has_job():
-                    self.get_a_job()
-                for job in self.finished_jobs():
-                    result = job.get_result()
-                    job.end()
-                    end_time = time()
-                    self.logger.info('Job finished: {}'.format(job))
-                    update_keys = workers.available[job.worker]['provides']
-                    for key in result.keys():
-                        if key not in update_keys:
-                            del result[key]
-                    worker_input = workers.available[job.worker]['from']
-                    worker_output = workers.available[job.worker]['to']
-                    if worker_input == worker_output == 'document':
-                        update_data = [{'_id': ObjectId(job.document_id)},
-                                       {'$set': result}]
-                        self.collection.update(*update_data)
-                        #TODO: what if document > 16MB?
-                    elif worker_input == 'gridfs-file' and \
-                         worker_output == 'document':
-                        data = {'_id': ObjectId(job.document_id)}
-                        data.update(result)
-                        self.collection.insert(data)
-                    #TODO: use safe=True (probably on pypln.stores)
-                    #TODO: what if we have other combinations of input/output?
-                    self.request({'command': 'job finished',
-                                  'job id': job.job_id,
-                                  'duration': end_time - job.start_time})
-                    result = self.get_reply()
-                    self.jobs.remove(job)
+                if self.should_send_heartbeat_now():
+                    self.send_heartbeat()
+                manager_has_job, finished_jobs = self.wait_for_events()
+                slots_freed = False
+                for job in finished_jobs:
+                    slots_freed = self.finish_job(job) or slots_freed
+                if time() - self.last_limits_check >= \
+                   self.limits_check_interval:
+                    slots_freed = self.check_limits() or slots_freed
+                    if self.controller is not None:
+                        slots_freed = self.adjust_concurrency() or \
+                                      slots_freed
+                if self.should_flush_results_now():
+                    self.flush_results()
+                if slots_freed or \
+                   (manager_has_job and not self.full_of_jobs()):
                     self.get_a_job()
         except KeyboardInterrupt:
             self.logger.info('Got SIGNINT (KeyboardInterrupt), exiting.')
             self.close_sockets()
             self.kill_processes()
+            for job in self.jobs:
+                for payload in job.payloads:
+                    payload.remove()
 
 def main():
     from logging import Logger, StreamHandler, Formatter
@@ -2,13 +2,15 @@
 # coding: utf-8
 
 from logging import Logger, NullHandler
-from copy import deepcopy
+from time import sleep
 import zmq
 
 
 class ManagerClient(object):
-    def __init__(self, logger=None, logger_name='ManagerClient'):
+    def __init__(self, logger=None, logger_name='ManagerClient',
+                 pipelined=False):
         self.context = zmq.Context()
+        self.pipelined = pipelined
         if logger is None:
             self.logger = Logger(logger_name)
             self.logger.addHandler(NullHandler())
@@ -21,7 +23,12 @@ class ManagerClient(object):
         if api_host_port is not None:
             self.api_host_port = api_host_port
             self.api_connection_string = 'tcp://{}:{}'.format(*api_host_port)
-            self.manager_api = self.context.socket(zmq.REQ)
+            if self.pipelined:
+                # DEALER does not enforce the send/receive lockstep, so we can
+                # have many requests in flight (replies come in order)
+                self.manager_api = self.context.socket(zmq.DEALER)
+            else:
+                self.manager_api = self.context.socket(zmq.REQ)
             self.manager_api.connect(self.api_connection_string)
         if broadcast_host_port is not None:
             self.broadcast_host_port = broadcast_host_port
@@ -31,11 +38,18 @@ class ManagerClient(object):
             self.manager_broadcast.connect(self.broadcast_connection_string)
 
     def send_api_request(self, json):
+        if self.pipelined:
+            self.manager_api.send('', zmq.SNDMORE)
         self.manager_api.send_json(json)
 
     def get_api_reply(self):
+        if self.pipelined:
+            self.manager_api.recv()
         return self.manager_api.recv_json()
 
+    def api_poll(self, timeout=0):
+        return self.manager_api.poll(timeout)
+
     def broadcast_subscribe(self, subscribe_to):
         return self.manager_broadcast.setsockopt(zmq.SUBSCRIBE, subscribe_to)
 
@@ -67,55 +81,88 @@ class Worker(object):
         self.after = after
         return self
 
+    def to_dict(self):
+        return {'worker': self.name,
+                'after': [worker.to_dict() for worker in self.after]}
+
 class Pipeline(object):
     def __init__(self, pipeline, api_host_port, broadcast_host_port,
-                 logger=None, logger_name='Pipeline', time_to_wait=0.1):
+                 logger=None, logger_name='Pipeline', time_to_wait=0.1,
+                 bulk_size=1000, priority=0, owner=None, corpus=None,
+                 max_backoff=60, fused=False):
         self.client = ManagerClient(logger, logger_name)
         self.client.connect(api_host_port, broadcast_host_port)
         self.pipeline = pipeline
         self.time_to_wait = time_to_wait
+        self.bulk_size = bulk_size
+        self.max_backoff = max_backoff
+        # a fused pipeline runs all its workers in one process of the same
+        # broker, so only the final results are stored in the database
+        self.fused = fused
+        self.attributes = {'priority': priority}
+        if owner is not None:
+            self.attributes['owner'] = owner
+        if corpus is not None:
+            self.attributes['corpus'] = corpus
         self.logger = self.client.logger
 
-    def send_job(self, worker):
-        job = {'command': 'add job', 'worker': worker.name,
-               'document': worker.document}
-        self.client.manager_api.send_json(job)
-        self.logger.info('Sent job: {}'.format(job))
-        message = self.client.manager_api.recv_json()
-        self.logger.info('Received from Manager API: {}'.format(message))
-        self.waiting[message['job id']] = worker
-        subscribe_message = 'job finished: {}'.format(message['job id'])
-        self.client.manager_broadcast.setsockopt(zmq.SUBSCRIBE,
-                                                 subscribe_message)
-        self.logger.info('Subscribed on Manager Broadcast to: {}'\
-                         .format(subscribe_message))
+    def wait_before_retry(self, message, attempt):
+        '''Sleep for the time Manager asked, doubling it on each attempt'''
+        wait = min(message['retry after'] * 2 ** attempt, self.max_backoff)
+        self.logger.info('Manager queue is full, retrying in {} seconds'\
+                         .format(wait))
+        sleep(wait)
+
+    def send_pipelines(self, documents):
+        attempt = 0
+        while documents:
+            message = {'command': 'add pipelines',
+                       'pipeline': self.pipeline.to_dict(),
+                       'documents': documents}
+            if self.fused:
+                message['fused'] = True
+            message.update(self.attributes)
+            self.client.send_api_request(message)
+            self.logger.info('Sent pipeline for {} documents'\
+                             .format(len(documents)))
+            message = self.client.get_api_reply()
+            pipeline_ids = message['pipeline ids']
+            self.logger.info('Received {} pipeline ids from Manager API'\
+                             .format(len(pipeline_ids)))
+            for pipeline_id, document in zip(pipeline_ids, documents):
+                self.waiting[pipeline_id] = document
+                subscribe_message = 'pipeline finished: {}'\
+                                    .format(pipeline_id)
+                self.client.manager_broadcast.setsockopt(zmq.SUBSCRIBE,
+                                                         subscribe_message)
+            documents = documents[len(pipeline_ids):]
+            if message['answer'] == 'queue full':
+                attempt = 0 if pipeline_ids else attempt + 1
+                self.wait_before_retry(message, attempt)
 
     def distribute(self):
         self.waiting = {}
-        for document in self.documents:
-            worker = deepcopy(self.pipeline)
-            worker.document = document
-            self.send_job(worker)
+        for start in range(0, len(self.documents), self.bulk_size):
+            self.send_pipelines(self.documents[start:start + self.bulk_size])
 
     def run(self, documents):
+        '''Send the whole pipeline to Manager and wait for it to finish
+
+        The Manager enqueues the next workers itself when a job finishes, so
+        the pipeline keeps running even if this process exits.
+        '''
         self.documents = documents
         self.distribute()
         try:
-            while True:
+            while self.waiting:
                 if self.client.manager_broadcast.poll(self.time_to_wait):
                     message = self.client.manager_broadcast.recv()
                     self.logger.info('[Client] Received from broadcast: {}'\
                                      .format(message))
-                    if message.startswith('job finished: '):
-                        #TODO: unsubscribe
-                        job_id = message.split(': ')[1].split(' ')[0]
-                        worker = self.waiting[job_id]
-                        for next_worker in worker.after:
-                            next_worker.document = worker.document
-                            self.send_job(next_worker)
-                        del self.waiting[job_id]
-                if not self.waiting.keys():
-                    break
+                    if message.startswith('pipeline finished: '):
+                        pipeline_id = message.split(': ')[1]
+                        self.client.broadcast_unsubscribe(message)
+                        del self.waiting[pipeline_id]
         except KeyboardInterrupt:
             self.client.close_sockets()
 
@@ -123,7 +170,7 @@ def main():
     import os
     from logging import Logger, StreamHandler, Formatter
     from sys import stdout, argv
-    from pymongo import Connection
+    from pypln.stores import connect
     from gridfs import GridFS
 
 
@@ -141,13 +188,8 @@ def main():
                      'monitoring collection': 'monitoring'},
               'monitoring interval': 60,}
     db_config = config['db']
-    mongo_connection = Connection(db_config['host'], db_config['port'])
-    db = mongo_connection[db_config['database']]
-    if 'username' in db_config and 'password' in db_config and \
-            db_config['username'] and db_config['password']:
-           db.authenticate(db_config['username'], db_config['password'])
+    mongo_connection, db = connect(db_config)
     gridfs = GridFS(db, db_config['gridfs collection'])
-    #TODO: connection/collection lines should be in pypln.stores.mongodb
 
     logger = Logger('Pipeline')
     handler = StreamHandler(stdout)
@@ -0,0 +1,105 @@
+# coding: utf-8
+
+from collections import defaultdict
+from math import ceil
+from multiprocessing import cpu_count
+from pypln.utils import get_load_signals
+
+
+class WorkerHistory(object):
+    '''Moving averages of the resources used by the jobs of a worker'''
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.jobs = 0
+        # fraction of a CPU used while the job runs (I/O-bound jobs or jobs
+        # that wait on subprocesses use less than 1)
+        self.cpu_share = None
+        self.memory = None
+
+    def average(self, old_value, new_value):
+        if old_value is None:
+            return new_value
+        return (1 - self.alpha) * old_value + self.alpha * new_value
+
+    def add(self, usage):
+        if 'cpu time' not in usage or not usage['duration']:
+            return
+        cpu_share = min(1.0, usage['cpu time'] / usage['duration'])
+        self.cpu_share = self.average(self.cpu_share, cpu_share)
+        self.memory = self.average(self.memory, usage['resident memory'])
+        self.jobs += 1
+
+class ConcurrencyController(object):
+    '''Decide how many jobs (in total and of each worker) a broker runs
+
+    The total limit starts at the number of CPUs and is adjusted with live
+    signals of the host: it grows by one job while the broker is using all
+    its slots and CPU use is below `cpu_target` (percent) and halves when
+    available memory is below `memory_reserve` (fraction of total memory)
+    or the load average is too high. It is always between `min_jobs` and
+    `max_jobs`.
+
+    The limit of each worker type also uses the worker's history: a worker
+    that uses 1/4 of a CPU can run 4 jobs per CPU, and a worker only gets
+    new jobs while the memory its jobs usually use is available.
+    '''
+    def __init__(self, cpus=None, min_jobs=1, max_jobs=None, cpu_target=85,
+                 memory_reserve=0.1):
+        self.cpus = cpus or cpu_count()
+        self.min_jobs = min_jobs
+        self.max_jobs = max_jobs or 4 * self.cpus
+        self.cpu_target = cpu_target
+        self.memory_reserve = memory_reserve
+        self.limit = min(self.cpus, self.max_jobs)
+        self.history = defaultdict(WorkerHistory)
+        self.signals = None
+
+    def record(self, worker, usage):
+        '''Add resource usage of a finished job to its worker's history'''
+        self.history[worker].add(usage)
+
+    def free_memory(self):
+        '''Memory that jobs can still use (or None if unknown)'''
+        if self.signals is None:
+            return None
+        return self.signals['available memory'] - \
+               self.memory_reserve * self.signals['total memory']
+
+    def update(self, running_jobs, signals=None):
+        '''Adjust and return the total limit, based on live signals
+
+        `signals` default to `pypln.utils.get_load_signals()`.
+        '''
+        if signals is None:
+            signals = get_load_signals()
+        self.signals = signals
+        if self.free_memory() < 0 or \
+           self.signals['load average'] > 2 * self.cpus:
+            self.limit = max(self.min_jobs, self.limit // 2)
+        elif running_jobs >= self.limit and \
+             self.signals['cpu percent'] < self.cpu_target and \
+             self.signals['load average'] < self.cpus:
+            self.limit = min(self.max_jobs, self.limit + 1)
+        return self.limit
+
+    def worker_limits(self, capabilities, running):
+        '''Return how many jobs of each worker can run at once
+
+        `capabilities` maps worker names to their maximum and `running` to
+        how many of their jobs are running now.
+        '''
+        free_memory = self.free_memory()
+        limits = {}
+        for name, maximum in capabilities.iteritems():
+            limit = min(maximum, self.limit)
+            history = self.history.get(name, None)
+            if history is not None and history.jobs:
+                if history.cpu_share:
+                    cpu_limit = int(ceil(self.cpus / history.cpu_share))
+                    limit = min(limit, cpu_limit)
+                if free_memory is not None and history.memory:
+                    memory_limit = running.get(name, 0) + \
+                                   int(max(0, free_memory) / history.memory)
+                    limit = min(limit, memory_limit)
+            limits[name] = limit
+        return limits
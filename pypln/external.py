@@ -0,0 +1,133 @@
+# coding: utf-8
+
+"""Workers backed by long-lived external programs
+
+A worker can be any executable (in C, Perl, Ruby etc.) that speaks this
+protocol over its stdin and stdout, so the program is started (and loads its
+models) once per broker process and not once per document. Each message is
+a line with the length of its body, in bytes, followed by the body: a JSON
+object encoded in UTF-8. For example::
+
+    27
+    {"text": "The cat sat."}
+
+The program receives one document per message (only the fields the worker
+requires) and must answer each one, in order, with ``{"result": {...}}`` or
+``{"error": "description"}``. It should exit when its stdin is closed.
+
+To use it, create a worker module whose `__meta__` has a 'command' (a list
+of arguments) instead of a `main` function::
+
+    __meta__ = {'from': 'document', 'requires': ['text'],
+                'to': 'document', 'provides': ['parse'],
+                'command': ['palavras-json', '--lang', 'pt']}
+
+An optional 'max requests' in `__meta__` restarts the program after that
+many documents.
+"""
+
+import json
+from subprocess import Popen, PIPE
+from time import sleep, time
+
+
+class ExternalWorkerError(Exception):
+    pass
+
+def write_message(fp, message):
+    body = json.dumps(message, default=str)
+    fp.write('{}\n{}'.format(len(body), body))
+    fp.flush()
+
+def read_message(fp):
+    header = fp.readline()
+    if not header:
+        raise EOFError('External program closed its stdout')
+    body = fp.read(int(header))
+    if len(body) < int(header):
+        raise EOFError('External program closed its stdout')
+    return json.loads(body)
+
+class ExternalProcess(object):
+    '''An external program that processes documents sent to it
+
+    The program is started on the first request and restarted on the next
+    one if it crashes (or after `max_requests` requests, if not None). If
+    `fields` is not None only these fields of the documents are sent.
+    '''
+    def __init__(self, command, fields=None, max_requests=None,
+                 stop_timeout=1):
+        self.command = command
+        self.fields = fields
+        self.max_requests = max_requests
+        self.stop_timeout = stop_timeout
+        self.process = None
+        self.requests = 0
+        self.starts = 0
+
+    def __repr__(self):
+        pid = None if self.process is None else self.process.pid
+        return '<ExternalProcess(command={}, pid={}, requests={})>'\
+               .format(self.command, pid, self.requests)
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        self.process = Popen(self.command, stdin=PIPE, stdout=PIPE,
+                             close_fds=True)
+        self.requests = 0
+        self.starts += 1
+
+    def stop(self):
+        '''Close program's stdin and wait for it to exit (or kill it)'''
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        end_time = time() + self.stop_timeout
+        while self.process.poll() is None and time() < end_time:
+            sleep(0.01)
+        self.kill()
+
+    def kill(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        for fp in (self.process.stdin, self.process.stdout):
+            try:
+                fp.close()
+            except IOError:
+                pass
+        self.process = None
+
+    def request(self, document):
+        '''Send `document` to the program and return its result'''
+        if self.fields is not None:
+            document = {key: document[key] for key in self.fields
+                        if key in document}
+        if not self.is_alive():
+            self.kill()
+            self.start()
+        try:
+            write_message(self.process.stdin, document)
+            answer = read_message(self.process.stdout)
+        except (IOError, EOFError, ValueError):
+            # the program crashed or is out of sync, a new one will be
+            # started for the next request
+            self.kill()
+            raise ExternalWorkerError('External program {} crashed'\
+                                      .format(self.command))
+        self.requests += 1
+        if self.max_requests is not None and \
+           self.requests >= self.max_requests:
+            self.stop()
+        if 'error' in answer:
+            raise ExternalWorkerError(answer['error'])
+        return answer['result']
+
+    __call__ = request
@@ -1,33 +1,115 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import heapq
+import json
 import uuid
-from Queue import Queue
+from collections import defaultdict
 from logging import Logger, NullHandler
+from time import time
 import zmq
+from pypln.scheduler import FairQueue
+from pypln.stores.journal import JobJournal
+from pypln.utils import pipeline_workers, is_valid_pipeline, with_defaults
+
+
+# fields used for scheduling, that the next jobs of a pipeline inherit
+job_attributes = ['priority', 'owner', 'corpus']
 
 
 class Manager(object):
-    #TODO: add another queue for processing jobs
-    #TODO: add a timeout for processing jobs (default or get it from client)
-    #TODO: if processing job have timeout, remove from processing queue, add
-    #      again in job_queue and announce pending job
-    def __init__(self, config, logger=None, logger_name='Manager'):
-        self.job_queue = Queue()
-        self.pending_job_ids = []
+    def __init__(self, config, logger=None, logger_name='Manager',
+                 journal_filename=None, lease_timeout=None,
+                 lease_check_interval=1, share_weights=None,
+                 max_pending_jobs=None, max_pending_per_worker=None,
+                 max_pending_per_owner=None, retry_after=None, max_attempts=3,
+                 retry_backoff=1.0):
+        self.config = with_defaults(config)
+        # one queue per worker type, so a broker only receives jobs it can
+        # run; entries are (sequence, job) so we can keep the global order
+        # when a broker can run many types of workers
+        # weights by owner (or 'owner/corpus'), see `pypln.scheduler`
+        if share_weights is None:
+            share_weights = self.config['share weights']
+        self.share_weights = share_weights
+        self.job_queues = defaultdict(lambda: FairQueue(self.share_weights))
+        # workers a broker must have to run the jobs of each queue (fused
+        # pipelines run all their workers in the same broker)
+        self.queue_workers = {}
+        self.job_sequence = {}
+        self.enqueued_at = {}
+        self.wait_statistics = defaultdict(lambda: {'jobs': 0,
+                                                    'total': 0.0,
+                                                    'max': 0.0})
+        self.next_sequence = 0
+        self.pending_jobs = {}
+        # (worker, document) -> job id, for jobs outside pipelines, so the
+        # same job submitted twice is executed only once
+        self.pending_keys = {}
+        self.deduplicated_jobs = 0
+        self.cached_jobs = 0
+        # admission control: new jobs are refused with 'queue full' when any
+        # of these high-water marks would be crossed (None in the
+        # configuration means no limit); arguments override configuration
+        limits = self.config['admission control']
+        if max_pending_jobs is None:
+            max_pending_jobs = limits['max pending jobs']
+        if max_pending_per_worker is None:
+            max_pending_per_worker = limits['max pending per worker']
+        if max_pending_per_owner is None:
+            max_pending_per_owner = limits['max pending per owner']
+        if retry_after is None:
+            retry_after = limits['retry after']
+        self.max_pending_jobs = max_pending_jobs
+        self.max_pending_per_worker = max_pending_per_worker
+        self.max_pending_per_owner = max_pending_per_owner
+        self.retry_after = retry_after
+        self.pending_per_worker = defaultdict(int)
+        self.pending_per_owner = defaultdict(int)
+        self.refused_jobs = 0
+        # jobs handed to a broker are leased to it: if the broker does not
+        # send any request (or 'heartbeat') for `lease_timeout` seconds, all
+        # its jobs go back to the queue
+        self.leases = {}
+        self.broker_jobs = defaultdict(set)
+        self.brokers_last_seen = {}
+        if lease_timeout is None:
+            lease_timeout = 3 * self.config['heartbeat interval']
+        self.lease_timeout = lease_timeout
+        self.lease_check_interval = lease_check_interval
+        self.last_lease_check = time()
+        # number of pending jobs of each pipeline, so we know when the whole
+        # pipeline for a document finished
+        self.pipelines = defaultdict(int)
+        # failed jobs are retried after `retry_backoff` seconds, doubled at
+        # each new failure; after `max_attempts` failures they go to the
+        # dead letter list (`dead_jobs`) and are not retried anymore
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.delayed_jobs = []
+        self.dead_jobs = []
         self.context = zmq.Context()
-        self.config = config
         if logger is None:
             self.logger = Logger(logger_name)
             self.logger.addHandler(NullHandler())
         else:
             self.logger = logger
+        self.journal = None
+        if journal_filename is not None:
+            self.journal = JobJournal(journal_filename)
+            self.recover_jobs()
+
+    def recover_jobs(self):
+        jobs = self.journal.recover()
+        self.enqueue(jobs)
+        self.dead_jobs = self.journal.dead.values()
+        self.logger.info('Recovered {} jobs from journal'.format(len(jobs)))
 
     def bind(self, api_host_port, broadcast_host_port):
         self.api_host_port = api_host_port
         self.broadcast_host_port = broadcast_host_port
 
-        self.api = self.context.socket(zmq.REP)
+        self.api = self.context.socket(zmq.ROUTER)
         self.broadcast = self.context.socket(zmq.PUB)
 
         self.api.bind('tcp://{}:{}'.format(*self.api_host_port))
@@ -37,63 +119,485 @@ class Manager(object):
         self.api.close()
         self.broadcast.close()
 
+    def wait_for_request(self):
+        '''Wait for a request, doing periodic tasks while idle
+
+        Periodic tasks are journal's group commit, lease expiration and
+        retries of failed jobs.
+        '''
+        self.requeue_expired_leases()
+        self.retry_delayed_jobs()
+        timeouts = [self.lease_check_interval - \
+                    (time() - self.last_lease_check)]
+        if self.delayed_jobs:
+            timeouts.append(self.delayed_jobs[0][0] - time())
+        if self.journal is not None:
+            self.journal.sync_if_needed()
+            time_to_sync = self.journal.time_to_next_sync()
+            if time_to_sync is not None:
+                timeouts.append(time_to_sync)
+        return self.api.poll(max(0, min(timeouts)) * 1000)
+
+    def announce_new_jobs(self):
+        self.broadcast.send('new job')
+        self.logger.info('[Broadcast] Sent "new job"')
+
+    def enqueue(self, jobs):
+        for job in jobs:
+            job_id = job['job id']
+            self.pending_jobs[job_id] = job
+            self.pending_per_worker[job['worker']] += 1
+            self.pending_per_owner[job.get('owner', '')] += 1
+            if 'pipeline' not in job:
+                self.pending_keys[(job['worker'], job['document'])] = job_id
+            self.job_sequence[job_id] = self.next_sequence
+            self.enqueued_at[job_id] = time()
+            self.job_queues[self.queue_name(job)].push(self.next_sequence,
+                                                       job)
+            self.next_sequence += 1
+            if 'pipeline' in job:
+                self.pipelines[job['pipeline']] += 1
+
+    def queue_name(self, job):
+        '''Return the name of the job's queue: its worker or fused workers'''
+        if job.get('fused'):
+            names = pipeline_workers(job)
+            name = '+'.join(names)
+        else:
+            name, names = job['worker'], [job['worker']]
+        self.queue_workers.setdefault(name, names)
+        return name
+
+    def requeue(self, jobs):
+        '''Put jobs that were handed out back on the head of their queues'''
+        jobs.sort(key=lambda job: self.job_sequence[job['job id']],
+                  reverse=True)
+        for job in jobs:
+            sequence = self.job_sequence[job['job id']]
+            self.enqueued_at[job['job id']] = time()
+            self.job_queues[self.queue_name(job)].push(sequence, job,
+                                                       front=True)
+            if self.journal is not None:
+                self.journal.requeue_job(job['job id'])
+
+    def admissible(self, jobs):
+        '''Return how many of `jobs` (in order) fit below high-water marks'''
+        total = len(self.pending_jobs)
+        per_worker = {}
+        per_owner = {}
+        for index, job in enumerate(jobs):
+            worker, owner = job['worker'], job.get('owner', '')
+            total += 1
+            per_worker[worker] = per_worker.get(worker,
+                    self.pending_per_worker.get(worker, 0)) + 1
+            per_owner[owner] = per_owner.get(owner,
+                    self.pending_per_owner.get(owner, 0)) + 1
+            if (self.max_pending_jobs is not None and \
+                total > self.max_pending_jobs) or \
+               (self.max_pending_per_worker is not None and \
+                per_worker[worker] > self.max_pending_per_worker) or \
+               (self.max_pending_per_owner is not None and \
+                per_owner[owner] > self.max_pending_per_owner):
+                self.refused_jobs += len(jobs) - index
+                return index
+        return len(jobs)
+
+    def add_jobs(self, jobs):
+        for job in jobs:
+            job['job id'] = uuid.uuid4().hex
+        if self.journal is not None:
+            self.journal.add_jobs(jobs)
+        self.enqueue(jobs)
+
+    def add_unique_jobs(self, jobs):
+        '''Add the jobs that are not pending yet and return all the job ids
+
+        A job is the same as a pending one if it runs the same worker on the
+        same document.
+        '''
+        new_jobs = []
+        new_keys = set()
+        for job in jobs:
+            key = (job['worker'], job['document'])
+            if key in self.pending_keys or key in new_keys:
+                self.deduplicated_jobs += 1
+            else:
+                new_keys.add(key)
+                new_jobs.append(job)
+        self.add_jobs(new_jobs)
+        return [self.pending_keys[(job['worker'], job['document'])]
+                for job in jobs]
+
+    def add_pipelines(self, pipeline, documents, attributes=None,
+                      fused=False):
+        '''Create one pipeline per document and enqueue its first job
+
+        `pipeline` is a tree: ``{'worker': name, 'after': [pipeline, ...]}``.
+        The next jobs are enqueued by the manager when its parent finishes.
+        If `fused` is True the whole pipeline is a single job, that a broker
+        with all its workers runs in one process, so intermediate results are
+        not stored. `attributes` (priority, owner etc.) are copied to all the
+        jobs. Only the pipelines that pass admission control are created.
+        '''
+        jobs = []
+        for document in documents:
+            job = dict(attributes or {})
+            job.update({'worker': pipeline['worker'], 'document': document,
+                        'pipeline': uuid.uuid4().hex,
+                        'after': pipeline.get('after', [])})
+            if fused:
+                job['fused'] = True
+            jobs.append(job)
+        jobs = jobs[:self.admissible(jobs)]
+        self.add_jobs(jobs)
+        return [job['pipeline'] for job in jobs]
+
+    def next_queue(self, worker_limits):
+        '''Return the name of the queue with the next job to run (or None)
+
+        The next job is the one with the highest priority and, between jobs
+        with the same priority, the oldest one. Only queues whose workers are
+        all in `worker_limits`, with free slots for the first one, are used.
+        '''
+        next_name, next_key = None, None
+        for name, queue in self.job_queues.iteritems():
+            names = self.queue_workers[name]
+            if worker_limits.get(names[0], 0) <= 0 or \
+               any(worker not in worker_limits for worker in names):
+                continue
+            head = queue.peek(self.pending_jobs.__contains__)
+            if head is None:
+                continue
+            priority, (sequence, job) = head
+            if next_key is None or (-priority, sequence) < next_key:
+                next_name, next_key = name, (-priority, sequence)
+        return next_name
+
+    def update_wait_statistics(self, job):
+        wait = time() - self.enqueued_at.pop(job['job id'])
+        statistics = self.wait_statistics[job.get('priority', 0)]
+        statistics['jobs'] += 1
+        statistics['total'] += wait
+        statistics['max'] = max(statistics['max'], wait)
+
+    def get_statistics(self):
+        queue_wait = {}
+        for priority, statistics in self.wait_statistics.iteritems():
+            queue_wait[str(priority)] = {
+                    'jobs': statistics['jobs'],
+                    'average': statistics['total'] / statistics['jobs'],
+                    'max': statistics['max']}
+        return {'queue wait': queue_wait,
+                'queued jobs': {name: len(queue) for name, queue in
+                                self.job_queues.iteritems() if len(queue)},
+                'pending jobs': len(self.pending_jobs),
+                'refused jobs': self.refused_jobs,
+                'deduplicated jobs': self.deduplicated_jobs,
+                'cached jobs': self.cached_jobs,
+                'delayed jobs': len(self.delayed_jobs),
+                'dead jobs': len(self.dead_jobs)}
+
+    def get_jobs(self, count, workers=None, broker=None):
+        '''Remove up to `count` jobs from the queues, by priority and age
+
+        `workers` restricts the jobs to these worker types: it can be a list
+        of names or a ``dict`` mapping each name to the maximum number of jobs
+        of that type to return. If `broker` is given, the jobs are leased to
+        it.
+        '''
+        if workers is None:
+            names = set()
+            for queue_workers in self.queue_workers.values():
+                names.update(queue_workers)
+            worker_limits = dict.fromkeys(names, count)
+        elif isinstance(workers, dict):
+            worker_limits = dict(workers)
+        else:
+            worker_limits = dict.fromkeys(workers, count)
+        jobs = []
+        while len(jobs) < count:
+            name = self.next_queue(worker_limits)
+            if name is None:
+                break
+            sequence, job = self.job_queues[name].pop()
+            worker_limits[job['worker']] -= 1
+            jobs.append(job)
+            self.update_wait_statistics(job)
+            if self.journal is not None:
+                self.journal.get_job(job['job id'])
+            if broker is not None:
+                self.leases[job['job id']] = broker
+                self.broker_jobs[broker].add(job['job id'])
+        return jobs
+
+    def release_lease(self, job_id):
+        broker = self.leases.pop(job_id, None)
+        if broker is not None:
+            self.broker_jobs[broker].discard(job_id)
+
+    def finish_job(self, job_id):
+        job = self.pending_jobs[job_id]
+        next_jobs = []
+        # the children of a fused job already ran with it
+        children = [] if job.get('fused') else job.get('after', [])
+        for child in children:
+            next_job = {key: job[key] for key in ['pipeline'] + job_attributes
+                        if key in job}
+            next_job.update({'worker': child['worker'],
+                             'document': job['document'],
+                             'after': child.get('after', [])})
+            next_jobs.append(next_job)
+        # next jobs are journaled before the parent is marked as finished, so
+        # a crash here can only cause a job to run twice, never to be lost
+        if next_jobs:
+            self.add_jobs(next_jobs)
+        self.forget_job(job_id)
+        if self.journal is not None:
+            self.journal.finish_job(job_id)
+        if next_jobs:
+            self.announce_new_jobs()
+        self.pipeline_job_done(job)
+
+    def forget_job(self, job_id):
+        '''Remove a job that won't run anymore from the manager's state'''
+        job = self.pending_jobs[job_id]
+        del self.pending_jobs[job_id]
+        self.pending_per_worker[job['worker']] -= 1
+        if not self.pending_per_worker[job['worker']]:
+            del self.pending_per_worker[job['worker']]
+        owner = job.get('owner', '')
+        self.pending_per_owner[owner] -= 1
+        if not self.pending_per_owner[owner]:
+            del self.pending_per_owner[owner]
+        del self.job_sequence[job_id]
+        self.enqueued_at.pop(job_id, None)
+        if 'pipeline' not in job:
+            del self.pending_keys[(job['worker'], job['document'])]
+        self.release_lease(job_id)
+
+    def pipeline_job_done(self, job):
+        if 'pipeline' in job:
+            pipeline_id = job['pipeline']
+            self.pipelines[pipeline_id] -= 1
+            if not self.pipelines[pipeline_id]:
+                del self.pipelines[pipeline_id]
+                self.broadcast.send('pipeline finished: {}'\
+                                    .format(pipeline_id))
+                self.logger.info('[Broadcast] Sent "pipeline finished"')
+
+    def fail_job(self, job_id, error=None, usage=None):
+        '''Retry a failed job later or, after `max_attempts`, dead-letter it
+
+        Return True if the job will be retried.
+        '''
+        job = self.pending_jobs[job_id]
+        self.release_lease(job_id)
+        job['attempts'] = job.get('attempts', 0) + 1
+        if job['attempts'] < self.max_attempts:
+            delay = self.retry_backoff * 2 ** (job['attempts'] - 1)
+            heapq.heappush(self.delayed_jobs,
+                           (time() + delay, self.job_sequence[job_id], job_id))
+            if self.journal is not None:
+                self.journal.fail_job(job_id, job['attempts'])
+            self.logger.info('Job {} failed (attempt {}), retrying in {}s'\
+                             .format(job_id, job['attempts'], delay))
+            return True
+        dead_job = {'job': job, 'error': error, 'resource usage': usage,
+                    'failed at': time()}
+        self.dead_jobs.append(dead_job)
+        self.forget_job(job_id)
+        if self.journal is not None:
+            self.journal.kill_job(job_id, dead_job)
+        self.logger.info('Job {} failed {} times, giving up'\
+                         .format(job_id, job['attempts']))
+        self.pipeline_job_done(job)
+        return False
+
+    def retry_delayed_jobs(self):
+        now = time()
+        retried = []
+        while self.delayed_jobs and self.delayed_jobs[0][0] <= now:
+            ready_at, sequence, job_id = heapq.heappop(self.delayed_jobs)
+            if job_id in self.pending_jobs:
+                retried.append(self.pending_jobs[job_id])
+        if retried:
+            self.requeue(retried)
+            self.announce_new_jobs()
+
+    def broker_seen(self, broker):
+        self.brokers_last_seen[broker] = time()
+
+    def requeue_expired_leases(self):
+        now = time()
+        if now - self.last_lease_check < self.lease_check_interval:
+            return
+        self.last_lease_check = now
+        for broker, last_seen in self.brokers_last_seen.items():
+            if now - last_seen <= self.lease_timeout:
+                continue
+            del self.brokers_last_seen[broker]
+            job_ids = sorted(self.broker_jobs.get(broker, set()),
+                             key=self.job_sequence.get)
+            self.logger.info('Broker {} lost, retrying {} jobs'\
+                             .format(broker, len(job_ids)))
+            for job_id in job_ids:
+                # the job may have killed its broker, so it's a failed
+                # attempt: a job that kills every broker is dead-lettered
+                self.fail_job(job_id, 'Lease expired (broker {} lost)'\
+                                      .format(broker))
+            self.broker_jobs.pop(broker, None)
+
     def get_request(self):
-        message = self.api.recv_json()
+        # ROUTER socket: every frame before the last one is the envelope that
+        # identifies the client (REQ clients add an empty delimiter frame,
+        # DEALER clients may not), so we store it to route the reply back
+        frames = self.api.recv_multipart()
+        self.envelope = frames[:-1]
+        message = json.loads(frames[-1])
         self.logger.info('[API] Request: {}'.format(message))
         return message
 
     def reply(self, message):
-        self.api.send_json(message)
+        self.api.send_multipart(self.envelope + [json.dumps(message)])
         self.logger.info('[API] Reply: {}'.format(message))
 
     def run(self):
         self.logger.info('Entering main loop')
         try:
             while True:
+                if not self.wait_for_request():
+                    continue
                 message = self.get_request()
                 if 'command' not in message:
                     self.reply({'answer': 'undefined command'})
                     continue
                 command = message['command']
+                if 'broker' in message:
+                    self.broker_seen(message['broker'])
                 if command == 'get configuration':
                     self.reply(self.config)
                 elif command == 'add job':
-                    message['job id'] = uuid.uuid4().hex
                     del message['command']
-                    self.job_queue.put(message)
-                    self.pending_job_ids.append(message['job id'])
-                    self.reply({'answer': 'job accepted',
-                                        'job id': message['job id']})
-                    self.broadcast.send('new job')
-                    self.logger.info('[Broadcast] Sent "new job"')
+                    if 'worker' not in message or 'document' not in message:
+                        self.reply({'answer': 'syntax error'})
+                        continue
+                    if not self.admissible([message]):
+                        self.reply({'answer': 'queue full',
+                                    'retry after': self.retry_after})
+                        continue
+                    job_id = self.add_unique_jobs([message])[0]
+                    self.reply({'answer': 'job accepted', 'job id': job_id})
+                    self.announce_new_jobs()
+                elif command == 'add jobs':
+                    if 'jobs' not in message or \
+                       not all('worker' in job and 'document' in job
+                               for job in message['jobs']):
+                        self.reply({'answer': 'syntax error'})
+                        continue
+                    # accept as many jobs as we can, client should send the
+                    # rest again after 'retry after' seconds
+                    jobs = message['jobs']
+                    jobs = jobs[:self.admissible(jobs)]
+                    reply = {'answer': 'jobs accepted',
+                             'job ids': self.add_unique_jobs(jobs)}
+                    if len(jobs) < len(message['jobs']):
+                        reply.update({'answer': 'queue full',
+                                      'retry after': self.retry_after})
+                    self.reply(reply)
+                    if jobs:
+                        self.announce_new_jobs()
+                elif command == 'add pipelines':
+                    if 'documents' not in message or \
+                       not isinstance(message['documents'], list) or \
+                       not is_valid_pipeline(message.get('pipeline')):
+                        self.reply({'answer': 'syntax error'})
+                        continue
+                    attributes = {key: message[key] for key in
+                                  job_attributes if key in message}
+                    pipeline_ids = self.add_pipelines(message['pipeline'],
+                                                      message['documents'],
+                                                      attributes,
+                                                      message.get('fused',
+                                                                  False))
+                    reply = {'answer': 'pipelines accepted',
+                             'pipeline ids': pipeline_ids}
+                    if len(pipeline_ids) < len(message['documents']):
+                        reply.update({'answer': 'queue full',
+                                      'retry after': self.retry_after})
+                    self.reply(reply)
+                    if pipeline_ids:
+                        self.announce_new_jobs()
                 elif command == 'get job':
-                    if self.job_queue.empty():
+                    jobs = self.get_jobs(1, broker=message.get('broker', None))
+                    if not jobs:
                         self.reply({'worker': None})
                     else:
-                        job = self.job_queue.get()
-                        self.reply(job)
+                        self.reply(jobs[0])
+                elif command == 'get jobs':
+                    if 'count' not in message:
+                        self.reply({'answer': 'syntax error'})
+                    else:
+                        jobs = self.get_jobs(message['count'],
+                                             message.get('workers', None),
+                                             message.get('broker', None))
+                        self.reply({'jobs': jobs})
+                elif command == 'get statistics':
+                    self.reply(self.get_statistics())
+                elif command == 'heartbeat':
+                    if 'broker' not in message:
+                        self.reply({'answer': 'syntax error'})
+                    else:
+                        self.reply({'answer': 'heartbeat received'})
+                elif command == 'reject job':
+                    if 'job id' not in message:
+                        self.reply({'answer': 'syntax error'})
+                    elif message['job id'] not in self.leases:
+                        self.reply({'answer': 'unknown job id'})
+                    else:
+                        job_id = message['job id']
+                        self.release_lease(job_id)
+                        self.requeue([self.pending_jobs[job_id]])
+                        self.reply({'answer': 'job requeued'})
                 elif command == 'job finished':
                     if 'job id' not in message or 'duration' not in message:
                         self.reply({'answer': 'syntax error'})
                     else:
                         job_id = message['job id']
-                        if job_id not in self.pending_job_ids:
+                        if job_id not in self.pending_jobs:
                             self.reply({'answer': 'unknown job id'})
                         else:
-                            self.pending_job_ids.remove(job_id)
+                            if message.get('cached', False):
+                                self.cached_jobs += 1
+                            self.finish_job(job_id)
                             self.reply({'answer': 'good job!'})
                             new_message = 'job finished: {} duration: {}'\
                                           .format(job_id, message['duration'])
                             self.broadcast.send(new_message)
                             self.logger.info('[Broadcast] Sent "new job"')
+                elif command == 'job failed':
+                    if 'job id' not in message:
+                        self.reply({'answer': 'syntax error'})
+                    elif message['job id'] not in self.leases:
+                        self.reply({'answer': 'unknown job id'})
+                    else:
+                        job_id = message['job id']
+                        if self.fail_job(job_id, message.get('error', None),
+                                         message.get('resource usage', None)):
+                            self.reply({'answer': 'job will be retried'})
+                        else:
+                            self.reply({'answer': 'job dead'})
+                elif command == 'get dead jobs':
+                    self.reply({'jobs': self.dead_jobs})
                 else:
                     self.reply({'answer': 'unknown command'})
         except KeyboardInterrupt:
             self.close_sockets()
+            if self.journal is not None:
+                self.journal.close()
 
 def main():
     from logging import Logger, StreamHandler, Formatter
-    from sys import stdout
+    from sys import stdout, argv
 
 
     logger = Logger('Manager')
@@ -104,13 +608,12 @@ def main():
     logger.addHandler(handler)
     api_host_port = ('*', 5555)
     broadcast_host_port = ('*', 5556)
-    config = {'db': {'host': 'localhost', 'port': 27017,
-                     'database': 'pypln',
-                     'collection': 'documents',
-                     'gridfs collection': 'files',
-                     'monitoring collection': 'monitoring'},
-              'monitoring interval': 60,}
-    manager = Manager(config, logger)
+    # the other keys come from `pypln.utils.config.default_config`
+    config = {'admission control': {'max pending per owner': 100000}}
+    journal_filename = None
+    if len(argv) > 1:
+        journal_filename = argv[1]
+    manager = Manager(config, logger, journal_filename=journal_filename)
     manager.bind(api_host_port, broadcast_host_port)
     manager.run()
 
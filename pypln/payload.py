@@ -0,0 +1,135 @@
+# coding: utf-8
+
+"""Hand-off of big payloads between broker and worker processes
+
+Instead of pickling big values through a `multiprocessing.Pipe`, they are
+written to a temporary file (on `/dev/shm` when available, so it lives in
+shared memory) and only a `SharedPayload` handle is sent through the pipe.
+Strings are written as they are and lists and dicts (like tokens) are
+encoded as BSON, which is faster to encode and decode than pickle.
+
+This is not a zero-copy hand-off: the value is copied once into the file
+and the other side reads it into a new string (workers need `str` and
+`unicode` values, not buffers). What is saved is pickling and sending the
+value through the pipe in small pieces. For inputs of document workers the
+file is a second copy of data the broker already has in memory; inputs read
+from GridFS are copied to the file chunk by chunk instead.
+"""
+
+import os
+from tempfile import mkstemp, gettempdir
+
+
+shared_memory_directory = '/dev/shm'
+chunk_size = 256 * 1024
+
+def payload_directory():
+    if os.path.isdir(shared_memory_directory) and \
+       os.access(shared_memory_directory, os.W_OK):
+        return shared_memory_directory
+    return gettempdir()
+
+class SharedPayload(object):
+    '''Handle to a payload stored in a (shared memory) temporary file'''
+    def __init__(self, filename, length, encoding=None):
+        self.filename = filename
+        self.length = length
+        self.encoding = encoding
+
+    def __repr__(self):
+        return '<SharedPayload(filename={}, length={})>'.format(self.filename,
+                                                                self.length)
+
+    @classmethod
+    def from_file(cls, file_obj):
+        '''Copy a file-like object (like a GridFS file) chunk by chunk'''
+        fd, filename = mkstemp(prefix='pypln-', dir=payload_directory())
+        length = 0
+        with os.fdopen(fd, 'wb') as fp:
+            while True:
+                data = file_obj.read(chunk_size)
+                if not data:
+                    break
+                fp.write(data)
+                length += len(data)
+        return cls(filename, length)
+
+    @classmethod
+    def from_value(cls, value):
+        '''Encode a list or dict as BSON, return None if it can't be'''
+        # imported here so workers (that import this module) start faster
+        from bson import BSON
+        try:
+            data = BSON.encode({'value': value})
+        except Exception:
+            return None
+        fd, filename = mkstemp(prefix='pypln-', dir=payload_directory())
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        return cls(filename, len(data), 'bson')
+
+    @classmethod
+    def from_string(cls, data):
+        encoding = None
+        if isinstance(data, unicode):
+            encoding = 'utf-8'
+            data = data.encode(encoding)
+        fd, filename = mkstemp(prefix='pypln-', dir=payload_directory())
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(data)
+        return cls(filename, len(data), encoding)
+
+    def read(self):
+        if not self.length:
+            data = ''
+        else:
+            # a copy of the file: mapping it would copy it as well, when
+            # the map is turned into a string
+            with open(self.filename, 'rb') as fp:
+                data = fp.read()
+        if self.encoding == 'bson':
+            from bson import BSON
+            return BSON(data).decode()['value']
+        elif self.encoding is not None:
+            return data.decode(self.encoding)
+        return data
+
+    def remove(self):
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
+
+def load_payloads(data):
+    '''Replace `SharedPayload`s in dict `data` by their contents
+
+    The payload files are removed after they are read.
+    '''
+    for key, value in data.items():
+        if isinstance(value, SharedPayload):
+            data[key] = value.read()
+            value.remove()
+    return data
+
+def share_big_values(data, threshold):
+    '''Replace values bigger than `threshold` in dict `data` by payloads
+
+    Lists and dicts with more than `threshold` / 16 items are encoded, and
+    shared if encoded they are bigger than `threshold` bytes (or can't be
+    encoded as BSON, like dicts with non-string keys).
+    '''
+    if threshold is None:
+        return data
+    for key, value in data.items():
+        if isinstance(value, basestring) and len(value) > threshold:
+            data[key] = SharedPayload.from_string(value)
+        elif isinstance(value, (list, tuple, dict)) and \
+             len(value) > threshold / 16:
+            payload = SharedPayload.from_value(value)
+            if payload is None:
+                continue
+            if payload.length > threshold:
+                data[key] = payload
+            else:
+                payload.remove()
+    return data
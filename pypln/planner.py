@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Recompute only the results that are stale
+
+The broker stamps each result it stores with the version of the worker that
+computed it and a fingerprint of the worker's input, and stores a
+fingerprint of each field it writes::
+
+    {'tokens': [...],
+     '_fingerprints': {'tokens': '<MD5 of tokens>', ...},
+     '_versions': {'tokenizer': {'version': '1 nltk-2.0.4',
+                                 'input': '<fingerprint of text>'}, ...}}
+
+Worker versions come from `__meta__` (see `pypln.workers.Worker`), so
+upgrading NLTK or bumping the 'version' of a worker makes its results stale.
+The planner reads only these stamps and, for each document, finds the parts
+of a pipeline that must run again: a worker that never ran on the document,
+whose version changed or whose input changed, along with the workers after
+it. The workers after it that get the same input as before are served by
+the broker's result cache, so an upgrade recomputes only what changed.
+
+Results stored in chunks (see `pypln.stores.chunks`) have a different
+fingerprint each time they are computed, so the workers after a chunked
+worker always run again when it runs.
+
+Fused jobs store only the results of their last workers, but all their
+workers are stamped. If a worker must run again and its input was not
+stored (an intermediate result of a fused job), the worker before it runs
+again too.
+"""
+
+import json
+from hashlib import md5
+from pypln import workers
+from pypln.client import Worker, Pipeline
+from pypln.utils import pipeline_workers
+
+
+def input_fingerprint(fingerprints, fields):
+    '''Return the fingerprint of an input made of `fields`
+
+    `fingerprints` maps field names to the fingerprints of their values.
+    '''
+    pairs = [[field, fingerprints.get(field)] for field in sorted(fields)]
+    return md5(json.dumps(pairs)).hexdigest()
+
+def get_stamp(worker, fingerprints, contents_md5=None):
+    '''Return the stamp of a result of `worker`, as stored in '_versions'
+
+    Workers that read GridFS files have the file's MD5 (`contents_md5`) as
+    input fingerprint.
+    '''
+    info = workers.available[worker]
+    if info['from'] == 'gridfs-file':
+        fingerprint = contents_md5
+    else:
+        fingerprint = input_fingerprint(fingerprints, info['requires'])
+    return {'version': info['version'], 'input': fingerprint}
+
+def has_input(worker, fingerprints):
+    '''Return True if the input of `worker` is stored in the document'''
+    info = workers.available[worker]
+    return info['from'] != 'document' or \
+           all(field in fingerprints for field in info['requires'])
+
+def stale_pipelines(pipeline, document, contents_md5=None):
+    '''Return the parts of `pipeline` that must run again on `document`
+
+    `document` has the '_versions' and '_fingerprints' stored by the broker.
+    '''
+    worker = pipeline['worker']
+    fingerprints = document.get('_fingerprints', {})
+    stamp = document.get('_versions', {}).get(worker)
+    if stamp != get_stamp(worker, fingerprints, contents_md5):
+        return [pipeline]
+    stale = []
+    for child in pipeline.get('after', []):
+        child_stale = stale_pipelines(child, document, contents_md5)
+        if any(not has_input(part['worker'], fingerprints)
+               for part in child_stale):
+            # the input of a stale worker was computed by a fused job and
+            # not stored
+            return [pipeline]
+        stale.extend(child_stale)
+    return stale
+
+def plan(pipeline, documents, contents_md5s=None):
+    '''Return a list of ``(pipeline, document_ids)`` to run again
+
+    Documents are grouped by the parts of `pipeline` that are stale for
+    them. `contents_md5s` maps document ids to the MD5 of the files they
+    were extracted from (documents have the ids of their files).
+    '''
+    if contents_md5s is None:
+        contents_md5s = {}
+    groups = {}
+    order = []
+    for document in documents:
+        contents_md5 = contents_md5s.get(document['_id'])
+        for stale in stale_pipelines(pipeline, document, contents_md5):
+            key = json.dumps(stale, sort_keys=True)
+            if key not in groups:
+                groups[key] = (stale, [])
+                order.append(key)
+            groups[key][1].append(document['_id'])
+    return [groups[key] for key in order]
+
+def find_stale(pipeline, collection, files_collection=None, query=None,
+               batch_size=1000):
+    '''Plan what to run again for the documents in `collection`
+
+    Only the stamps of the documents (that match `query`) are read, not
+    their results. `files_collection` is the 'files' collection of GridFS,
+    needed if a worker of the pipeline reads files.
+    '''
+    documents = list(collection.find(query or {},
+                                     fields=['_versions', '_fingerprints'])\
+                               .batch_size(batch_size))
+    contents_md5s = {}
+    if any(workers.available[worker]['from'] == 'gridfs-file'
+           for worker in pipeline_workers(pipeline)):
+        for start in range(0, len(documents), batch_size):
+            document_ids = [document['_id'] for document in
+                            documents[start:start + batch_size]]
+            files = files_collection.find({'_id': {'$in': document_ids}},
+                                          fields=['md5'])
+            for file_data in files:
+                contents_md5s[file_data['_id']] = file_data['md5']
+    return plan(pipeline, documents, contents_md5s)
+
+def to_worker(pipeline):
+    '''Return a `pypln.client.Worker` from a pipeline dict'''
+    return Worker(pipeline['worker'])\
+           .then(*[to_worker(child) for child in pipeline.get('after', [])])
+
+def main():
+    from logging import Logger, StreamHandler, Formatter
+    from sys import stdout
+    from pypln.stores import connect
+
+
+    api_host_port = ('localhost', 5555)
+    broadcast_host_port = ('localhost', 5556)
+    #TODO: should get config from manager
+    db_config = {'host': 'localhost', 'port': 27017,
+                 'database': 'pypln',
+                 'collection': 'documents',
+                 'gridfs collection': 'files'}
+    mongo_connection, db = connect(db_config)
+
+    logger = Logger('Planner')
+    handler = StreamHandler(stdout)
+    formatter = Formatter('%(asctime)s - %(name)s - %(levelname)s - '
+                          '%(message)s')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+
+    W, W.__call__ = Worker, Worker.then
+    pipeline = W('extractor')(W('tokenizer')(W('pos'),
+                                             W('freqdist'))).to_dict()
+    groups = find_stale(pipeline, db[db_config['collection']],
+                        db['{}.files'.format(db_config['gridfs collection'])])
+    if not groups:
+        logger.info('Nothing to recompute')
+    for stale, document_ids in groups:
+        logger.info('Running {} again for {} documents'\
+                    .format(', '.join(pipeline_workers(stale)),
+                            len(document_ids)))
+        Pipeline(to_worker(stale), api_host_port, broadcast_host_port,
+                 logger).run([str(document_id)
+                              for document_id in document_ids])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+# coding: utf-8
+
+from multiprocessing import Process, Pipe
+from os import kill, killpg, setsid
+from signal import SIGKILL
+from pypln import workers
+from pypln.utils import get_resident_memory
+
+
+def run_in_new_session(child_connection, payload_threshold=None):
+    '''Run jobs in a new session, whose process group has the process' id
+
+    Programs started by workers (like `pdftotext` or the ones of external
+    workers) are in the same group, so they are killed with the process.
+    '''
+    setsid()
+    workers.persistent_wrapper(child_connection, payload_threshold)
+
+class WorkerProcess(object):
+    '''A long-lived process that runs jobs sent through a persistent Pipe'''
+    def __init__(self, payload_threshold=None):
+        self.parent_connection, self.child_connection = Pipe()
+        self.process = Process(target=run_in_new_session,
+                               args=(self.child_connection, payload_threshold))
+        self.process.start()
+        # only the child uses this end, so we get EOF if the child dies
+        self.child_connection.close()
+        self.pid = self.process.pid
+        self.jobs_done = 0
+
+    def __repr__(self):
+        return '<WorkerProcess(pid={}, jobs_done={})>'.format(self.pid,
+                                                              self.jobs_done)
+
+    def send(self, message):
+        self.parent_connection.send(message)
+
+    def recv(self):
+        return self.parent_connection.recv()
+
+    def poll(self):
+        return self.parent_connection.poll()
+
+    def fileno(self):
+        return self.parent_connection.fileno()
+
+    def stop(self, timeout=1):
+        try:
+            self.send(None)
+        except IOError:
+            pass # process is already dead
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.kill()
+            self.process.join()
+        self.parent_connection.close()
+
+    def kill(self):
+        '''Kill the process and the programs it started'''
+        try:
+            killpg(self.pid, SIGKILL)
+        except OSError:
+            # the process didn't create its group yet (or is dead)
+            try:
+                kill(self.pid, SIGKILL)
+            except OSError:
+                pass
+
+class WorkerPool(object):
+    '''Pool of `size` preforked processes that run jobs of any worker
+
+    A process is recycled (stopped and replaced by a new one) after it runs
+    `max_jobs_per_process` jobs or when its resident memory is greater than
+    `max_memory` bytes, so leaks in workers (or in the libraries they use)
+    do not accumulate forever. Results bigger than `payload_threshold` bytes
+    are handed back through shared memory (see `pypln.payload`).
+    '''
+    def __init__(self, size, max_jobs_per_process=None, max_memory=None,
+                 payload_threshold=None):
+        self.size = size
+        self.max_jobs_per_process = max_jobs_per_process
+        self.max_memory = max_memory
+        self.payload_threshold = payload_threshold
+        self.idle = [self.new_process() for i in range(size)]
+        self.busy = set()
+        self.recycled = 0
+
+    def new_process(self):
+        return WorkerProcess(self.payload_threshold)
+
+    def __len__(self):
+        return len(self.idle) + len(self.busy)
+
+    def acquire(self):
+        if self.idle:
+            process = self.idle.pop()
+        else:
+            process = self.new_process()
+        self.busy.add(process)
+        return process
+
+    def should_recycle(self, process):
+        if self.max_jobs_per_process is not None and \
+           process.jobs_done >= self.max_jobs_per_process:
+            return True
+        if self.max_memory is not None:
+            memory = get_resident_memory(process.pid)
+            return memory is None or memory > self.max_memory
+        return False
+
+    def release(self, process):
+        '''Give back a process that finished its job'''
+        self.busy.discard(process)
+        process.jobs_done += 1
+        if self.should_recycle(process):
+            process.stop()
+            self.recycled += 1
+            process = self.new_process()
+        if len(self) < self.size:
+            self.idle.append(process)
+        else:
+            process.stop()
+
+    def discard(self, process):
+        '''Kill a process that can't be reused and replace it by a new one'''
+        self.busy.discard(process)
+        process.kill()
+        process.stop()
+        if len(self) < self.size:
+            self.idle.append(self.new_process())
+
+    def resize(self, size):
+        '''Change the number of processes kept in the pool'''
+        self.size = size
+        while self.idle and len(self) > self.size:
+            self.idle.pop().stop()
+
+    def pids(self):
+        return [process.pid for process in self.idle + list(self.busy)]
+
+    def close(self):
+        for process in self.idle + list(self.busy):
+            process.stop()
+        self.idle = []
+        self.busy = set()
+
+    def kill(self):
+        for process in self.idle + list(self.busy):
+            process.kill()
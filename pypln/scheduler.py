@@ -0,0 +1,90 @@
+# coding: utf-8
+
+from collections import deque
+
+
+class PriorityLevel(object):
+    def __init__(self):
+        self.flows = {}
+        self.credits = {}
+        self.active = deque()
+
+class FairQueue(object):
+    '''Queue of jobs with priority levels and weighted fair share
+
+    Jobs with higher `priority` are always served first, so bulk jobs only
+    use the capacity that interactive jobs leave idle. Inside a priority
+    level each flow (the jobs of one `corpus` of one `owner`) has its own
+    FIFO and flows are served in weighted (deficit) round-robin, so a huge
+    corpus does not starve everyone else. Per round, a flow can have
+    `weights['owner/corpus']` jobs dispatched or, if there's no weight for
+    the corpus, `weights['owner']` (1 by default).
+
+    Entries are ``(sequence, job)`` tuples.
+    '''
+    def __init__(self, weights=None):
+        self.weights = weights or {}
+        self.levels = {}
+
+    def get_weight(self, flow):
+        owner, corpus = flow
+        return self.weights.get('{}/{}'.format(owner, corpus),
+                                self.weights.get(owner, 1))
+
+    def __len__(self):
+        return sum(len(queue) for level in self.levels.itervalues()
+                              for queue in level.flows.itervalues())
+
+    def push(self, sequence, job, front=False):
+        '''Add a job in the end (or in the front) of its flow'''
+        priority = job.get('priority', 0)
+        flow = (job.get('owner', ''), job.get('corpus', ''))
+        if priority not in self.levels:
+            self.levels[priority] = PriorityLevel()
+        level = self.levels[priority]
+        if flow not in level.flows:
+            level.flows[flow] = deque()
+            level.credits[flow] = self.get_weight(flow)
+            if front:
+                level.active.appendleft(flow)
+            else:
+                level.active.append(flow)
+        if front:
+            level.flows[flow].appendleft((sequence, job))
+        else:
+            level.flows[flow].append((sequence, job))
+
+    def peek(self, is_pending=None):
+        '''Return ``(priority, (sequence, job))`` of next job (or None)
+
+        Jobs for which `is_pending(job id)` is false are discarded.
+        '''
+        for priority in sorted(self.levels.keys(), reverse=True):
+            level = self.levels[priority]
+            while level.active:
+                flow = level.active[0]
+                queue = level.flows[flow]
+                while queue and is_pending is not None and \
+                      not is_pending(queue[0][1]['job id']):
+                    queue.popleft()
+                if not queue:
+                    level.active.popleft()
+                    del level.flows[flow]
+                    del level.credits[flow]
+                elif level.credits[flow] <= 0:
+                    level.credits[flow] += self.get_weight(flow)
+                    level.active.rotate(-1)
+                else:
+                    return priority, queue[0]
+            del self.levels[priority]
+        return None
+
+    def pop(self, is_pending=None):
+        '''Remove and return next ``(sequence, job)`` (or None)'''
+        next_entry = self.peek(is_pending)
+        if next_entry is None:
+            return None
+        level = self.levels[next_entry[0]]
+        flow = level.active[0]
+        level.credits[flow] -= 1
+        return level.flows[flow].popleft()
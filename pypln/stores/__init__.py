@@ -1 +1,18 @@
 """ Abstraction layer to store data """
+
+
+def connect(config):
+    '''Connect to MongoDB, return the connection and the database
+
+    `config` is the 'db' section of the configuration; the database is
+    authenticated if it has 'username' and 'password'. pymongo is imported
+    here so modules that only refer to stored values stay cheap to import.
+    '''
+    from pymongo import Connection
+
+
+    connection = Connection(config['host'], config['port'])
+    db = connection[config['database']]
+    if config.get('username') and config.get('password'):
+        db.authenticate(config['username'], config['password'])
+    return connection, db
@@ -0,0 +1,78 @@
+# coding: utf-8
+
+"""In-memory cache of document fields, shared by the jobs of a broker"""
+
+from collections import OrderedDict
+from bson import BSON
+from bson.errors import InvalidDocument
+
+
+def value_size(value):
+    '''Return the size of `value` in bytes, as stored by MongoDB'''
+    return len(BSON.encode({'value': value}))
+
+class FieldCache(object):
+    '''Least recently used cache of document fields, limited by size
+
+    Entries are keyed by ``(document id, field)`` and their size is the size
+    of the BSON-encoded value. When the total size goes above `max_size`
+    bytes, the least recently used entries are evicted. Values bigger than
+    `max_size` are not cached.
+    '''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, document_id, field, value):
+        key = (document_id, field)
+        self.remove(key)
+        try:
+            size = value_size(value)
+        except InvalidDocument:
+            return
+        if size > self.max_size:
+            return
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_size:
+            old_key, (old_value, old_size) = self.entries.popitem(last=False)
+            self.size -= old_size
+            self.evictions += 1
+
+    def remove(self, key):
+        if key in self.entries:
+            value, size = self.entries.pop(key)
+            self.size -= size
+
+    def invalidate(self, document_id, fields):
+        '''Remove `fields` of a document, which changed in the database'''
+        for field in fields:
+            self.remove((document_id, field))
+        self.invalidations += 1
+
+    def get_fields(self, document_id, fields):
+        '''Return a dict with `fields` of a document, or None on a miss
+
+        It's a hit only if all the fields are cached.
+        '''
+        data = {}
+        for field in fields:
+            key = (document_id, field)
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            data[field] = self.entries[key][0]
+        for field in fields:
+            # move to the end: most recently used
+            key = (document_id, field)
+            self.entries[key] = self.entries.pop(key)
+        self.hits += 1
+        return data
@@ -0,0 +1,83 @@
+# coding: utf-8
+
+"""Chunked workers: process big documents piece by piece
+
+A worker with `'chunked': True` in its `__meta__` has a generator as `main`.
+Each field it requires is given as an iterator of chunks (pieces of a
+string, split between words, or slices of a list) and it yields dicts with
+partial results, that are stored as soon as they arrive. For example::
+
+    __meta__ = {'from': 'document', 'requires': ['text'],
+                'to': 'document', 'provides': ['tokens'],
+                'chunked': True, 'chunk size': 65536}
+
+    def main(document):
+        for text in document['text']:
+            yield {'tokens': text.split()}
+
+Fields stored in chunks are read by the worker's process, one chunk at a
+time, so the memory used by a job depends on the chunk size and not on the
+size of the document. Workers that are not chunked receive the whole value,
+as always.
+"""
+
+from pypln.stores import connect
+from pypln.stores.spill import iter_reference
+
+
+def split_value(value, size):
+    '''Yield chunks of `value` with about `size` characters (or items)
+
+    Strings are not split in the middle of a word (unless a word is bigger
+    than `size`). Values that are not strings or lists are not split.
+    '''
+    if isinstance(value, basestring):
+        start = 0
+        while start < len(value):
+            end = start + size
+            if end < len(value):
+                space = max(value.rfind(' ', start, end),
+                            value.rfind('\n', start, end))
+                if space >= start:
+                    end = space + 1
+            yield value[start:end]
+            start = end
+    elif isinstance(value, (list, tuple)):
+        for start in range(0, len(value), size):
+            yield value[start:start + size]
+    else:
+        yield value
+
+def iter_chunks(value, size):
+    '''Return an iterator over chunks of `value` (maybe a `ChunkReader`)'''
+    if isinstance(value, ChunkReader):
+        return (piece for chunk in value for piece in split_value(chunk, size))
+    return split_value(value, size)
+
+class ChunkReader(object):
+    '''A value stored in GridFS, read chunk by chunk where it's used
+
+    `config` is the 'db' section of the configuration and `reference` the
+    value stored in the document (see `pypln.stores.spill`). Only these are
+    sent to the worker's process, which opens its own connection.
+    '''
+    def __init__(self, config, reference):
+        self.config = config
+        self.reference = reference
+
+    def __repr__(self):
+        return '<ChunkReader(reference={})>'.format(self.reference)
+
+    def __iter__(self):
+        # imported here: pypln.workers imports this module in every worker
+        # process, most of which never read chunks
+        from gridfs import GridFS
+
+
+        connection, db = connect(self.config)
+        try:
+            gridfs = GridFS(db, self.config['gridfs collection'])
+            for chunk in iter_reference(self.reference, gridfs):
+                yield chunk
+        finally:
+            connection.close()
@@ -0,0 +1,125 @@
+# coding: utf-8
+
+"""Lazy access to all the documents of a corpus, for corpus workers
+
+Workers with `'from': 'corpus'` receive a `CorpusCursor` instead of the
+documents. It is sent to the worker's process, that opens its own connection
+to MongoDB, and reads the documents in batches (with only the fields the
+worker requires), so memory use does not depend on the size of the corpus.
+
+Long scans can be resumed: the worker calls `checkpoint(state)` from time to
+time and, if the job is run again (after a crash or a timeout, for example),
+the cursor starts after the last checkpointed document and `state` has what
+the worker saved::
+
+    def main(document):
+        corpus = document['corpus']
+        total = corpus.state or 0
+        for index, item in enumerate(corpus):
+            total += len(item['tokens'])
+            if index % 1000 == 0:
+                corpus.checkpoint(total)
+        return {'tokens': total}
+
+The result of the job is stored in the corpus (`'to': 'corpus'`). States
+bigger than `max_state_size` bytes are stored in GridFS, like big results
+(see `pypln.stores.spill`).
+"""
+
+from pymongo import ASCENDING
+from gridfs import GridFS
+from pypln.stores import connect
+from pypln.stores.spill import (LazyDocument, spill_big_values,
+                                referenced_files, delete_stale_files)
+
+
+class CorpusCursor(object):
+    '''Iterate over the documents of a corpus, resuming from a checkpoint
+
+    `config` is the 'db' section of the configuration. Documents belong to
+    a corpus if its id is in their 'corpora' field. Checkpoints are saved in
+    the checkpoint collection, with `checkpoint_id` as id (the broker uses
+    the job id, that does not change when the job is retried).
+    '''
+    def __init__(self, config, corpus_id, fields, checkpoint_id,
+                 batch_size=100, max_state_size=4 * 1024 * 1024):
+        self.config = config
+        self.corpus_id = corpus_id
+        self.fields = fields
+        self.checkpoint_id = checkpoint_id
+        self.batch_size = batch_size
+        self.max_state_size = max_state_size
+        self.last_id = None
+        self._state = None
+        self._connection = None
+
+    def __repr__(self):
+        return '<CorpusCursor(corpus_id={}, last_id={})>'\
+               .format(self.corpus_id, self.last_id)
+
+    def __getstate__(self):
+        # connections are not sent to other processes
+        return {key: value for key, value in self.__dict__.iteritems()
+                if not key.startswith('_') or key == '_state'}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._connection = None
+
+    def connect(self):
+        if self._connection is not None:
+            return
+        conf = self.config
+        self._connection, self._db = connect(conf)
+        self._collection = self._db[conf['collection']]
+        self._checkpoints = self._db[conf['checkpoint collection']]
+        self._gridfs = GridFS(self._db, conf['gridfs collection'])
+        self._files = self._db[conf['gridfs collection']].files
+        checkpoint = self._checkpoints.find_one({'_id': self.checkpoint_id})
+        if checkpoint is not None:
+            self.last_id = checkpoint['last id']
+            self._state = LazyDocument(checkpoint, self._gridfs)['state']
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    @property
+    def state(self):
+        '''What the worker saved in its last checkpoint (or None)'''
+        self.connect()
+        return self._state
+
+    def __iter__(self):
+        self.connect()
+        query = {'corpora': self.corpus_id}
+        if self.last_id is not None:
+            query['_id'] = {'$gt': self.last_id}
+        # documents are read in `_id` order, so a checkpoint only needs the
+        # id of the last document
+        cursor = self._collection.find(query, fields=self.fields)\
+                                 .sort('_id', ASCENDING)\
+                                 .batch_size(self.batch_size)
+        for document in cursor:
+            self.last_id = document['_id']
+            yield LazyDocument(document, self._gridfs).resolve(self.fields)
+
+    def checkpoint(self, state=None):
+        '''Save the position of the cursor and the worker's `state`'''
+        self.connect()
+        self._state = state
+        # states of workers like corpus_freqdist may not fit in a document
+        stored = spill_big_values({'state': state}, self._gridfs,
+                                  self.max_state_size,
+                                  document_id=self.checkpoint_id)['state']
+        self._checkpoints.update({'_id': self.checkpoint_id},
+                                 {'_id': self.checkpoint_id,
+                                  'corpus': self.corpus_id,
+                                  'last id': self.last_id, 'state': stored},
+                                 upsert=True, w=1)
+        # the files of the previous state are deleted only when the new one
+        # is saved
+        delete_stale_files(self._gridfs, self._files,
+                           [(self.checkpoint_id, 'state')],
+                           set(referenced_files(stored)))
@@ -0,0 +1,204 @@
+# coding: utf-8
+
+"""Append-only journal used by the Manager to survive restarts"""
+
+import json
+import os
+from collections import OrderedDict
+from time import time
+
+
+class JobJournal(object):
+    '''Durable log of the Manager's job queue
+
+    Every change in the job queue is appended as a JSON line to `filename`.
+    Lines are written to the OS as soon as they are appended (so a crash of
+    the manager process does not lose them) but `fsync` is done in groups:
+    only after `sync_every` records or `sync_interval` seconds. Manager
+    answers requests before they are synced, so a power loss (or an OS
+    crash) can lose the records of the last `sync_interval` seconds; use
+    ``sync_every=1`` if that is not acceptable.
+
+    A snapshot of the current state is written to `filename + '.snapshot'`
+    and the journal is truncated after `compact_every` records, or after as
+    many records as there are jobs times `compact_ratio`, if it's bigger:
+    writing the snapshot takes time proportional to the number of jobs, so
+    big queues are compacted less often.
+    '''
+    def __init__(self, filename, sync_every=100, sync_interval=0.5,
+                 compact_every=10000, compact_ratio=2):
+        self.filename = filename
+        self.snapshot_filename = filename + '.snapshot'
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_every = compact_every
+        self.compact_ratio = compact_ratio
+        self.queued = OrderedDict()
+        self.in_flight = OrderedDict()
+        self.dead = OrderedDict()
+        self.sequence = 0
+        self.records_since_snapshot = 0
+        self.unsynced_records = 0
+        self.last_sync = time()
+        self._fp = None
+
+    def recover(self):
+        '''Load snapshot and replay journal, return jobs to be enqueued
+
+        Jobs that were handed to a broker but not finished are put back on
+        the queue, before the jobs that were never started.
+        '''
+        snapshot_sequence = 0
+        if os.path.exists(self.snapshot_filename):
+            with open(self.snapshot_filename) as fp:
+                snapshot = json.load(fp)
+            snapshot_sequence = snapshot['sequence']
+            for job in snapshot['in flight']:
+                self.in_flight[job['job id']] = job
+            for job in snapshot['queued']:
+                self.queued[job['job id']] = job
+            for dead_job in snapshot.get('dead', []):
+                self.dead[dead_job['job']['job id']] = dead_job
+        self.sequence = snapshot_sequence
+        if os.path.exists(self.filename):
+            with open(self.filename) as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break # torn write at the end of the journal
+                    if record['sequence'] <= snapshot_sequence:
+                        continue
+                    self._apply(record)
+                    self.sequence = record['sequence']
+        requeued = OrderedDict(self.in_flight)
+        requeued.update(self.queued)
+        self.queued = requeued
+        self.in_flight = OrderedDict()
+        self._fp = open(self.filename, 'a')
+        self.compact()
+        return self.queued.values()
+
+    def _apply(self, record):
+        operation = record['operation']
+        if operation == 'add':
+            job = record['job']
+            self.queued[job['job id']] = job
+        elif operation == 'add jobs':
+            for job in record['jobs']:
+                self.queued[job['job id']] = job
+        elif operation == 'get':
+            job = self.queued.pop(record['job id'], None)
+            if job is not None:
+                self.in_flight[record['job id']] = job
+        elif operation == 'requeue':
+            job = self.in_flight.pop(record['job id'], None)
+            if job is not None:
+                self.queued[record['job id']] = job
+        elif operation == 'finish':
+            self.in_flight.pop(record['job id'], None)
+            self.queued.pop(record['job id'], None)
+        elif operation == 'fail':
+            job = self.in_flight.get(record['job id'],
+                                     self.queued.get(record['job id'], None))
+            if job is not None:
+                job['attempts'] = record['attempts']
+        elif operation == 'dead':
+            self.in_flight.pop(record['job id'], None)
+            self.queued.pop(record['job id'], None)
+            self.dead[record['job id']] = record['dead job']
+
+    def append(self, record):
+        self.sequence += 1
+        record['sequence'] = self.sequence
+        self._apply(record)
+        self._fp.write(json.dumps(record) + '\n')
+        self._fp.flush()
+        self.unsynced_records += 1
+        self.records_since_snapshot += 1
+        if self.unsynced_records >= self.sync_every:
+            self.sync()
+        if self.should_compact():
+            self.compact()
+
+    def add_job(self, job):
+        self.append({'operation': 'add', 'job': job})
+
+    def add_jobs(self, jobs):
+        self.append({'operation': 'add jobs', 'jobs': jobs})
+
+    def get_job(self, job_id):
+        self.append({'operation': 'get', 'job id': job_id})
+
+    def requeue_job(self, job_id):
+        self.append({'operation': 'requeue', 'job id': job_id})
+
+    def finish_job(self, job_id):
+        self.append({'operation': 'finish', 'job id': job_id})
+
+    def fail_job(self, job_id, attempts):
+        self.append({'operation': 'fail', 'job id': job_id,
+                     'attempts': attempts})
+
+    def kill_job(self, job_id, dead_job):
+        self.append({'operation': 'dead', 'job id': job_id,
+                     'dead job': dead_job})
+
+    def sync(self):
+        '''Commit all appended records to disk'''
+        if self.unsynced_records:
+            os.fsync(self._fp.fileno())
+            self.unsynced_records = 0
+        self.last_sync = time()
+
+    def sync_if_needed(self):
+        if self.unsynced_records and \
+           time() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def time_to_next_sync(self):
+        '''Return how many seconds until next group commit (or None)'''
+        if not self.unsynced_records:
+            return None
+        return max(0, self.sync_interval - (time() - self.last_sync))
+
+    def should_compact(self):
+        jobs = len(self.queued) + len(self.in_flight) + len(self.dead)
+        return self.records_since_snapshot >= \
+               max(self.compact_every, jobs * self.compact_ratio)
+
+    def sync_directory(self):
+        '''Commit renames and new files in the journal's directory'''
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def compact(self):
+        '''Write a snapshot of the current state and truncate the journal'''
+        snapshot = {'sequence': self.sequence,
+                    'queued': self.queued.values(),
+                    'in flight': self.in_flight.values(),
+                    'dead': self.dead.values()}
+        temp_filename = self.snapshot_filename + '.tmp'
+        with open(temp_filename, 'w') as fp:
+            json.dump(snapshot, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(temp_filename, self.snapshot_filename)
+        # the snapshot must be on disk before the journal is truncated
+        self.sync_directory()
+        self._fp.close()
+        self._fp = open(self.filename, 'w')
+        os.fsync(self._fp.fileno())
+        self.records_since_snapshot = 0
+        self.unsynced_records = 0
+        self.last_sync = time()
+
+    def close(self):
+        if self._fp is not None:
+            self.sync()
+            self._fp.close()
+            self._fp = None
@@ -4,6 +4,7 @@ from datetime import datetime
 from pymongo import Connection
 from gridfs import GridFS
 from pypln.utils import slug
+from pypln.stores.spill import LazyDocument
 
 
 def now():
@@ -129,6 +130,18 @@ class Document(Object):
         fp = self._store._gridfs.get_last_version(filename=self._id)
         return fp.read()
 
+    def get_result(self, name):
+        '''Return a worker's result for this document (or None)
+
+        Results too big for MongoDB are loaded from GridFS.'''
+        if self._id is None:
+            raise RuntimeError('You need to save document before getting its'
+                               ' results')
+        data = self._collection.find_one({'_id': self._id}, fields=[name])
+        if data is None:
+            return None
+        return LazyDocument(data, self._store._gridfs).get(name)
+
 class Analysis(Object):
     '''Class that represents PyPLN's document analysis'''
     fields = {'name': '',
@@ -0,0 +1,176 @@
+# coding: utf-8
+
+"""Store values too big for a MongoDB document in GridFS
+
+MongoDB documents are limited to 16MB, but a worker result for a
+book-length text (like `tokens` or `pos`) can be bigger than that. Values
+bigger than a threshold are encoded (BSON, compressed with zlib) and stored
+in GridFS; the document keeps only a reference, like::
+
+    {'_gridfs': ObjectId(...), 'encoding': 'bson+zlib', 'length': 123}
+
+References are resolved only when the field is used.
+
+Results of chunked workers (see `pypln.stores.chunks`) are stored one GridFS
+file per chunk, and the document keeps the list of files::
+
+    {'_gridfs_chunks': [ObjectId(...), ...], 'encoding': 'bson+zlib',
+     'length': 123}
+
+Files have the id of their document and the name of their field, so the
+files of a value are deleted when it is overwritten (see
+`delete_stale_files`).
+"""
+
+import zlib
+from hashlib import md5
+
+
+encoding = 'bson+zlib'
+reference_key = '_gridfs'
+chunks_key = '_gridfs_chunks'
+
+def encode(value):
+    # bson is imported where it's used, so workers (whose module imports
+    # this one) start faster
+    from bson import BSON
+    return zlib.compress(BSON.encode({'value': value}))
+
+def decode(data):
+    from bson import BSON
+    return BSON(zlib.decompress(data)).decode()['value']
+
+def is_reference(value):
+    return isinstance(value, dict) and value.get('encoding') == encoding and \
+           (reference_key in value or chunks_key in value)
+
+def join_chunks(chunks):
+    '''Join chunks of a value: strings, lists or dicts'''
+    chunks = list(chunks)
+    if not chunks:
+        return None
+    if isinstance(chunks[0], basestring):
+        return chunks[0][:0].join(chunks)
+    elif isinstance(chunks[0], dict):
+        value = {}
+        for chunk in chunks:
+            value.update(chunk)
+        return value
+    return [item for chunk in chunks for item in chunk]
+
+def put_encoded(gridfs, field, data, document_id=None):
+    '''Store compressed `data` of `field` in GridFS, return its id'''
+    if document_id is None:
+        return gridfs.put(data, field=field, encoding=encoding)
+    return gridfs.put(data, field=field, encoding=encoding,
+                      document=document_id)
+
+def put_chunk(gridfs, field, value, document_id=None):
+    '''Store a chunk of `field` in GridFS, return its id and size'''
+    data = encode(value)
+    return put_encoded(gridfs, field, data, document_id), len(data)
+
+def chunked_reference(file_ids, length):
+    return {chunks_key: file_ids, 'encoding': encoding, 'length': length}
+
+def iter_reference(reference, gridfs):
+    '''Yield the value of a reference chunk by chunk'''
+    file_ids = reference.get(chunks_key, [reference.get(reference_key)])
+    for file_id in file_ids:
+        yield decode(gridfs.get(file_id).read())
+
+def referenced_files(value):
+    '''Return the ids of the GridFS files a value refers to'''
+    if not is_reference(value):
+        return []
+    return list(value.get(chunks_key, [value.get(reference_key)]))
+
+def spill_big_values(data, gridfs, threshold, fingerprints=None,
+                     document_id=None, max_total=None):
+    '''Move values of dict `data` bigger than `threshold` bytes to GridFS
+
+    If the values that are left add up to more than `max_total` bytes the
+    biggest of them are moved too, so an update with many values just
+    below `threshold` still fits in a document. If `fingerprints` is a
+    dict, the MD5 of each value (BSON-encoded, as it is needed to know its
+    size) is stored in it.
+    '''
+    if threshold is None and fingerprints is None and max_total is None:
+        return data
+    from bson import BSON
+    encoded_values = []
+    total = 0
+    for key, value in data.items():
+        encoded = BSON.encode({'value': value})
+        if fingerprints is not None:
+            fingerprints[key] = md5(encoded).hexdigest()
+        total += len(encoded)
+        if not is_reference(value):
+            encoded_values.append((key, encoded))
+    encoded_values.sort(key=lambda item: len(item[1]), reverse=True)
+    for key, encoded in encoded_values:
+        if (threshold is None or len(encoded) <= threshold) and \
+           (max_total is None or total <= max_total):
+            break
+        compressed = zlib.compress(encoded)
+        file_id = put_encoded(gridfs, key, compressed, document_id)
+        data[key] = {reference_key: file_id, 'encoding': encoding,
+                     'length': len(compressed)}
+        total -= len(encoded) - len(BSON.encode({'value': data[key]}))
+    return data
+
+def delete_stale_files(gridfs, files_collection, written, keep):
+    '''Delete the files of values that were overwritten
+
+    `written` is a list of ``(document_id, field)`` that were written,
+    `keep` has the ids of the files the new values refer to and
+    `files_collection` is the 'files' collection of `gridfs`. Return how
+    many files were deleted.
+    '''
+    fields_by_document = {}
+    for document_id, field in written:
+        fields_by_document.setdefault(document_id, set()).add(field)
+    if not fields_by_document:
+        return 0
+    query = {'$or': [{'document': document_id, 'field': {'$in': list(fields)}}
+                     for document_id, fields in
+                     fields_by_document.iteritems()]}
+    deleted = 0
+    for file_data in files_collection.find(query, fields=['_id']):
+        if file_data['_id'] not in keep:
+            gridfs.delete(file_data['_id'])
+            deleted += 1
+    return deleted
+
+def load_reference(reference, gridfs):
+    if chunks_key in reference:
+        return join_chunks(iter_reference(reference, gridfs))
+    return decode(gridfs.get(reference[reference_key]).read())
+
+class LazyDocument(dict):
+    '''A document that loads values stored in GridFS when they are used'''
+    def __init__(self, data, gridfs):
+        dict.__init__(self, data)
+        self.gridfs = gridfs
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if is_reference(value):
+            value = load_reference(value, self.gridfs)
+            self[key] = value
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def resolve(self, keys=None):
+        '''Return a plain dict, with values of `keys` (default: all) loaded'''
+        if keys is None:
+            keys = self.keys()
+        data = dict(self)
+        for key in keys:
+            if key in self:
+                data[key] = self[key]
+        return data
@@ -1,7 +1,11 @@
 # coding: utf-8
 
 
+from pypln.utils.config import default_config, with_defaults
 from pypln.utils.monitoring import (get_outgoing_ip, get_host_info,
-                                    get_process_info)
+                                    get_process_info, get_resident_memory,
+                                    get_resource_usage, get_load_signals)
+from pypln.utils.pipeline import (pipeline_workers, pipeline_leaves,
+                                  is_valid_pipeline)
 from pypln.utils.tagset import tagset_nltk
 from pypln.utils.slug import slug
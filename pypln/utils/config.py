@@ -0,0 +1,31 @@
+# coding: utf-8
+
+from copy import deepcopy
+
+
+# used by Manager and brokers for the keys missing in Manager's configuration
+default_config = {'db': {'host': 'localhost', 'port': 27017,
+                         'database': 'pypln',
+                         'collection': 'documents',
+                         'gridfs collection': 'files',
+                         'monitoring collection': 'monitoring',
+                         'result cache collection': 'result_cache',
+                         'corpora collection': 'corpora',
+                         'checkpoint collection': 'checkpoints'},
+                  'monitoring interval': 60,
+                  'heartbeat interval': 10,
+                  'share weights': {},
+                  'admission control': {'max pending jobs': 1000000,
+                                        'max pending per worker': None,
+                                        'max pending per owner': None,
+                                        'retry after': 1.0},}
+
+def with_defaults(config, defaults=default_config):
+    '''Return a copy of `config` with the values it lacks from `defaults`'''
+    result = deepcopy(defaults)
+    for key, value in config.iteritems():
+        if isinstance(value, dict) and isinstance(result.get(key), dict):
+            result[key] = with_defaults(value, result[key])
+        else:
+            result[key] = value
+    return result
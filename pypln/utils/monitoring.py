@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import os
 import socket
 from time import time
 import psutil
@@ -77,6 +78,48 @@ def get_process_info(process_id):
             'pid': process.pid,
             'started at': process.create_time,}
 
+def get_resident_memory(process_id):
+    """Return resident memory (in bytes) of a given PID (or None)"""
+    try:
+        return psutil.Process(process_id).get_memory_info().rss
+    except psutil.error.NoSuchProcess:
+        return None
+
+def get_load_signals():
+    """Return current CPU use, load average and memory of this host
+
+    Cheaper than `get_host_info`, so it can be called frequently."""
+    memory_usage = psutil.phymem_usage()
+    cached_memory = psutil.cached_phymem()
+    buffered_memory = psutil.phymem_buffers()
+    real_used = memory_usage.used - buffered_memory - cached_memory
+    return {'cpu percent': psutil.cpu_percent(interval=None),
+            'load average': os.getloadavg()[0],
+            'total memory': memory_usage.total,
+            'available memory': memory_usage.total - real_used,}
+
+def get_resource_usage(process_id):
+    """Return CPU time (user + system) and resident memory of a given PID
+
+    The processes it started (and the ones they started) are included."""
+    try:
+        process = psutil.Process(process_id)
+        processes = [process] + process.get_children(recursive=True)
+    except psutil.error.NoSuchProcess:
+        return None
+    usage = {'cpu time': 0, 'resident memory': 0}
+    for process in processes:
+        try:
+            cpu_times = process.get_cpu_times()
+            memory_info = process.get_memory_info()
+        except psutil.error.NoSuchProcess:
+            if process.pid == process_id:
+                return None
+            continue # a child finished meanwhile
+        usage['cpu time'] += cpu_times.user + cpu_times.system
+        usage['resident memory'] += memory_info.rss
+    return usage
+
 
 if __name__ == '__main__':
     from pprint import pprint
@@ -0,0 +1,31 @@
+# coding: utf-8
+
+
+def pipeline_workers(pipeline):
+    '''Return the workers of a pipeline tree, parents before children
+
+    `pipeline` is a tree like ``{'worker': name, 'after': [pipeline, ...]}``.
+    '''
+    names = [pipeline['worker']]
+    for child in pipeline.get('after', []):
+        names.extend(pipeline_workers(child))
+    return names
+
+def pipeline_leaves(pipeline):
+    '''Return the workers of a pipeline tree that have no next workers'''
+    children = pipeline.get('after', [])
+    if not children:
+        return [pipeline['worker']]
+    return [name for child in children for name in pipeline_leaves(child)]
+
+def is_valid_pipeline(pipeline):
+    '''Return True if `pipeline` is a well-formed pipeline tree
+
+    'after' is optional; when present it must be a list of pipelines.
+    '''
+    if not isinstance(pipeline, dict) or \
+       not isinstance(pipeline.get('worker'), basestring):
+        return False
+    children = pipeline.get('after', [])
+    return isinstance(children, list) and \
+           all(is_valid_pipeline(child) for child in children)
@@ -1,40 +1,241 @@
 # coding: utf-8
 
-import sys
+import ast
+import traceback
+from time import time
+from hashlib import md5
 from os.path import dirname, basename
 from glob import glob
 from importlib import import_module
+from pypln.external import ExternalProcess
+from pypln.payload import load_payloads, share_big_values
+from pypln.stores.chunks import iter_chunks
+from pypln.stores.spill import join_chunks
 
 
-__all__ = ['available', 'wrapper']
+__all__ = ['available', 'preload', 'run_worker', 'run_pipeline',
+           'stream_worker', 'wrapper', 'persistent_wrapper']
 current_dir = dirname(__file__)
 required_objects = ['__meta__', 'main']
 required_meta = ['from', 'requires', 'to', 'provides']
+lazy_keys = ['main', 'warm_up', 'version']
+
+def read_manifest(source):
+    '''Return `__meta__` and top-level names of a worker's source code
+
+    The module is parsed, not imported, so its dependencies are not loaded.
+    `__meta__` must be a literal. Workers that run an external program
+    (see `pypln.external`) have a 'command' in `__meta__` instead of a
+    `main` function. Return `None` if the module can't be a worker.
+    '''
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return None
+    names = set()
+    meta = None
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    names.add(target.id)
+                    if target.id == '__meta__':
+                        try:
+                            meta = ast.literal_eval(node.value)
+                        except ValueError:
+                            return None
+    if not isinstance(meta, dict) or \
+       any(key not in meta for key in required_meta):
+        return None
+    if 'command' in meta:
+        names.add('main')
+    if any(name not in names for name in required_objects):
+        return None
+    return meta, names
+
+def package_version(name):
+    '''Return the installed version of Python package `name` (or None)'''
+    # imported here because pkg_resources is slow to import
+    from pkg_resources import get_distribution
+    try:
+        return get_distribution(name).version
+    except Exception:
+        return None
+
+class Worker(dict):
+    '''A worker's metadata, that imports its module only when it's used
+
+    'main' and 'warm_up' (None if the worker has no `warm_up`) are loaded
+    from the module the first time they are used. The 'main' of an external
+    worker is a `pypln.external.ExternalProcess`, so each process that runs
+    the worker keeps its own instance of the program running.
+
+    'version' is the 'version' in `__meta__` (or `version`, the MD5 of the
+    source code, if there is none) followed by the installed version of each
+    package in 'dependencies', like ``'2 nltk-2.0.4'``. Results are stamped
+    with it (see `pypln.planner`).
+    '''
+    def __init__(self, name, meta, names, version):
+        executables = list(meta.get('executables', []))
+        if 'command' in meta and meta['command'][0] not in executables:
+            executables.append(meta['command'][0])
+        dict.__init__(self, {'from': meta['from'],
+                             'requires': meta['requires'],
+                             'to': meta['to'],
+                             'provides': meta['provides'],
+                             'executables': executables,
+                             # external workers (see pypln.external)
+                             'command': meta.get('command'),
+                             'max requests': meta.get('max requests'),
+                             # chunked workers (see pypln.stores.chunks)
+                             'chunked': meta.get('chunked', False),
+                             'chunk size': meta.get('chunk size', 65536),
+                             # limits enforced by the broker (None means
+                             # broker's default)
+                             'timeout': meta.get('timeout'),
+                             'cpu timeout': meta.get('cpu timeout'),
+                             'max memory': meta.get('max memory'),
+                             'dependencies': meta.get('dependencies', [])})
+        self.name = name
+        self.base_version = str(meta.get('version', version))
+        self.has_warm_up = 'warm_up' in names
+
+    def load(self):
+        if self['command'] is not None:
+            self['main'] = ExternalProcess(self['command'], self['requires'],
+                                           self['max requests'])
+            self['warm_up'] = None
+            return
+        module = import_module('{}.{}'.format(__name__, self.name))
+        self['main'] = module.main
+        self['warm_up'] = getattr(module, 'warm_up', None)
+
+    def get_version(self):
+        versions = [self.base_version]
+        for package in self['dependencies']:
+            versions.append('{}-{}'.format(package, package_version(package)))
+        return ' '.join(versions)
+
+    def __getitem__(self, key):
+        if not dict.__contains__(self, key):
+            if key == 'version':
+                self['version'] = self.get_version()
+            elif key in ('main', 'warm_up'):
+                self.load()
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key in self or key in lazy_keys:
+            return self[key]
+        return default
 
 available = {}
-sys.path.insert(0, current_dir)
 for filename in glob('{}/*.py'.format(current_dir)):
     worker = basename(filename[:-3])
     if worker != '__init__':
-        worker_module = import_module(worker)
-        worker_objects = dir(worker_module)
-        for obj in required_objects:
-            if obj not in worker_objects:
-                break
-        else:
-            meta_obj = getattr(worker_module, '__meta__')
-            meta_keys = meta_obj.keys()
-            for meta in required_meta:
-                if meta not in meta_keys:
-                    break
-            else:
-                __all__.append(worker)
-                available[worker] = {'main': getattr(worker_module, 'main'),
-                                     'from': meta_obj['from'],
-                                     'requires': meta_obj['requires'],
-                                     'to': meta_obj['to'],
-                                     'provides': meta_obj['provides'],
-                                    }
+        source = open(filename).read()
+        manifest = read_manifest(source)
+        if manifest is not None:
+            meta, names = manifest
+            available[worker] = Worker(worker, meta, names,
+                                       md5(source).hexdigest())
+
+def preload(names=None):
+    '''Call `warm_up` of workers that have one, return the time spent
+
+    Workers that use heavy resources (like NLTK models) load them in their
+    optional `warm_up` function. The broker calls it once before forking its
+    processes, so the resources are shared (copy-on-write) with them instead
+    of being loaded by each process. If a warm-up fails the worker is not
+    included in the result and loads its resources on first use. Only the
+    modules of workers with a `warm_up` function are imported. `names`
+    restricts the workers to be warmed up (default: all).
+    '''
+    warm_up_times = {}
+    for name, worker in available.iteritems():
+        if not worker.has_warm_up or (names is not None and
+                                      name not in names):
+            continue
+        start_time = time()
+        try:
+            worker['warm_up']()
+        except Exception:
+            continue
+        warm_up_times[name] = time() - start_time
+    return warm_up_times
+
+def chunked_input(worker, document):
+    '''Replace fields required by a chunked worker by iterators of chunks'''
+    document = dict(document)
+    size = available[worker]['chunk size']
+    for key in available[worker]['requires']:
+        if key in document:
+            document[key] = iter_chunks(document[key], size)
+    return document
+
+def join_results(partial_results):
+    '''Join the partial results yielded by a chunked worker'''
+    chunks = {}
+    for partial_result in partial_results:
+        for key, value in partial_result.iteritems():
+            chunks.setdefault(key, []).append(value)
+    return {key: join_chunks(values) for key, values in chunks.iteritems()}
+
+def run_worker(worker, document):
+    '''Return ``('result', result)`` or ``('error', traceback)``
+
+    Partial results of chunked workers are joined in the result.
+    '''
+    try:
+        if available[worker]['chunked']:
+            return 'result', join_results(available[worker]['main'](
+                    chunked_input(worker, document)))
+        return 'result', available[worker]['main'](document)
+    except Exception:
+        return 'error', traceback.format_exc()
+
+def stream_worker(worker, document, child_connection, payload_threshold=None):
+    '''Run a chunked worker, sending each partial result as it's yielded
+
+    Partial results are sent as ``('chunk', partial_result)``. Return
+    ``('result', {})`` when the worker finishes or ``('error', traceback)``.
+    '''
+    try:
+        partial_results = available[worker]['main'](chunked_input(worker,
+                                                                  document))
+        for partial_result in partial_results:
+            partial_result = share_big_values(partial_result,
+                                              payload_threshold)
+            child_connection.send(('chunk', partial_result))
+    except Exception:
+        return 'error', traceback.format_exc()
+    return 'result', {}
+
+def run_pipeline(pipeline, document):
+    '''Run all the workers of a pipeline tree on `document`, in this process
+
+    Each worker receives the document updated with the results of the
+    workers before it, so intermediate results never leave the process.
+    Return ``('result', results)``, with the fields provided by all the
+    workers, or ``('error', traceback)`` of the first worker that failed.
+    '''
+    worker = pipeline['worker']
+    status, result = run_worker(worker, document)
+    if status != 'result':
+        return status, 'Worker "{}" failed:\n{}'.format(worker, result)
+    provides = available[worker]['provides']
+    results = {key: value for key, value in result.iteritems()
+               if key in provides}
+    document = dict(document)
+    document.update(results)
+    for child in pipeline.get('after', []):
+        status, child_results = run_pipeline(child, document)
+        if status != 'result':
+            return status, child_results
+        results.update(child_results)
+    return 'result', results
 
 def wrapper(child_connection):
     #TODO: should receive the document or database's configuration?
@@ -43,11 +244,31 @@ def wrapper(child_connection):
     #      worker only an lazy iterator for the collection (pymongo's cursor)
     #TODO: create documentation about object type returned by worker (strings
     #      must be unicode)
-    #TODO: add the possibility to create workers that are executables (they
-    #      receive data as JSON in stdin and put the result as JSON in stdout),
-    #      so we can create workers in C, Perl, Ruby etc.
-    #TODO: should get any exception information and send it to broker signaling
-    #      'job failed' and sending the traceback
     worker, document = child_connection.recv()
-    result = available[worker]['main'](document)
-    child_connection.send(result)
+    child_connection.send(run_worker(worker, document))
+
+def persistent_wrapper(child_connection, payload_threshold=None):
+    '''Run jobs received from `child_connection` until it receives `None`
+
+    Used by the broker's pool of preforked processes, so process creation and
+    worker initialization are paid once and not for each job. Strings in the
+    result bigger than `payload_threshold` are sent back as shared payloads.
+    Instead of a worker name a job can have a pipeline tree, that is run by
+    `run_pipeline`. Chunked workers send their partial results as they are
+    yielded (see `stream_worker`).
+    '''
+    while True:
+        message = child_connection.recv()
+        if message is None:
+            break
+        worker, document = message
+        if isinstance(worker, dict):
+            status, result = run_pipeline(worker, load_payloads(document))
+        elif worker in available and available[worker]['chunked']:
+            status, result = stream_worker(worker, load_payloads(document),
+                                           child_connection, payload_threshold)
+        else:
+            status, result = run_worker(worker, load_payloads(document))
+        if status == 'result':
+            result = share_big_values(result, payload_threshold)
+        child_connection.send((status, result))
@@ -0,0 +1,23 @@
+# coding: utf-8
+
+__meta__ = {'from': 'corpus',
+            'requires': ['freqdist'],
+            'to': 'corpus',
+            'provides': ['freqdist'],
+            'version': 1,}
+
+checkpoint_every = 1000
+
+def main(document):
+    corpus = document['corpus']
+    # saved as a list, since tokens (like '.') can't be MongoDB keys
+    frequency_distribution = dict(corpus.state or [])
+    for index, corpus_document in enumerate(corpus, start=1):
+        for token, count in corpus_document.get('freqdist', []):
+            frequency_distribution[token] = \
+                    frequency_distribution.get(token, 0) + count
+        if index % checkpoint_every == 0:
+            corpus.checkpoint(frequency_distribution.items())
+    fd = frequency_distribution.items()
+    fd.sort(lambda x, y: cmp(y[1], x[1]))
+    return {'freqdist': fd}
@@ -3,7 +3,11 @@
 __meta__ = {'from': 'gridfs-file',
             'requires': ['contents'],
             'to': 'document',
-            'provides': ['text', 'metadata'],}
+            'provides': ['text', 'metadata'],
+            'version': 1,
+            'executables': ['pdftotext', 'pdfinfo'],
+            # some 'evil' PDFs make pdftotext hang
+            'timeout': 300,}
 
 import shlex
 from subprocess import Popen, PIPE
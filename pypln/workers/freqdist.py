@@ -3,7 +3,8 @@
 __meta__ = {'from': 'document',
             'requires': ['tokens'],
             'to': 'document',
-            'provides': ['freqdist'],}
+            'provides': ['freqdist'],
+            'version': 1,}
 
 def main(document):
     tokens = [info[0].lower() for info in document['tokens']]
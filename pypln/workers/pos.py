@@ -6,7 +6,9 @@ from nltk import pos_tag
 __meta__ = {'from': 'document',
             'requires': ['text', 'tokens'],
             'to': 'document',
-            'provides': ['pos'],}
+            'provides': ['pos'],
+            'version': 1,
+            'dependencies': ['nltk'],}
 #TODO: add 'lang' to 'requires'
 
 def _put_offset(text, tagged_text):
@@ -18,6 +20,10 @@ def _put_offset(text, tagged_text):
         position = token_position + len(token) - 1
     return result
 
+def warm_up():
+    # loads the pickled tagger
+    pos_tag(['Warm', 'up', '.'])
+
 def main(document):
     text = document['text']
     tokens = document['tokens']
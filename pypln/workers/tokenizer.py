@@ -6,7 +6,13 @@ from nltk import word_tokenize
 __meta__ = {'from': 'document',
             'requires': ['text'],
             'to': 'document',
-            'provides': ['tokens'],}
+            'provides': ['tokens'],
+            'version': 1,
+            'dependencies': ['nltk'],}
+
+def warm_up():
+    # loads the punkt models
+    word_tokenize('Warm up. Now.')
 
 def main(document):
     text = document['text']
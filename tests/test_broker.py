@@ -13,6 +13,7 @@ import zmq
 from pymongo import Connection
 from gridfs import GridFS
 from psutil import Process, NoSuchProcess
+from pypln.stores.spill import LazyDocument
 
 
 time_to_wait = 500
@@ -25,9 +26,29 @@ class TestManagerBroker(unittest.TestCase):
         worker.close()
         cls.workers.append(filename)
 
+    @classmethod
+    def remove_workers(cls):
+        for worker in cls.workers:
+            for filename in (worker, worker + 'c'): # .pyc
+                try:
+                    unlink(filename)
+                except OSError:
+                    # file was not created, probably test failed
+                    pass
+
     @classmethod
     def setUpClass(cls):
         cls.workers = []
+        try:
+            cls.create_workers()
+            cls.connect_to_database()
+        except:
+            # workers in the package would be run by every broker
+            cls.remove_workers()
+            raise
+
+    @classmethod
+    def create_workers(cls):
         cls.create_worker('./pypln/workers/dummy.py', dedent('''
             __meta__ = {'from': '', 'requires': [], 'to': '', 'provides': []}
             def main(document):
@@ -39,6 +60,20 @@ class TestManagerBroker(unittest.TestCase):
             def main(document):
                 return {'key-c': document['key-a'], 'key-d': document['key-b']}
         '''))
+        cls.create_worker('./pypln/workers/mirror.py', dedent('''
+            __meta__ = {'from': 'document', 'requires': ['key-c'],
+                        'to': 'document', 'provides': ['key-e']}
+            def main(document):
+                return {'key-e': document['key-c'][::-1]}
+        '''))
+        cls.create_worker('./pypln/workers/chunky.py', dedent('''
+            __meta__ = {'from': 'document', 'requires': ['key-a'],
+                        'to': 'document', 'provides': ['key-c'],
+                        'chunked': True, 'chunk size': 2}
+            def main(document):
+                for chunk in document['key-a']:
+                    yield {'key-c': [value * 2 for value in chunk]}
+        '''))
         cls.create_worker('./pypln/workers/gridfs_clone.py', dedent('''
             __meta__ = {'from': 'gridfs-file',
                         'requires': ['length', 'md5', 'name', 'upload_date',
@@ -57,27 +92,51 @@ class TestManagerBroker(unittest.TestCase):
                 sleep(document['sleep-for'])
                 return {}
         '''))
+        cls.create_worker('./pypln/workers/broken.py', dedent('''
+            __meta__ = {'from': '', 'requires': [], 'to': '', 'provides': []}
+            def main(document):
+                return 1 / 0
+        '''))
+        cls.create_worker('./pypln/workers/impatient.py', dedent('''
+            from time import sleep
+            __meta__ = {'from': '', 'requires': [], 'to': '', 'provides': [],
+                        'timeout': 0.1}
+            def main(document):
+                sleep(100)
+                return {}
+        '''))
+        cls.create_worker('./pypln/workers/warm.py', dedent('''
+            from time import sleep
+            __meta__ = {'from': '', 'requires': [], 'to': '', 'provides': []}
+            def warm_up():
+                sleep(0.05)
+            def main(document):
+                return {}
+        '''))
+
+    @classmethod
+    def connect_to_database(cls):
         cls.monitoring_interval = 0.3
         cls.config = {'db': {'host': 'localhost', 'port': 27017,
                              'database': 'pypln_test',
                              'collection': 'documents',
                              'gridfs collection': 'files',
-                             'monitoring collection': 'monitoring'},
-                      'monitoring interval': cls.monitoring_interval,}
+                             'monitoring collection': 'monitoring',
+                             'result cache collection': 'result_cache',
+                             'corpora collection': 'corpora',
+                             'checkpoint collection': 'checkpoints'},
+                      'monitoring interval': cls.monitoring_interval,
+                      'heartbeat interval': 60,}
         cls.connection = Connection(cls.config['db']['host'],
                                     cls.config['db']['port'])
 
     @classmethod
     def tearDownClass(cls):
-        cls.connection.drop_database(cls.config['db']['database'])
-        cls.connection.close()
-        for worker in cls.workers:
-            try:
-                unlink(worker)
-                unlink(worker + 'c') # .pyc
-            except OSError:
-                # file was not created, probably test failed
-                pass
+        try:
+            cls.connection.drop_database(cls.config['db']['database'])
+            cls.connection.close()
+        finally:
+            cls.remove_workers()
 
     def setUp(self):
         self.context = zmq.Context()
@@ -129,16 +188,30 @@ class TestManagerBroker(unittest.TestCase):
             self.fail("Didn't receive 'get configuration' from broker")
         message = self.api.recv_json()
         self.api.send_json(self.config)
-        self.assertEquals(message, {'command': 'get configuration'})
+        self.assertEquals(message['command'], 'get configuration')
+        self.assertIn('broker', message)
 
-    def receive_get_job_and_send_it_to_broker(self, job=None):
+    def receive_get_jobs_and_send_them_to_broker(self, jobs=None):
         if not self.api.poll(time_to_wait):
-            self.fail("Didn't receive 'get job' from broker")
+            self.fail("Didn't receive 'get jobs' from broker")
         message = self.api.recv_json()
-        if job is None:
-            job = {'worker': 'dummy', 'document': '1', 'job id': '2'}
-        self.api.send_json(job)
-        self.assertEquals(message, {'command': 'get job'})
+        if jobs is None:
+            jobs = [{'worker': 'dummy', 'document': '1', 'job id': '2'}]
+        self.api.send_json({'jobs': jobs})
+        self.assertEquals(message['command'], 'get jobs')
+        self.assertIn('dummy', message['workers'])
+        return message
+
+    def receive_job_finished(self):
+        for i in range(cpu_count()):
+            if not self.api.poll(3 * time_to_wait):
+                self.fail("Didn't receive 'job finished' from broker")
+            message = self.api.recv_json()
+            if message['command'] == 'job finished':
+                self.api.send_json({'answer': 'good job!'})
+                return message
+            self.api.send_json({'jobs': []})
+        self.fail("Didn't receive 'job finished' from broker")
 
     def broker_should_be_quiet(self):
         sleep(time_to_wait / 1000.0)
@@ -150,32 +223,67 @@ class TestManagerBroker(unittest.TestCase):
 
     def test_should_ask_for_a_job_after_configuration(self):
         self.receive_get_configuration_and_send_it_to_broker()
-        self.receive_get_job_and_send_it_to_broker()
+        self.receive_get_jobs_and_send_them_to_broker()
+
+    def test_should_ask_for_as_many_jobs_as_free_slots_in_one_request(self):
+        self.receive_get_configuration_and_send_it_to_broker()
+        message = self.receive_get_jobs_and_send_them_to_broker([])
+        self.assertEquals(message['count'], cpu_count())
+        self.broker_should_be_quiet()
 
     def test_broker_should_send_get_job_just_after_manager_broadcast_new_job(self):
         self.receive_get_configuration_and_send_it_to_broker()
-        self.receive_get_job_and_send_it_to_broker({'worker': None})
+        self.receive_get_jobs_and_send_them_to_broker([])
         self.broker_should_be_quiet()
         self.broadcast.send('new job')
         # just kidding
-        self.receive_get_job_and_send_it_to_broker({'worker': None})
+        self.receive_get_jobs_and_send_them_to_broker([])
+
+    def test_should_advertise_free_slots_per_worker(self):
+        self.receive_get_configuration_and_send_it_to_broker()
+        message = self.receive_get_jobs_and_send_them_to_broker([])
+        self.assertEquals(message['workers']['dummy'], cpu_count())
+        self.assertEquals(message['workers']['echo'], cpu_count())
+
+    def test_broker_should_reject_jobs_for_workers_it_cannot_run(self):
+        self.receive_get_configuration_and_send_it_to_broker()
+        job = {'worker': 'unknown-worker', 'document': '1', 'job id': '2'}
+        self.receive_get_jobs_and_send_them_to_broker([job])
+        if not self.api.poll(time_to_wait):
+            self.fail("Didn't receive 'reject job' from broker")
+        message = self.api.recv_json()
+        self.api.send_json({'answer': 'job requeued'})
+        self.assertEquals(message['command'], 'reject job')
+        self.assertEquals(message['job id'], '2')
+
+    def test_broker_should_send_heartbeat_when_idle(self):
+        if not self.api.poll(time_to_wait):
+            self.fail("Didn't receive 'get configuration' from broker")
+        message = self.api.recv_json()
+        config = dict(self.config)
+        config['heartbeat interval'] = 0.2
+        self.api.send_json(config)
+        self.receive_get_jobs_and_send_them_to_broker([])
+        if not self.api.poll(time_to_wait):
+            self.fail("Didn't receive 'heartbeat' from broker")
+        message = self.api.recv_json()
+        self.api.send_json({'answer': 'heartbeat received'})
+        self.assertEquals(message['command'], 'heartbeat')
+        self.assertEquals(message['jobs'], [])
 
     def test_broker_should_send_finished_job_when_asked_to_run_dummy_worker(self):
         self.receive_get_configuration_and_send_it_to_broker()
 
-        jobs = [{'worker': 'dummy', 'document': 'xpto'}] * cpu_count()
+        jobs = [{'worker': 'dummy', 'document': 'xpto', 'job id': str(i)}
+                for i in range(cpu_count())]
         finished_jobs = 0
-        for i in range(3 * cpu_count()):
+        for i in range(2 * cpu_count() + 1):
             if not self.api.poll(3 * time_to_wait):
-                self.fail("Didn't receive 'get job' or 'finished job'")
-            message = self.api.recv_json() # 'get job' or 'finished job'
-            if message == {'command': 'get job'}:
-                if len(jobs):
-                    job = jobs.pop()
-                    job['job id'] = str(i)
-                else:
-                    job = {'worker': None}
-                self.api.send_json(job)
+                self.fail("Didn't receive 'get jobs' or 'finished job'")
+            message = self.api.recv_json() # 'get jobs' or 'finished job'
+            if message['command'] == 'get jobs':
+                self.api.send_json({'jobs': jobs[:message['count']]})
+                jobs = jobs[message['count']:]
             elif 'command' in message and message['command'] == 'job finished':
                 finished_jobs += 1
                 self.api.send_json({'answer': 'good job!'})
@@ -186,22 +294,8 @@ class TestManagerBroker(unittest.TestCase):
         document_id = self.collection.insert({'key-a': 'spam', 'key-b': 'eggs'})
         job = {'worker': 'echo', 'document': str(document_id), 'job id': '42'}
         self.receive_get_configuration_and_send_it_to_broker()
-        self.receive_get_job_and_send_it_to_broker(job)
-        message = None
-        for i in range(cpu_count() - 1):
-            if not self.api.poll(3 * time_to_wait):
-                self.fail("Didn't receive 'get job' from broker")
-            msg = self.api.recv_json()
-            if msg['command'] == 'job finished':
-                message = msg
-                self.api.send_json({'answer': 'good job!'})
-                break
-            else:
-                self.api.send_json({'worker': None})
-        if message is None:
-            if not self.api.poll(3 * time_to_wait):
-                self.fail("Didn't receive 'job finished' from broker")
-            message = self.api.recv_json()
+        self.receive_get_jobs_and_send_them_to_broker([job])
+        message = self.receive_job_finished()
         self.assertIn('command', message)
         self.assertIn('job id', message)
         self.assertEquals(message['command'], 'job finished')
@@ -212,6 +306,239 @@ class TestManagerBroker(unittest.TestCase):
         self.assertEquals(document['key-c'], document['key-a'])
         self.assertEquals(document['key-d'], document['key-b'])
 
+    def test_broker_should_run_fused_pipeline_and_save_only_final_results(self):
+        document_id = self.collection.insert({'key-a': 'spam',
+                                              'key-b': 'eggs'})
+        job = {'worker': 'echo', 'document': str(document_id), 'job id': '7',
+               'fused': True, 'after': [{'worker': 'mirror', 'after': []}]}
+        self.receive_get_configuration_and_send_it_to_broker()
+        self.receive_get_jobs_and_send_them_to_broker([job])
+        message = self.receive_job_finished()
+        self.assertEquals(message['job id'], '7')
+        document = self.collection.find_one({'_id': document_id})
+        self.assertNotIn('key-c', document)
+        self.assertNotIn('key-d', document)
+        self.assertEquals(document['key-e'], 'maps')
+        # all the workers are stamped, so the planner knows they ran
+        self.assertEquals(sorted(document['_versions'].keys()),
+                          ['echo', 'mirror'])
+        self.assertEquals(document['_cache keys'].keys(), ['mirror'])
+
+    def test_files_of_overwritten_results_should_be_deleted(self):
+        big_value = 'spam ' * (1024 * 1024) # bigger than spill threshold
+        document_id = self.collection.insert({'key-a': big_value,
+                                              'key-b': 'eggs'})
+        self.receive_get_configuration_and_send_it_to_broker()
+        for job_id, key_b in [('11', 'eggs'), ('12', 'ham')]:
+            self.collection.update({'_id': document_id},
+                                   {'$set': {'key-b': key_b}})
+            self.receive_get_jobs_and_send_them_to_broker([{'worker': 'echo',
+                'document': str(document_id), 'job id': job_id}])
+            self.receive_job_finished()
+        files = self.db[self.config['db']['gridfs collection']].files
+        self.assertEquals(files.find({'document': document_id,
+                                      'field': 'key-c'}).count(), 1)
+        document = self.collection.find_one({'_id': document_id})
+        self.assertEquals(LazyDocument(document, self.gridfs)['key-c'],
+                          big_value)
+
+    def test_gridfs_file_workers_should_keep_other_fields_of_document(self):
+        file_id = self.gridfs.put('spam', filename='spam.txt')
+        self.collection.insert({'_id': file_id, 'corpora': ['corpus'],
+                                'key-c': 'eggs'})
+        job = {'worker': 'gridfs_clone', 'document': str(file_id),
+               'job id': '10'}
+        self.receive_get_configuration_and_send_it_to_broker()
+        self.receive_get_jobs_and_send_them_to_broker([job])
+        self.receive_job_finished()
+        document = self.collection.find_one({'_id': file_id})
+        self.assertEquals(document['contents'], 'spam')
+        self.assertEquals(document['corpora'], ['corpus'])
+        self.assertEquals(document['key-c'], 'eggs')
+
+    def test_broker_should_stamp_results_with_version_and_input(self):
+        from bson import BSON
+        from pypln.planner import input_fingerprint
+        document_id = self.collection.insert({'key-a': 'spam',
+                                              'key-b': 'eggs'})
+        job = {'worker': 'echo', 'document': str(document_id), 'job id': '8'}
+        self.receive_get_configuration_and_send_it_to_broker()
+        self.receive_get_jobs_and_send_them_to_broker([job])
+        self.receive_job_finished()
+        document = self.collection.find_one({'_id': document_id})
+        self.assertEquals(document['_fingerprints']['key-c'],
+                          md5(BSON.encode({'value': 'spam'})).hexdigest())
+        # 'key-a' and 'key-b' were not written by a worker
+        self.assertEquals(document['_versions']['echo']['input'],
+                          input_fingerprint({}, ['key-a', 'key-b']))
+        self.assertTrue(document['_versions']['echo']['version'])
+
+    def test_broker_should_store_partial_results_of_chunked_workers(self):
+        document_id = self.collection.insert({'key-a': [1, 2, 3, 4, 5]})
+        job = {'worker': 'chunky', 'document': str(document_id),
+               'job id': '9'}
+        self.receive_get_configuration_and_send_it_to_broker()
+        self.receive_get_jobs_and_send_them_to_broker([job])
+        message = self.receive_job_finished()
+        self.assertEquals(message['job id'], '9')
+        document = self.collection.find_one({'_id': document_id})
+        self.assertEquals(len(document['key-c']['_gridfs_chunks']), 3)
+        self.assertEquals(LazyDocument(document, self.gridfs)['key-c'],
+                          [2, 4, 6, 8, 10])
+
+    def test_broker_should_reject_fused_jobs_with_workers_it_cannot_run(self):
+        self.receive_get_configuration_and_send_it_to_broker()
+        job = {'worker': 'echo', 'document': '1', 'job id': '8',
+               'fused': True,
+               'after': [{'worker': 'unknown-worker', 'after': []}]}
+        self.receive_get_jobs_and_send_them_to_broker([job])
+        if not self.api.poll(time_to_wait):
+            self.fail("Didn't receive 'reject job' from broker")
+        message = self.api.recv_json()
+        self.api.send_json({'answer': 'job requeued'})
+        self.assertEquals(message['command'], 'reject job')
+        self.assertEquals(message['job id'], '8')
+
+    def test_broker_should_save_results_of_a_batch_of_jobs(self):
+        document_ids = [self.collection.insert({'key-a': i, 'key-b': -i})
+                        for i in range(cpu_count())]
+        jobs = [{'worker': 'echo', 'document': str(document_id),
+                 'job id': str(index)}
+                for index, document_id in enumerate(document_ids)]
+        self.receive_get_configuration_and_send_it_to_broker()
+        self.receive_get_jobs_and_send_them_to_broker(jobs)
+        finished = set()
+        for job in jobs:
+            finished.add(self.receive_job_finished()['job id'])
+        self.assertEquals(finished, set(job['job id'] for job in jobs))
+        for index, document_id in enumerate(document_ids):
+            document = self.collection.find_one({'_id': document_id})
+            self.assertEquals(document['key-c'], index)
+            self.assertEquals(document['key-d'], -index)
+
+    def receive_job_failed(self, timeout):
+        if not self.api.poll(timeout):
+            self.fail("Didn't receive 'job failed' from broker")
+        message = self.api.recv_json()
+        self.api.send_json({'answer': 'job will be retried'})
+        self.assertEquals(message['command'], 'job failed')
+        self.assertIn('duration', message['resource usage'])
+        return message
+
+    def test_broker_should_send_job_failed_with_traceback(self):
+        self.receive_get_configuration_and_send_it_to_broker()
+        self.receive_get_jobs_and_send_them_to_broker([{'worker': 'broken',
+            'document': '1', 'job id': '3'}])
+        message = self.receive_job_failed(3 * time_to_wait)
+        self.assertEquals(message['job id'], '3')
+        self.assertIn('ZeroDivisionError', message['error'])
+
+    def test_broker_should_kill_jobs_that_exceed_their_timeout(self):
+        self.receive_get_configuration_and_send_it_to_broker()
+        self.receive_get_jobs_and_send_them_to_broker([{'worker': 'impatient',
+            'document': '1', 'job id': '4'}])
+        message = self.receive_job_failed(2000)
+        self.assertEquals(message['job id'], '4')
+        self.assertIn('Timeout', message['error'])
+        self.assertTrue(message['resource usage']['duration'] > 0.1)
+
+    def test_jobs_whose_results_can_not_be_saved_should_fail(self):
+        first_id = self.collection.insert({'key-a': 'spam', 'key-b': 'eggs'})
+        # '_versions.echo' can't be set in this document
+        second_id = self.collection.insert({'key-a': 'eggs', 'key-b': 'spam',
+                                            '_versions': 'not a dict'})
+        self.receive_get_configuration_and_send_it_to_broker()
+        self.receive_get_jobs_and_send_them_to_broker([
+            {'worker': 'echo', 'document': str(first_id), 'job id': '1'},
+            {'worker': 'echo', 'document': str(second_id), 'job id': '2'}])
+        messages = {}
+        while len(messages) < 2:
+            if not self.api.poll(3 * time_to_wait):
+                self.fail("Didn't receive the results of all jobs")
+            message = self.api.recv_json()
+            if message['command'] in ('job finished', 'job failed'):
+                messages[message['job id']] = message['command']
+                self.api.send_json({'answer': 'ok'})
+            else:
+                self.api.send_json({'jobs': []})
+        # the broker is still running
+        self.assertEquals(self.broker.poll(), None)
+        self.assertEquals(messages, {'1': 'job finished', '2': 'job failed'})
+        document = self.collection.find_one({'_id': first_id})
+        self.assertEquals(document['key-c'], 'spam')
+
+    def test_results_should_be_spilled_if_the_document_gets_too_big(self):
+        # results of other jobs, each below the spill threshold
+        document_id = self.collection.insert({'text': 'a' * (3 << 20),
+                                              'tokens': 'b' * (3 << 20),
+                                              'pos': 'c' * (3 << 20),
+                                              'freqdist': 'd' * (3 << 20),
+                                              'key-a': 'e' * (3 << 20),
+                                              'key-b': 'f'})
+        self.receive_get_configuration_and_send_it_to_broker()
+        self.receive_get_jobs_and_send_them_to_broker([{'worker': 'echo',
+            'document': str(document_id), 'job id': '1'}])
+        message = self.receive_job_finished()
+        self.assertEquals(message['job id'], '1')
+        document = LazyDocument(self.collection.find_one({'_id':
+                                                          document_id}),
+                                self.gridfs)
+        self.assertEquals(document['key-c'], 'e' * (3 << 20))
+        self.assertEquals(document['key-d'], 'f')
+
+    def test_broker_should_reuse_cached_result_for_the_same_input(self):
+        first_id = self.collection.insert({'key-a': 'spam', 'key-b': 'eggs'})
+        second_id = self.collection.insert({'key-a': 'spam', 'key-b': 'eggs'})
+        self.receive_get_configuration_and_send_it_to_broker()
+        self.receive_get_jobs_and_send_them_to_broker([{'worker': 'echo',
+            'document': str(first_id), 'job id': '1'}])
+        message = self.receive_job_finished()
+        self.assertNotIn('cached', message)
+        self.receive_get_jobs_and_send_them_to_broker([{'worker': 'echo',
+            'document': str(second_id), 'job id': '2'}])
+        message = self.receive_job_finished()
+        self.assertEquals(message['job id'], '2')
+        self.assertTrue(message['cached'])
+        document = self.collection.find_one({'_id': second_id})
+        self.assertEquals(document['key-c'], 'spam')
+        self.assertEquals(document['key-d'], 'eggs')
+
+    def test_broker_should_not_reuse_results_that_were_overwritten(self):
+        first_id = self.collection.insert({'key-a': 'spam', 'key-b': 'eggs'})
+        second_id = self.collection.insert({'key-a': 'spam', 'key-b': 'eggs'})
+        self.receive_get_configuration_and_send_it_to_broker()
+        self.receive_get_jobs_and_send_them_to_broker([{'worker': 'echo',
+            'document': str(first_id), 'job id': '1'}])
+        self.receive_job_finished()
+        # the cache entry points to the first document, which now has the
+        # result of another input
+        self.collection.update({'_id': first_id},
+                               {'$set': {'key-c': 'other',
+                                         '_cache keys.echo': 'other key'}})
+        self.receive_get_jobs_and_send_them_to_broker([{'worker': 'echo',
+            'document': str(second_id), 'job id': '2'}])
+        message = self.receive_job_finished()
+        self.assertNotIn('cached', message)
+        document = self.collection.find_one({'_id': second_id})
+        self.assertEquals(document['key-c'], 'spam')
+
+    def test_broker_should_not_use_cached_fields_written_by_others(self):
+        document_id = self.collection.insert({'key-a': 'spam',
+                                              'key-b': 'eggs'})
+        self.receive_get_configuration_and_send_it_to_broker()
+        self.receive_get_jobs_and_send_them_to_broker([{'worker': 'echo',
+            'document': str(document_id), 'job id': '1'}])
+        self.receive_job_finished()
+        # another broker writes the field kept in this broker's field cache
+        self.collection.update({'_id': document_id},
+                               {'$set': {'key-c': 'other',
+                                         '_fingerprints.key-c': 'other md5'}})
+        self.receive_get_jobs_and_send_them_to_broker([{'worker': 'mirror',
+            'document': str(document_id), 'job id': '2'}])
+        self.receive_job_finished()
+        document = self.collection.find_one({'_id': document_id})
+        self.assertEquals(document['key-e'], 'rehto')
+
     def test_broker_should_load_and_save_document_from_and_to_collection(self):
         file_contents = 'Now is better than never.'
         filename = 'this.txt'
@@ -219,22 +546,8 @@ class TestManagerBroker(unittest.TestCase):
         job = {'worker': 'gridfs_clone', 'document': str(document_id),
                'job id': '42'}
         self.receive_get_configuration_and_send_it_to_broker()
-        self.receive_get_job_and_send_it_to_broker(job)
-        message = None
-        for i in range(cpu_count() - 1):
-            if not self.api.poll(3 * time_to_wait):
-                self.fail("Didn't receive 'get job' from broker")
-            msg = self.api.recv_json()
-            if msg['command'] == 'job finished':
-                message = msg
-                self.api.send_json({'answer': 'good job!'})
-                break
-            else:
-                self.api.send_json({'worker': None})
-        if message is None:
-            if not self.api.poll(3 * time_to_wait):
-                self.fail("Didn't receive 'job finished' from broker")
-            message = self.api.recv_json()
+        self.receive_get_jobs_and_send_them_to_broker([job])
+        message = self.receive_job_finished()
         self.assertIn('command', message)
         self.assertIn('job id', message)
         self.assertEquals(message['command'], 'job finished')
@@ -253,11 +566,11 @@ class TestManagerBroker(unittest.TestCase):
     def test_broker_should_kill_active_workers_process_when_receive_SIGINT(self):
         document_id = str(self.collection.insert({'sleep-for': 100}))
         jobs = [{'worker': 'snorlax', 'document': document_id,
-                 'job id': '143'}] * cpu_count()
+                 'job id': '143'} for i in range(cpu_count())]
         self.receive_get_configuration_and_send_it_to_broker()
         for index, job in enumerate(jobs):
             job['job id'] = '143-{}'.format(index)
-            self.receive_get_job_and_send_it_to_broker(job)
+        self.receive_get_jobs_and_send_them_to_broker(jobs)
         sleep(cpu_count() * time_to_wait / 1000.0)
         broker_pid = self.broker.pid
         children_pid = [process.pid for process in \
@@ -275,30 +588,16 @@ class TestManagerBroker(unittest.TestCase):
         document_id = str(self.collection.insert({'sleep-for': sleep_time}))
         job = {'worker': 'snorlax', 'document': document_id, 'job id': '143'}
         self.receive_get_configuration_and_send_it_to_broker()
-        self.receive_get_job_and_send_it_to_broker(job)
+        self.receive_get_jobs_and_send_them_to_broker([job])
         start_time = time()
-        for i in range(cpu_count() - 1):
-            if not self.api.poll(3 * time_to_wait):
-                self.fail("Didn't receive 'get job' from broker")
-            msg = self.api.recv_json()
-            if msg['command'] == 'job finished':
-                end_time = time()
-                message = msg
-                self.api.send_json({'answer': 'good job!'})
-                break
-            else:
-                self.api.send_json({'worker': None})
-        if message is None:
-            if not self.api.poll(3 * time_to_wait):
-                self.fail("Didn't receive 'job finished' from broker")
-            message = self.api.recv_json()
-            end_time = time()
+        message = self.receive_job_finished()
+        end_time = time()
         self.assertIn('duration', message)
         self.assertTrue(0 < message['duration'] < (end_time - start_time))
 
     def test_broker_should_insert_monitoring_information_in_mongodb(self):
         self.receive_get_configuration_and_send_it_to_broker()
-        self.receive_get_job_and_send_it_to_broker({'worker': None})
+        self.receive_get_jobs_and_send_them_to_broker([])
         monitoring_info = self.monitoring_collection.find()
         self.assertEquals(monitoring_info.count(), 1)
         info = monitoring_info[0]
@@ -345,9 +644,17 @@ class TestManagerBroker(unittest.TestCase):
         for key in needed_process_keys:
             self.assertIn(key, process_info)
 
+    def test_broker_should_report_warm_up_times_in_monitoring(self):
+        self.receive_get_configuration_and_send_it_to_broker()
+        self.receive_get_jobs_and_send_them_to_broker([])
+        info = self.monitoring_collection.find_one()
+        warm_up_times = info['processes'][0]['warm up times']
+        self.assertTrue(warm_up_times['warm'] >= 0.05)
+        self.assertNotIn('echo', warm_up_times)
+
     def test_broker_should_insert_monitoring_information_regularly(self):
         self.receive_get_configuration_and_send_it_to_broker()
-        self.receive_get_job_and_send_it_to_broker({'worker': None})
+        self.receive_get_jobs_and_send_them_to_broker([])
         sleep((self.monitoring_interval + 0.05) * 3)
         # 0.05 = default broker poll time
         monitoring_info = self.monitoring_collection.find()
@@ -358,10 +665,9 @@ class TestManagerBroker(unittest.TestCase):
         self.receive_get_configuration_and_send_it_to_broker()
         start_time = time()
         document_id = self.collection.insert({'sleep-for': 100})
-        for i in range(cpus):
-            job = {'worker': 'snorlax', 'document': str(document_id),
-                   'job id': i}
-            self.receive_get_job_and_send_it_to_broker(job)
+        jobs = [{'worker': 'snorlax', 'document': str(document_id),
+                 'job id': i} for i in range(cpus)]
+        self.receive_get_jobs_and_send_them_to_broker(jobs)
         sleep(0.1 * cpus) # 0.1 = time for each worker to start
         end_time = time()
         sleep(self.monitoring_interval * 2) # wait for broker to save info
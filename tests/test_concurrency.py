@@ -0,0 +1,71 @@
+# coding: utf-8
+
+import unittest
+from pypln.concurrency import ConcurrencyController, WorkerHistory
+
+
+megabyte = 1024 * 1024
+idle_host = {'cpu percent': 10.0, 'load average': 0.1,
+             'total memory': 1000 * megabyte,
+             'available memory': 900 * megabyte}
+
+class TestWorkerHistory(unittest.TestCase):
+    def test_should_keep_moving_averages(self):
+        history = WorkerHistory(alpha=0.5)
+        history.add({'duration': 2.0, 'cpu time': 2.0,
+                     'resident memory': 100})
+        history.add({'duration': 2.0, 'cpu time': 0.0,
+                     'resident memory': 200})
+        self.assertEquals(history.jobs, 2)
+        self.assertEquals(history.cpu_share, 0.5)
+        self.assertEquals(history.memory, 150)
+
+    def test_jobs_without_process_information_should_be_ignored(self):
+        history = WorkerHistory()
+        history.add({'duration': 1.0})
+        self.assertEquals(history.jobs, 0)
+
+class TestConcurrencyController(unittest.TestCase):
+    def test_limit_should_start_with_number_of_cpus(self):
+        controller = ConcurrencyController(cpus=4)
+        self.assertEquals(controller.limit, 4)
+        self.assertEquals(controller.worker_limits({'pos': 16}, {}),
+                          {'pos': 4})
+
+    def test_limit_should_grow_when_slots_are_full_and_host_is_idle(self):
+        controller = ConcurrencyController(cpus=2, max_jobs=3)
+        self.assertEquals(controller.update(1, idle_host), 2)
+        self.assertEquals(controller.update(2, idle_host), 3)
+        self.assertEquals(controller.update(3, idle_host), 3)
+
+    def test_limit_should_not_grow_when_cpu_is_busy(self):
+        controller = ConcurrencyController(cpus=2)
+        busy_host = dict(idle_host, **{'cpu percent': 99.0})
+        self.assertEquals(controller.update(2, busy_host), 2)
+
+    def test_limit_should_halve_when_memory_is_low(self):
+        controller = ConcurrencyController(cpus=8)
+        low_memory = dict(idle_host, **{'available memory': 50 * megabyte})
+        self.assertEquals(controller.update(8, low_memory), 4)
+        self.assertEquals(controller.update(4, low_memory), 2)
+        self.assertEquals(controller.update(2, low_memory), 1)
+        self.assertEquals(controller.update(1, low_memory), 1)
+
+    def test_io_bound_workers_should_run_more_jobs_per_cpu(self):
+        controller = ConcurrencyController(cpus=2, max_jobs=16)
+        controller.limit = 16
+        controller.signals = idle_host
+        controller.record('extractor', {'duration': 1.0, 'cpu time': 0.25,
+                                        'resident memory': megabyte})
+        controller.record('pos', {'duration': 1.0, 'cpu time': 1.0,
+                                  'resident memory': megabyte})
+        limits = controller.worker_limits({'extractor': 16, 'pos': 16}, {})
+        self.assertEquals(limits, {'extractor': 8, 'pos': 2})
+
+    def test_memory_heavy_workers_should_run_only_if_memory_is_available(self):
+        controller = ConcurrencyController(cpus=4, max_jobs=16)
+        controller.signals = idle_host # 800MB free, 100MB is the reserve
+        controller.record('pos', {'duration': 1.0, 'cpu time': 0.1,
+                                  'resident memory': 300 * megabyte})
+        limits = controller.worker_limits({'pos': 16}, {'pos': 1})
+        self.assertEquals(limits, {'pos': 3})
@@ -0,0 +1,20 @@
+# coding: utf-8
+
+import unittest
+from pypln.utils import default_config, with_defaults
+
+
+class TestConfigDefaults(unittest.TestCase):
+    def test_missing_keys_should_come_from_defaults(self):
+        config = with_defaults({'monitoring interval': 30,
+                                'db': {'database': 'spam'}})
+        self.assertEquals(config['monitoring interval'], 30)
+        self.assertEquals(config['heartbeat interval'], 10)
+        self.assertEquals(config['db']['database'], 'spam')
+        self.assertEquals(config['db']['checkpoint collection'],
+                          'checkpoints')
+
+    def test_defaults_should_not_be_changed(self):
+        config = with_defaults({})
+        config['db']['database'] = 'spam'
+        self.assertEquals(default_config['db']['database'], 'pypln')
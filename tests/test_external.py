@@ -0,0 +1,91 @@
+# coding: utf-8
+
+import sys
+import unittest
+from os import unlink
+from tempfile import mkstemp
+from textwrap import dedent
+from pypln.external import ExternalProcess, ExternalWorkerError
+from pypln.workers import Worker, read_manifest
+
+
+program = dedent('''
+    import json, os, sys
+    while True:
+        header = sys.stdin.readline()
+        if not header:
+            break
+        document = json.loads(sys.stdin.read(int(header)))
+        if document['text'] == 'crash':
+            os._exit(1)
+        elif document['text'] == 'fail':
+            answer = {'error': 'I failed'}
+        else:
+            answer = {'result': {'upper': document['text'].upper(),
+                                 'fields': sorted(document.keys()),
+                                 'pid': os.getpid()}}
+        body = json.dumps(answer)
+        sys.stdout.write('{}\\n{}'.format(len(body), body))
+        sys.stdout.flush()
+''')
+
+class TestExternalProcess(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        fd, cls.filename = mkstemp(suffix='.py')
+        with open(cls.filename, 'w') as fp:
+            fp.write(program)
+        cls.command = [sys.executable, cls.filename]
+
+    @classmethod
+    def tearDownClass(cls):
+        unlink(cls.filename)
+
+    def setUp(self):
+        self.external = ExternalProcess(self.command, fields=['text'])
+
+    def tearDown(self):
+        self.external.stop()
+
+    def test_same_process_should_handle_many_documents(self):
+        first = self.external.request({'text': u'the cat', 'other': 1})
+        second = self.external.request({'text': u'ol\xe1'})
+        self.assertEquals(first['upper'], u'THE CAT')
+        self.assertEquals(first['fields'], ['text'])
+        self.assertEquals(second['upper'], u'OL\xc1')
+        self.assertEquals(first['pid'], second['pid'])
+        self.assertEquals(self.external.starts, 1)
+
+    def test_errors_should_be_raised_and_process_kept(self):
+        pid = self.external.request({'text': 'spam'})['pid']
+        with self.assertRaises(ExternalWorkerError):
+            self.external.request({'text': 'fail'})
+        self.assertEquals(self.external.request({'text': 'eggs'})['pid'], pid)
+
+    def test_program_should_be_restarted_after_a_crash(self):
+        pid = self.external.request({'text': 'spam'})['pid']
+        with self.assertRaises(ExternalWorkerError):
+            self.external.request({'text': 'crash'})
+        self.assertNotEquals(self.external.request({'text': 'eggs'})['pid'],
+                             pid)
+        self.assertEquals(self.external.starts, 2)
+
+    def test_program_should_be_restarted_after_max_requests(self):
+        external = ExternalProcess(self.command, max_requests=2)
+        pids = [external.request({'text': 'spam'})['pid'] for i in range(3)]
+        external.stop()
+        self.assertEquals(pids[0], pids[1])
+        self.assertNotEquals(pids[1], pids[2])
+
+class TestExternalWorker(unittest.TestCase):
+    def test_worker_with_command_should_use_an_external_process(self):
+        meta, names = read_manifest(dedent('''
+            __meta__ = {'from': 'document', 'requires': ['text'],
+                        'to': 'document', 'provides': ['upper'],
+                        'command': ['shout', '--loud']}
+        '''))
+        worker = Worker('shout', meta, names, 'version')
+        self.assertEquals(worker['executables'], ['shout'])
+        self.assertTrue(isinstance(worker['main'], ExternalProcess))
+        self.assertEquals(worker['main'].fields, ['text'])
+        self.assertEquals(worker['warm_up'], None)
@@ -0,0 +1,131 @@
+# coding: utf-8
+
+import unittest
+import shutil
+import tempfile
+from os.path import join
+from pypln.stores.journal import JobJournal
+
+
+class TestJobJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = join(self.directory, 'manager.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def reopen(self, journal, **kwargs):
+        journal.close()
+        new_journal = JobJournal(self.filename, **kwargs)
+        return new_journal, new_journal.recover()
+
+    def test_empty_journal_should_recover_no_jobs(self):
+        journal = JobJournal(self.filename)
+        self.assertEquals(journal.recover(), [])
+        journal.close()
+
+    def test_should_recover_added_jobs_in_order(self):
+        journal = JobJournal(self.filename)
+        journal.recover()
+        for index in range(3):
+            journal.add_job({'job id': str(index), 'worker': 'w',
+                             'document': 'd'})
+        journal, jobs = self.reopen(journal)
+        self.assertEquals([job['job id'] for job in jobs], ['0', '1', '2'])
+        journal.close()
+
+    def test_should_recover_jobs_added_in_bulk(self):
+        journal = JobJournal(self.filename)
+        journal.recover()
+        journal.add_jobs([{'job id': 'a'}, {'job id': 'b'}])
+        journal.get_job('a')
+        journal.finish_job('a')
+        journal, jobs = self.reopen(journal)
+        self.assertEquals(jobs, [{'job id': 'b'}])
+        journal.close()
+
+    def test_finished_jobs_should_not_be_recovered(self):
+        journal = JobJournal(self.filename)
+        journal.recover()
+        journal.add_job({'job id': 'a'})
+        journal.add_job({'job id': 'b'})
+        journal.get_job('a')
+        journal.finish_job('a')
+        journal, jobs = self.reopen(journal)
+        self.assertEquals(jobs, [{'job id': 'b'}])
+        journal.close()
+
+    def test_jobs_in_flight_should_be_requeued_before_queued_ones(self):
+        journal = JobJournal(self.filename)
+        journal.recover()
+        journal.add_job({'job id': 'a'})
+        journal.add_job({'job id': 'b'})
+        journal.get_job('b')
+        journal, jobs = self.reopen(journal)
+        self.assertEquals([job['job id'] for job in jobs], ['b', 'a'])
+        journal.close()
+
+    def test_should_recover_from_snapshot_plus_journal(self):
+        journal = JobJournal(self.filename, compact_every=2, compact_ratio=0)
+        journal.recover()
+        journal.add_job({'job id': 'a'})
+        journal.add_job({'job id': 'b'}) # snapshot is written here
+        journal.get_job('a')
+        journal.finish_job('a')
+        journal.add_job({'job id': 'c'})
+        journal, jobs = self.reopen(journal)
+        self.assertEquals([job['job id'] for job in jobs], ['b', 'c'])
+        journal.close()
+
+    def test_dead_jobs_should_be_recovered_apart(self):
+        journal = JobJournal(self.filename, compact_every=3, compact_ratio=0)
+        journal.recover()
+        journal.add_jobs([{'job id': 'a'}, {'job id': 'b'}])
+        journal.get_job('a')
+        journal.fail_job('a', 1)
+        journal.kill_job('a', {'job': {'job id': 'a', 'attempts': 1},
+                               'error': 'spam'}) # snapshot is written here
+        journal.get_job('b')
+        journal.fail_job('b', 1)
+        journal, jobs = self.reopen(journal)
+        self.assertEquals(jobs, [{'job id': 'b', 'attempts': 1}])
+        self.assertEquals(journal.dead.keys(), ['a'])
+        journal.close()
+
+    def test_torn_write_at_the_end_should_be_ignored(self):
+        journal = JobJournal(self.filename)
+        journal.recover()
+        journal.add_job({'job id': 'a'})
+        journal._fp.write('{"operation": "add", "job": {"job')
+        journal, jobs = self.reopen(journal)
+        self.assertEquals(jobs, [{'job id': 'a'}])
+        journal.close()
+
+    def test_records_should_be_synced_in_groups(self):
+        journal = JobJournal(self.filename, sync_every=3)
+        journal.recover()
+        journal.add_job({'job id': 'a'})
+        journal.add_job({'job id': 'b'})
+        self.assertEquals(journal.unsynced_records, 2)
+        journal.add_job({'job id': 'c'})
+        self.assertEquals(journal.unsynced_records, 0)
+        journal.close()
+
+    def test_big_queues_should_be_compacted_less_often(self):
+        journal = JobJournal(self.filename, compact_every=2, compact_ratio=2)
+        journal.recover()
+        journal.add_jobs([{'job id': str(index)} for index in range(3)])
+        journal.add_job({'job id': '3'})
+        # 4 jobs, so the snapshot is written after 8 records
+        self.assertEquals(journal.records_since_snapshot, 2)
+        for index in range(4):
+            journal.get_job(str(index))
+        self.assertEquals(journal.records_since_snapshot, 6)
+        # 3 jobs left, so 6 records are enough
+        journal.finish_job('0')
+        self.assertEquals(journal.records_since_snapshot, 0)
+        journal.finish_job('1')
+        journal, jobs = self.reopen(journal)
+        self.assertEquals([job['job id'] for job in jobs], ['2', '3'])
+        journal.close()
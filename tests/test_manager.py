@@ -5,7 +5,9 @@ from signal import SIGINT, SIGKILL
 from time import sleep
 from subprocess import Popen, PIPE
 import shlex
+import json
 import zmq
+from pypln.manager import Manager
 
 
 time_to_wait = 150
@@ -74,8 +76,19 @@ class TestManager(unittest.TestCase):
                                  'database': 'pypln',
                                  'collection': 'documents',
                                  'gridfs collection': 'files',
-                                 'monitoring collection': 'monitoring',},
+                                 'monitoring collection': 'monitoring',
+                                 'result cache collection': 'result_cache',
+                                 'corpora collection': 'corpora',
+                                 'checkpoint collection': 'checkpoints',},
                           'monitoring interval': 60,
+                          'heartbeat interval': 10,
+                          'share weights': {},
+                          'admission control': {'max pending jobs': 1000000,
+                                                'max pending per worker':
+                                                        None,
+                                                'max pending per owner':
+                                                        100000,
+                                                'retry after': 1.0},
                          }
         if not self.api.poll(time_to_wait):
             self.fail("Didn't receive configuration from manager")
@@ -92,6 +105,59 @@ class TestManager(unittest.TestCase):
         self.assertIn('job id', message)
         self.assertEquals(len(message['job id']), 32)
 
+    def test_command_add_jobs_should_return_one_job_id_per_job(self):
+        jobs = [{'worker': 'test', 'document': str(index)}
+                for index in range(5)]
+        self.api.send_json({'command': 'add jobs', 'jobs': jobs})
+        if not self.api.poll(time_to_wait):
+            self.fail("Didn't receive 'jobs accepted' from manager")
+        message = self.api.recv_json()
+        self.assertEquals(message['answer'], 'jobs accepted')
+        self.assertEquals(len(message['job ids']), 5)
+        self.assertEquals(len(set(message['job ids'])), 5)
+        self.api.send_json({'command': 'get jobs', 'count': 10})
+        if not self.api.poll(time_to_wait):
+            self.fail("Didn't receive jobs from manager")
+        jobs = self.api.recv_json()['jobs']
+        self.assertEquals([job['job id'] for job in jobs],
+                          message['job ids'])
+        self.assertEquals([job['document'] for job in jobs],
+                          ['0', '1', '2', '3', '4'])
+
+    def test_command_add_jobs_should_broadcast_new_job_only_once(self):
+        sleep(time_to_wait / 1000.0) # wait for the subscription to propagate
+        jobs = [{'worker': 'test', 'document': str(index)}
+                for index in range(5)]
+        self.api.send_json({'command': 'add jobs', 'jobs': jobs})
+        if not self.api.poll(time_to_wait):
+            self.fail("Didn't receive 'jobs accepted' from manager")
+        self.api.recv_json()
+        if not self.broadcast.poll(time_to_wait):
+            self.fail("Didn't receive 'new job' from broadcast")
+        self.assertEquals(self.broadcast.recv(), 'new job')
+        self.assertFalse(self.broadcast.poll(time_to_wait))
+
+    def test_command_add_job_without_worker_should_return_error(self):
+        self.api.send_json({'command': 'add job', 'document': 'eggs'})
+        if not self.api.poll(time_to_wait):
+            self.fail("Didn't receive 'syntax error' from manager")
+        message = self.api.recv_json()
+        self.assertEquals(message['answer'], 'syntax error')
+
+    def test_command_add_job_twice_should_return_the_same_job_id(self):
+        job_ids = []
+        for i in range(2):
+            self.api.send_json({'command': 'add job', 'worker': 'test',
+                                'document': 'eggs'})
+            if not self.api.poll(time_to_wait):
+                self.fail("Didn't receive 'job accepted' from manager")
+            job_ids.append(self.api.recv_json()['job id'])
+        self.assertEquals(job_ids[0], job_ids[1])
+        self.api.send_json({'command': 'get jobs', 'count': 10})
+        if not self.api.poll(time_to_wait):
+            self.fail("Didn't receive jobs from manager")
+        self.assertEquals(len(self.api.recv_json()['jobs']), 1)
+
     def test_command_get_job_should_return_empty_if_no_job(self):
         self.api.send_json({'command': 'get job'})
         if not self.api.poll(time_to_wait):
@@ -114,6 +180,53 @@ class TestManager(unittest.TestCase):
         self.assertIn('job id', message)
         self.assertEquals(len(message['job id']), 32)
 
+    def test_command_get_jobs_should_return_up_to_count_jobs(self):
+        for document in ['a', 'b', 'c']:
+            self.api.send_json({'command': 'add job', 'worker': 'spam',
+                                'document': document})
+            if not self.api.poll(time_to_wait):
+                self.fail("Didn't receive 'add job' reply")
+            self.api.recv_json()
+        self.api.send_json({'command': 'get jobs', 'count': 2})
+        if not self.api.poll(time_to_wait):
+            self.fail("Didn't receive jobs from manager")
+        message = self.api.recv_json()
+        self.assertEquals([job['document'] for job in message['jobs']],
+                          ['a', 'b'])
+        self.api.send_json({'command': 'get jobs', 'count': 2})
+        if not self.api.poll(time_to_wait):
+            self.fail("Didn't receive jobs from manager")
+        message = self.api.recv_json()
+        self.assertEquals([job['document'] for job in message['jobs']], ['c'])
+
+    def test_command_get_jobs_should_return_only_jobs_for_given_workers(self):
+        for worker, document in [('spam', 'ham'), ('eggs', 'ham'),
+                                 ('spam', 'bacon')]:
+            self.api.send_json({'command': 'add job', 'worker': worker,
+                                'document': document})
+            if not self.api.poll(time_to_wait):
+                self.fail("Didn't receive 'add job' reply")
+            self.api.recv_json()
+        self.api.send_json({'command': 'get jobs', 'count': 5,
+                            'workers': ['eggs']})
+        if not self.api.poll(time_to_wait):
+            self.fail("Didn't receive jobs from manager")
+        message = self.api.recv_json()
+        self.assertEquals([job['worker'] for job in message['jobs']], ['eggs'])
+        self.api.send_json({'command': 'get jobs', 'count': 5})
+        if not self.api.poll(time_to_wait):
+            self.fail("Didn't receive jobs from manager")
+        message = self.api.recv_json()
+        self.assertEquals([job['worker'] for job in message['jobs']],
+                          ['spam', 'spam'])
+
+    def test_command_get_jobs_without_count_should_return_error(self):
+        self.api.send_json({'command': 'get jobs'})
+        if not self.api.poll(time_to_wait):
+            self.fail("Didn't receive 'syntax error' from manager")
+        message = self.api.recv_json()
+        self.assertEquals(message['answer'], 'syntax error')
+
     def test_finished_job_without_job_id_should_return_error(self):
         self.api.send_json({'command': 'job finished'})
         if not self.api.poll(time_to_wait):
@@ -121,6 +234,16 @@ class TestManager(unittest.TestCase):
         message = self.api.recv_json()
         self.assertEquals(message['answer'], 'syntax error')
 
+    def test_add_pipelines_with_malformed_pipeline_should_return_error(self):
+        for pipeline in [{'after': []}, {'worker': 'spam', 'after': 'eggs'},
+                         {'worker': 'spam', 'after': [{'after': []}]}]:
+            self.api.send_json({'command': 'add pipelines',
+                                'pipeline': pipeline, 'documents': ['a']})
+            if not self.api.poll(time_to_wait):
+                self.fail("Didn't receive 'syntax error' from manager")
+            message = self.api.recv_json()
+            self.assertEquals(message['answer'], 'syntax error')
+
     def test_finished_job_with_unknown_job_id_should_return_error(self):
         self.api.send_json({'command': 'job finished', 'job id': 'python rlz',
                             'duration': 0.1})
@@ -169,3 +292,369 @@ class TestManager(unittest.TestCase):
         message = self.broadcast.recv()
         expected = 'job finished: {} duration: 0.1'.format(job['job id'])
         self.assertEquals(message, expected)
+
+    def test_should_answer_pipelined_requests_from_dealer_sockets_in_order(self):
+        dealer = self.context.socket(zmq.DEALER)
+        dealer.connect('tcp://localhost:5555')
+        for index in range(3):
+            job = {'command': 'add job', 'worker': 'w',
+                   'document': str(index)}
+            dealer.send_multipart(['', json.dumps(job)])
+        for index in range(3):
+            dealer.send_multipart(['', json.dumps({'command': 'get job'})])
+        replies = []
+        for index in range(6):
+            if not dealer.poll(time_to_wait):
+                self.fail("Didn't receive all pipelined replies")
+            delimiter, reply = dealer.recv_multipart()
+            replies.append(reply)
+        dealer.close()
+        documents = [json.loads(reply)['document'] for reply in replies[3:]]
+        self.assertEquals(documents, ['0', '1', '2'])
+
+class TestManagerLeases(unittest.TestCase):
+    def setUp(self):
+        self.manager = Manager({}, lease_timeout=0.1, lease_check_interval=0,
+                               retry_backoff=0)
+        self.manager.bind(('*', 15555), ('*', 15556))
+        self.manager.enqueue([{'job id': document, 'worker': 'w',
+                               'document': document}
+                              for document in ['a', 'b', 'c']])
+
+    def tearDown(self):
+        self.manager.close_sockets()
+        self.manager.context.term()
+
+    def test_jobs_should_be_leased_to_the_broker_that_got_them(self):
+        self.manager.broker_seen('broker-1')
+        self.manager.get_jobs(2, broker='broker-1')
+        self.assertEquals(self.manager.leases, {'a': 'broker-1',
+                                                'b': 'broker-1'})
+        self.assertEquals(self.manager.broker_jobs['broker-1'],
+                          set(['a', 'b']))
+
+    def test_jobs_of_a_lost_broker_should_be_requeued_in_order(self):
+        self.manager.broker_seen('broker-1')
+        self.manager.get_jobs(2, broker='broker-1')
+        sleep(0.15)
+        self.manager.requeue_expired_leases()
+        self.assertEquals(self.manager.leases, {})
+        self.assertNotIn('broker-1', self.manager.brokers_last_seen)
+        self.manager.retry_delayed_jobs()
+        jobs = self.manager.get_jobs(3)
+        self.assertEquals([job['job id'] for job in jobs], ['a', 'b', 'c'])
+
+    def test_jobs_that_keep_losing_their_broker_should_be_dead_lettered(self):
+        for attempt in range(self.manager.max_attempts):
+            self.manager.broker_seen('broker-1')
+            jobs = self.manager.get_jobs(1, broker='broker-1')
+            self.assertEquals(jobs[0]['job id'], 'a')
+            sleep(0.15)
+            self.manager.requeue_expired_leases()
+            self.manager.retry_delayed_jobs()
+        self.assertNotIn('a', self.manager.pending_jobs)
+        self.assertEquals(self.manager.dead_jobs[0]['job']['job id'], 'a')
+        self.assertIn('Lease expired', self.manager.dead_jobs[0]['error'])
+
+    def test_jobs_of_a_live_broker_should_not_be_requeued(self):
+        self.manager.broker_seen('broker-1')
+        self.manager.get_jobs(2, broker='broker-1')
+        sleep(0.05)
+        self.manager.broker_seen('broker-1') # heartbeat
+        sleep(0.06)
+        self.manager.requeue_expired_leases()
+        self.assertEquals(len(self.manager.leases), 2)
+        jobs = self.manager.get_jobs(3)
+        self.assertEquals([job['job id'] for job in jobs], ['c'])
+
+    def test_finished_job_should_release_its_lease(self):
+        self.manager.broker_seen('broker-1')
+        self.manager.get_jobs(1, broker='broker-1')
+        self.manager.finish_job('a')
+        self.assertEquals(self.manager.leases, {})
+        self.assertEquals(self.manager.broker_jobs['broker-1'], set())
+        self.assertNotIn('a', self.manager.pending_jobs)
+
+    def test_job_finished_while_queued_should_not_be_handed_out(self):
+        self.manager.finish_job('b')
+        jobs = self.manager.get_jobs(3)
+        self.assertEquals([job['job id'] for job in jobs], ['a', 'c'])
+
+    def test_rejected_job_should_go_back_to_the_head_of_the_queue(self):
+        self.manager.broker_seen('broker-1')
+        self.manager.get_jobs(1, broker='broker-1')
+        self.manager.release_lease('a')
+        self.manager.requeue([self.manager.pending_jobs['a']])
+        jobs = self.manager.get_jobs(3)
+        self.assertEquals([job['job id'] for job in jobs], ['a', 'b', 'c'])
+
+class TestManagerWorkerQueues(unittest.TestCase):
+    def setUp(self):
+        self.manager = Manager({})
+        self.manager.bind(('*', 15555), ('*', 15556))
+        self.manager.enqueue([{'job id': str(index), 'worker': worker,
+                               'document': str(index)}
+                              for index, worker in enumerate(['pos', 'pos',
+                                  'extractor', 'freqdist', 'extractor'])])
+
+    def tearDown(self):
+        self.manager.close_sockets()
+        self.manager.context.term()
+
+    def test_jobs_should_be_returned_oldest_first_across_queues(self):
+        jobs = self.manager.get_jobs(10)
+        self.assertEquals([job['job id'] for job in jobs],
+                          ['0', '1', '2', '3', '4'])
+
+    def test_should_return_only_jobs_for_the_workers_broker_can_run(self):
+        jobs = self.manager.get_jobs(10, ['extractor', 'freqdist'])
+        self.assertEquals([job['job id'] for job in jobs], ['2', '3', '4'])
+        jobs = self.manager.get_jobs(10)
+        self.assertEquals([job['job id'] for job in jobs], ['0', '1'])
+
+    def test_share_weights_should_be_read_from_configuration(self):
+        manager = Manager({'share weights': {'alice': 3}})
+        self.assertEquals(manager.share_weights, {'alice': 3})
+        manager.context.term()
+
+    def test_should_respect_free_slots_per_worker_type(self):
+        jobs = self.manager.get_jobs(10, {'pos': 1, 'extractor': 2})
+        self.assertEquals([job['job id'] for job in jobs], ['0', '2', '4'])
+
+    def test_should_respect_total_count_with_slots_per_worker_type(self):
+        jobs = self.manager.get_jobs(2, {'pos': 5, 'extractor': 5})
+        self.assertEquals([job['job id'] for job in jobs], ['0', '1'])
+
+    def test_higher_priority_jobs_should_be_returned_first(self):
+        self.manager.enqueue([{'job id': 'urgent', 'worker': 'freqdist',
+                               'document': 'x', 'priority': 1}])
+        jobs = self.manager.get_jobs(2)
+        self.assertEquals([job['job id'] for job in jobs], ['urgent', '0'])
+
+    def test_statistics_should_have_queue_wait_time_per_priority(self):
+        self.manager.enqueue([{'job id': 'urgent', 'worker': 'freqdist',
+                               'document': 'x', 'priority': 1}])
+        self.manager.get_jobs(3)
+        statistics = self.manager.get_statistics()
+        self.assertEquals(statistics['queue wait']['1']['jobs'], 1)
+        self.assertEquals(statistics['queue wait']['0']['jobs'], 2)
+        self.assertIn('average', statistics['queue wait']['0'])
+        self.assertIn('max', statistics['queue wait']['0'])
+        self.assertEquals(statistics['queued jobs'], {'extractor': 2,
+                                                      'freqdist': 1})
+        self.assertEquals(statistics['pending jobs'], 6)
+
+class TestManagerAdmissionControl(unittest.TestCase):
+    def setUp(self):
+        self.manager = Manager({}, max_pending_jobs=5,
+                               max_pending_per_worker=3,
+                               max_pending_per_owner=2)
+        self.manager.bind(('*', 15555), ('*', 15556))
+
+    def tearDown(self):
+        self.manager.close_sockets()
+        self.manager.context.term()
+
+    def jobs(self, worker, owners):
+        return [{'worker': worker, 'document': 'd', 'owner': owner}
+                for owner in owners]
+
+    def test_should_admit_jobs_below_high_water_marks(self):
+        jobs = self.jobs('pos', ['a', 'b', 'c'])
+        self.assertEquals(self.manager.admissible(jobs), 3)
+
+    def test_should_not_admit_more_jobs_per_worker_than_the_limit(self):
+        jobs = self.jobs('pos', ['a', 'b', 'c', 'd'])
+        self.assertEquals(self.manager.admissible(jobs), 3)
+
+    def test_should_not_admit_more_jobs_per_owner_than_the_limit(self):
+        jobs = self.jobs('pos', ['a', 'b', 'a', 'a'])
+        self.assertEquals(self.manager.admissible(jobs), 3)
+
+    def test_should_not_admit_more_jobs_than_the_total_limit(self):
+        self.manager.add_jobs(self.jobs('pos', ['a', 'b', 'c']))
+        jobs = self.jobs('tokenizer', ['d', 'e', 'f'])
+        self.assertEquals(self.manager.admissible(jobs), 2)
+        self.assertEquals(self.manager.get_statistics()['refused jobs'], 1)
+
+    def test_finished_jobs_should_free_room_for_new_ones(self):
+        self.manager.add_jobs(self.jobs('pos', ['a', 'b', 'c']))
+        self.assertEquals(self.manager.admissible(self.jobs('pos', ['d'])), 0)
+        job = self.manager.get_jobs(1)[0]
+        self.manager.finish_job(job['job id'])
+        self.assertEquals(self.manager.admissible(self.jobs('pos', ['d'])), 1)
+
+    def test_high_water_marks_should_be_read_from_configuration(self):
+        manager = Manager({'admission control': {'max pending jobs': 2}})
+        self.assertEquals(manager.max_pending_jobs, 2)
+        self.assertEquals(manager.max_pending_per_worker, None)
+        self.assertEquals(manager.retry_after, 1.0)
+        self.assertEquals(manager.admissible(self.jobs('pos', ['a', 'b',
+                                                               'c'])), 2)
+        manager.context.term()
+
+    def test_add_pipelines_should_only_create_admissible_pipelines(self):
+        pipeline = {'worker': 'extractor', 'after': []}
+        pipeline_ids = self.manager.add_pipelines(pipeline, ['1', '2', '3'],
+                                                  {'owner': 'alice'})
+        self.assertEquals(len(pipeline_ids), 2)
+        self.assertEquals(len(self.manager.pending_jobs), 2)
+
+class TestManagerDeduplication(unittest.TestCase):
+    def setUp(self):
+        self.manager = Manager({})
+        self.manager.bind(('*', 15555), ('*', 15556))
+
+    def tearDown(self):
+        self.manager.close_sockets()
+        self.manager.context.term()
+
+    def test_duplicated_jobs_in_the_same_batch_should_be_added_once(self):
+        job_ids = self.manager.add_unique_jobs([
+                {'worker': 'pos', 'document': '1'},
+                {'worker': 'pos', 'document': '2'},
+                {'worker': 'pos', 'document': '1'}])
+        self.assertEquals(job_ids[0], job_ids[2])
+        self.assertNotEquals(job_ids[0], job_ids[1])
+        self.assertEquals(len(self.manager.pending_jobs), 2)
+        self.assertEquals(self.manager.get_statistics()['deduplicated jobs'],
+                          1)
+
+    def test_job_should_be_added_again_after_finished(self):
+        job_id = self.manager.add_unique_jobs([{'worker': 'pos',
+                                                'document': '1'}])[0]
+        self.manager.finish_job(job_id)
+        new_job_id = self.manager.add_unique_jobs([{'worker': 'pos',
+                                                    'document': '1'}])[0]
+        self.assertNotEquals(job_id, new_job_id)
+
+class TestManagerFailedJobs(unittest.TestCase):
+    def setUp(self):
+        self.manager = Manager({}, max_attempts=2, retry_backoff=0.1)
+        self.manager.bind(('*', 15555), ('*', 15556))
+        self.manager.enqueue([{'job id': document, 'worker': 'w',
+                               'document': document}
+                              for document in ['a', 'b']])
+
+    def tearDown(self):
+        self.manager.close_sockets()
+        self.manager.context.term()
+
+    def test_failed_job_should_be_retried_after_backoff(self):
+        self.manager.get_jobs(1, broker='broker-1')
+        self.assertTrue(self.manager.fail_job('a', 'Traceback...'))
+        self.assertEquals(self.manager.leases, {})
+        jobs = self.manager.get_jobs(2)
+        self.assertEquals([job['job id'] for job in jobs], ['b'])
+        sleep(0.15)
+        self.manager.retry_delayed_jobs()
+        jobs = self.manager.get_jobs(2)
+        self.assertEquals([job['job id'] for job in jobs], ['a'])
+        self.assertEquals(jobs[0]['attempts'], 1)
+
+    def test_job_should_be_dead_lettered_after_max_attempts(self):
+        self.manager.get_jobs(1, broker='broker-1')
+        self.manager.fail_job('a', 'first error')
+        sleep(0.15)
+        self.manager.retry_delayed_jobs()
+        self.manager.get_jobs(1, broker='broker-1')
+        self.assertFalse(self.manager.fail_job('a', 'second error',
+                                               {'duration': 1.5}))
+        self.assertNotIn('a', self.manager.pending_jobs)
+        self.assertEquals(len(self.manager.dead_jobs), 1)
+        dead_job = self.manager.dead_jobs[0]
+        self.assertEquals(dead_job['job']['job id'], 'a')
+        self.assertEquals(dead_job['error'], 'second error')
+        self.assertEquals(dead_job['resource usage'], {'duration': 1.5})
+        self.assertEquals(self.manager.get_statistics()['dead jobs'], 1)
+
+    def test_dead_job_should_end_its_pipeline(self):
+        pipeline_id = self.manager.add_pipelines({'worker': 'w', 'after': []},
+                                                 ['c'])[0]
+        self.manager.max_attempts = 1
+        job = self.manager.get_jobs(3)[-1]
+        self.manager.fail_job(job['job id'])
+        self.assertNotIn(pipeline_id, self.manager.pipelines)
+
+class TestManagerPipelines(unittest.TestCase):
+    def setUp(self):
+        self.manager = Manager({})
+        self.manager.bind(('*', 15555), ('*', 15556))
+        self.pipeline = {'worker': 'extractor',
+                         'after': [{'worker': 'tokenizer',
+                                    'after': [{'worker': 'pos', 'after': []},
+                                              {'worker': 'freqdist',
+                                               'after': []}]}]}
+
+    def tearDown(self):
+        self.manager.close_sockets()
+        self.manager.context.term()
+
+    def finish_all(self, count):
+        jobs = self.manager.get_jobs(count)
+        for job in jobs:
+            self.manager.finish_job(job['job id'])
+        return jobs
+
+    def test_add_pipelines_should_enqueue_only_the_first_worker(self):
+        pipeline_ids = self.manager.add_pipelines(self.pipeline, ['d1', 'd2'])
+        self.assertEquals(len(pipeline_ids), 2)
+        jobs = self.manager.get_jobs(10)
+        self.assertEquals([(job['worker'], job['document']) for job in jobs],
+                          [('extractor', 'd1'), ('extractor', 'd2')])
+
+    def test_next_workers_should_be_enqueued_when_parent_finishes(self):
+        self.manager.add_pipelines(self.pipeline, ['d1'])
+        self.finish_all(10)
+        jobs = self.finish_all(10)
+        self.assertEquals([job['worker'] for job in jobs], ['tokenizer'])
+        jobs = self.manager.get_jobs(10)
+        self.assertEquals([(job['worker'], job['document']) for job in jobs],
+                          [('pos', 'd1'), ('freqdist', 'd1')])
+
+    def test_next_workers_should_inherit_priority_and_owner(self):
+        self.manager.add_pipelines(self.pipeline, ['d1'],
+                                   {'priority': 2, 'owner': 'alice'})
+        self.finish_all(10)
+        job = self.manager.get_jobs(10)[0]
+        self.assertEquals(job['priority'], 2)
+        self.assertEquals(job['owner'], 'alice')
+
+    def test_pipeline_should_be_forgotten_after_all_its_jobs_finish(self):
+        pipeline_id = self.manager.add_pipelines(self.pipeline, ['d1'])[0]
+        self.assertEquals(self.manager.pipelines[pipeline_id], 1)
+        self.finish_all(10)
+        self.finish_all(10)
+        self.assertEquals(self.manager.pipelines[pipeline_id], 2)
+        self.finish_all(10)
+        self.assertNotIn(pipeline_id, self.manager.pipelines)
+        self.assertEquals(self.manager.pending_jobs, {})
+
+    def test_after_should_be_optional(self):
+        self.manager.add_pipelines({'worker': 'extractor',
+                                    'after': [{'worker': 'tokenizer'}]},
+                                   ['d1'])
+        self.finish_all(10)
+        jobs = self.finish_all(10)
+        self.assertEquals([job['worker'] for job in jobs], ['tokenizer'])
+        self.assertEquals(self.manager.pipelines, {})
+
+    def test_fused_pipeline_should_be_a_single_job(self):
+        pipeline_id = self.manager.add_pipelines(self.pipeline, ['d1'],
+                                                 fused=True)[0]
+        jobs = self.finish_all(10)
+        self.assertEquals(len(jobs), 1)
+        self.assertTrue(jobs[0]['fused'])
+        self.assertEquals(jobs[0]['after'], self.pipeline['after'])
+        self.assertEquals(self.manager.get_jobs(10), [])
+        self.assertNotIn(pipeline_id, self.manager.pipelines)
+
+    def test_fused_job_should_only_go_to_brokers_with_all_its_workers(self):
+        self.manager.add_pipelines(self.pipeline, ['d1'], fused=True)
+        self.assertEquals(self.manager.get_jobs(10, {'extractor': 1,
+                                                     'tokenizer': 1}), [])
+        self.assertEquals(self.manager.get_statistics()['queued jobs'],
+                          {'extractor+tokenizer+pos+freqdist': 1})
+        jobs = self.manager.get_jobs(10, {'extractor': 1, 'tokenizer': 0,
+                                          'pos': 0, 'freqdist': 0})
+        self.assertEquals(len(jobs), 1)
@@ -0,0 +1,60 @@
+# coding: utf-8
+
+import unittest
+from os.path import exists
+from StringIO import StringIO
+from pypln.payload import (SharedPayload, load_payloads, share_big_values,
+                           chunk_size)
+
+
+class TestSharedPayload(unittest.TestCase):
+    def test_payload_from_file_should_have_the_same_contents(self):
+        contents = 'spam and eggs ' * chunk_size
+        payload = SharedPayload.from_file(StringIO(contents))
+        self.assertEquals(payload.length, len(contents))
+        self.assertEquals(payload.read(), contents)
+        payload.remove()
+        self.assertFalse(exists(payload.filename))
+
+    def test_payload_should_keep_unicode_strings(self):
+        payload = SharedPayload.from_string(u'Ol\xe1, mundo!')
+        self.assertEquals(payload.read(), u'Ol\xe1, mundo!')
+        payload.remove()
+
+    def test_empty_payload(self):
+        payload = SharedPayload.from_string('')
+        self.assertEquals(payload.read(), '')
+        payload.remove()
+
+    def test_only_values_bigger_than_threshold_should_be_shared(self):
+        data = share_big_values({'small': 'spam', 'big': 'eggs' * 20,
+                                 'tokens': ['eggs'] * 2}, threshold=50)
+        self.assertEquals(data['small'], 'spam')
+        self.assertEquals(data['tokens'], ['eggs'] * 2)
+        self.assertTrue(isinstance(data['big'], SharedPayload))
+        filename = data['big'].filename
+        data = load_payloads(data)
+        self.assertEquals(data['big'], 'eggs' * 20)
+        self.assertFalse(exists(filename))
+
+    def test_without_threshold_nothing_should_be_shared(self):
+        data = {'big': 'eggs' * 10}
+        self.assertEquals(share_big_values(data, None), {'big': 'eggs' * 10})
+
+    def test_big_lists_and_dicts_should_be_shared_as_bson(self):
+        tokens = [[u'The', u'DT', 0], [u'sky', u'NN', 4]] * 100
+        freqdist = {u'token {}'.format(index): index for index in range(10)}
+        data = share_big_values({'tokens': tokens, 'freqdist': freqdist},
+                                threshold=32)
+        self.assertEquals(data['tokens'].encoding, 'bson')
+        self.assertEquals(data['freqdist'].encoding, 'bson')
+        data = load_payloads(data)
+        self.assertEquals(data['tokens'], tokens)
+        self.assertEquals(data['freqdist'], freqdist)
+
+    def test_values_that_bson_cant_encode_should_not_be_shared(self):
+        data = share_big_values({'counts': {index: index
+                                            for index in range(100)}},
+                                threshold=32)
+        self.assertEquals(data['counts'], {index: index
+                                           for index in range(100)})
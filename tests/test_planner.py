@@ -0,0 +1,108 @@
+# coding: utf-8
+
+import unittest
+from pypln.planner import (input_fingerprint, get_stamp, stale_pipelines,
+                           plan, to_worker)
+
+
+pipeline = {'worker': 'extractor',
+            'after': [{'worker': 'tokenizer',
+                       'after': [{'worker': 'pos', 'after': []},
+                                 {'worker': 'freqdist', 'after': []}]}]}
+
+def processed_document(document_id, contents_md5='file-md5'):
+    '''Return the stamps of a document on which the pipeline ran'''
+    fingerprints = {'text': 'text-md5', 'metadata': 'metadata-md5',
+                    'tokens': 'tokens-md5', 'pos': 'pos-md5',
+                    'freqdist': 'freqdist-md5'}
+    versions = {worker: get_stamp(worker, fingerprints, contents_md5)
+                for worker in ('extractor', 'tokenizer', 'pos', 'freqdist')}
+    return {'_id': document_id, '_fingerprints': fingerprints,
+            '_versions': versions}
+
+def fused_document(document_id, contents_md5='file-md5'):
+    '''Return the stamps of a document on which the pipeline ran fused
+
+    Only the results of the last workers (pos and freqdist) are stored, but
+    all the workers are stamped.
+    '''
+    fingerprints = {'pos': 'pos-md5', 'freqdist': 'freqdist-md5'}
+    versions = {worker: get_stamp(worker, fingerprints, contents_md5)
+                for worker in ('extractor', 'tokenizer', 'pos', 'freqdist')}
+    return {'_id': document_id, '_fingerprints': fingerprints,
+            '_versions': versions}
+
+class TestPlanner(unittest.TestCase):
+    def test_input_fingerprint_should_depend_only_on_required_fields(self):
+        fingerprint = input_fingerprint({'text': 'a', 'tokens': 'b'},
+                                        ['text'])
+        self.assertEquals(fingerprint,
+                          input_fingerprint({'text': 'a', 'tokens': 'c'},
+                                            ['text']))
+        self.assertNotEquals(fingerprint,
+                             input_fingerprint({'text': 'c'}, ['text']))
+        self.assertEquals(input_fingerprint({'a': 1, 'b': 2}, ['a', 'b']),
+                          input_fingerprint({'a': 1, 'b': 2}, ['b', 'a']))
+
+    def test_nothing_should_run_again_if_nothing_changed(self):
+        document = processed_document(1)
+        self.assertEquals(stale_pipelines(pipeline, document, 'file-md5'), [])
+
+    def test_new_documents_should_run_the_whole_pipeline(self):
+        self.assertEquals(stale_pipelines(pipeline, {'_id': 1}), [pipeline])
+
+    def test_workers_with_a_new_version_should_run_again(self):
+        document = processed_document(1)
+        document['_versions']['tokenizer']['version'] = 'old version'
+        self.assertEquals(stale_pipelines(pipeline, document, 'file-md5'),
+                          [pipeline['after'][0]])
+
+    def test_workers_whose_input_changed_should_run_again(self):
+        document = processed_document(1)
+        # tokens were computed again, but pos and freqdist were not
+        document['_fingerprints']['tokens'] = 'new-tokens-md5'
+        self.assertEquals(stale_pipelines(pipeline, document, 'file-md5'),
+                          pipeline['after'][0]['after'])
+
+    def test_changed_files_should_run_the_whole_pipeline(self):
+        document = processed_document(1)
+        self.assertEquals(stale_pipelines(pipeline, document, 'new-file-md5'),
+                          [pipeline])
+
+    def test_documents_should_be_grouped_by_stale_pipelines(self):
+        changed = processed_document(2)
+        changed['_versions']['freqdist']['version'] = 'old version'
+        documents = [processed_document(1), changed, {'_id': 3},
+                     processed_document(4, contents_md5='old-file-md5')]
+        groups = plan(pipeline, documents, {1: 'file-md5', 2: 'file-md5',
+                                            3: 'file-md5', 4: 'file-md5'})
+        self.assertEquals(groups, [({'worker': 'freqdist', 'after': []},
+                                    [2]),
+                                   (pipeline, [3, 4])])
+
+    def test_to_worker_should_build_the_same_pipeline(self):
+        self.assertEquals(to_worker(pipeline).to_dict(), pipeline)
+
+    def test_nothing_should_run_again_on_fused_results(self):
+        document = fused_document(1)
+        self.assertEquals(stale_pipelines(pipeline, document, 'file-md5'), [])
+
+    def test_stale_fused_workers_should_run_with_the_workers_before(self):
+        document = fused_document(1)
+        # tokens were not stored, so tokenizer and extractor run again
+        document['_versions']['freqdist']['version'] = 'old version'
+        self.assertEquals(stale_pipelines(pipeline, document, 'file-md5'),
+                          [pipeline])
+
+    def test_only_workers_whose_input_is_stored_should_run_again(self):
+        document = processed_document(1)
+        # tokenizer ran fused with pos and freqdist: text is stored, tokens
+        # are not
+        del document['_fingerprints']['tokens']
+        for worker in ('tokenizer', 'pos', 'freqdist'):
+            document['_versions'][worker] = \
+                    get_stamp(worker, document['_fingerprints'])
+        self.assertEquals(stale_pipelines(pipeline, document, 'file-md5'), [])
+        document['_versions']['pos']['version'] = 'old version'
+        self.assertEquals(stale_pipelines(pipeline, document, 'file-md5'),
+                          [pipeline['after'][0]])
@@ -0,0 +1,119 @@
+# coding: utf-8
+
+import unittest
+from os import getpgid
+from pypln.payload import SharedPayload
+from pypln.pool import WorkerPool
+
+
+document = {'tokens': [('the', 'DT'), ('cat', 'NN'), ('the', 'DT')]}
+expected_result = ('result', {'freqdist': [('the', 2), ('cat', 1)]})
+
+class TestWorkerPool(unittest.TestCase):
+    def tearDown(self):
+        self.pool.close()
+
+    def run_job(self):
+        process = self.pool.acquire()
+        process.send(('freqdist', document))
+        result = process.recv()
+        self.pool.release(process)
+        return process, result
+
+    def test_pool_should_prefork_processes(self):
+        self.pool = WorkerPool(3)
+        self.assertEquals(len(self.pool), 3)
+        self.assertEquals(len(set(self.pool.pids())), 3)
+        for process in self.pool.idle:
+            self.assertTrue(process.process.is_alive())
+
+    def test_process_should_run_many_jobs(self):
+        self.pool = WorkerPool(1)
+        first_process, result = self.run_job()
+        self.assertEquals(result, expected_result)
+        second_process, result = self.run_job()
+        self.assertEquals(result, expected_result)
+        self.assertIs(first_process, second_process)
+        self.assertEquals(second_process.jobs_done, 2)
+
+    def test_process_should_be_recycled_after_max_jobs(self):
+        self.pool = WorkerPool(1, max_jobs_per_process=2)
+        first_process, result = self.run_job()
+        second_process, result = self.run_job()
+        self.assertIs(first_process, second_process)
+        self.assertFalse(first_process.process.is_alive())
+        self.assertEquals(self.pool.recycled, 1)
+        self.assertEquals(len(self.pool), 1)
+        self.assertNotEquals(self.pool.pids(), [first_process.pid])
+
+    def test_process_should_be_recycled_when_using_too_much_memory(self):
+        self.pool = WorkerPool(1, max_memory=1)
+        process, result = self.run_job()
+        self.assertEquals(result, expected_result)
+        self.assertEquals(self.pool.recycled, 1)
+        self.assertNotEquals(self.pool.pids(), [process.pid])
+
+    def test_discarded_process_should_be_killed_and_replaced(self):
+        self.pool = WorkerPool(1)
+        process = self.pool.acquire()
+        self.pool.discard(process)
+        self.assertFalse(process.process.is_alive())
+        self.assertEquals(len(self.pool), 1)
+        self.assertEquals(self.run_job()[1], expected_result)
+
+    def test_processes_should_lead_their_own_process_group(self):
+        # so the programs they start are killed with them
+        self.pool = WorkerPool(1)
+        process, result = self.run_job()
+        self.assertEquals(getpgid(process.pid), process.pid)
+        self.assertNotEquals(getpgid(process.pid), getpgid(0))
+
+    def test_big_inputs_and_results_should_go_through_shared_payloads(self):
+        self.pool = WorkerPool(1, payload_threshold=10)
+        process = self.pool.acquire()
+        text = 'The sky is blue. ' * 100
+        contents = SharedPayload.from_string(text)
+        process.send(('extractor', {'name': 'sky.txt', 'contents': contents}))
+        status, result = process.recv()
+        self.pool.release(process)
+        self.assertEquals(status, 'result')
+        self.assertTrue(isinstance(result['text'], SharedPayload))
+        self.assertEquals(result['text'].read(), text)
+        result['text'].remove()
+
+    def test_exceptions_in_workers_should_be_sent_back(self):
+        self.pool = WorkerPool(1)
+        process = self.pool.acquire()
+        process.send(('freqdist', {}))
+        status, error = process.recv()
+        self.pool.release(process)
+        self.assertEquals(status, 'error')
+        self.assertIn('KeyError', error)
+        self.assertEquals(self.run_job()[1], expected_result)
+
+    def test_fused_pipeline_should_run_all_workers_in_the_same_process(self):
+        self.pool = WorkerPool(1)
+        process = self.pool.acquire()
+        pipeline = {'worker': 'extractor',
+                    'after': [{'worker': 'freqdist', 'after': []}]}
+        data = {'name': 'cat.txt', 'contents': 'The cat.'}
+        data.update(document)
+        process.send((pipeline, data))
+        status, result = process.recv()
+        self.pool.release(process)
+        self.assertEquals(status, 'result')
+        self.assertEquals(result['text'], 'The cat.')
+        self.assertEquals(result['freqdist'], [('the', 2), ('cat', 1)])
+        self.assertNotIn('tokens', result)
+
+    def test_fused_pipeline_should_stop_at_the_first_error(self):
+        self.pool = WorkerPool(1)
+        process = self.pool.acquire()
+        pipeline = {'worker': 'extractor',
+                    'after': [{'worker': 'freqdist', 'after': []}]}
+        process.send((pipeline, {'name': 'cat.txt', 'contents': 'The cat.'}))
+        status, error = process.recv()
+        self.pool.release(process)
+        self.assertEquals(status, 'error')
+        self.assertIn('Worker "freqdist" failed', error)
+        self.assertIn('KeyError', error)
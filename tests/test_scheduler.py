@@ -0,0 +1,83 @@
+# coding: utf-8
+
+import unittest
+from pypln.scheduler import FairQueue
+
+
+class TestFairQueue(unittest.TestCase):
+    def push_jobs(self, queue, jobs):
+        for sequence, (job_id, attributes) in enumerate(jobs):
+            job = {'job id': job_id}
+            job.update(attributes)
+            queue.push(sequence, job)
+
+    def pop_all(self, queue, is_pending=None):
+        job_ids = []
+        entry = queue.pop(is_pending)
+        while entry is not None:
+            job_ids.append(entry[1]['job id'])
+            entry = queue.pop(is_pending)
+        return job_ids
+
+    def test_empty_queue_should_return_none(self):
+        queue = FairQueue()
+        self.assertEquals(queue.peek(), None)
+        self.assertEquals(queue.pop(), None)
+        self.assertEquals(len(queue), 0)
+
+    def test_jobs_of_the_same_flow_should_be_fifo(self):
+        queue = FairQueue()
+        self.push_jobs(queue, [('a', {}), ('b', {}), ('c', {})])
+        self.assertEquals(len(queue), 3)
+        self.assertEquals(self.pop_all(queue), ['a', 'b', 'c'])
+
+    def test_higher_priority_should_always_be_served_first(self):
+        queue = FairQueue()
+        self.push_jobs(queue, [('bulk-1', {}), ('bulk-2', {}),
+                               ('interactive', {'priority': 10})])
+        self.assertEquals(self.pop_all(queue),
+                          ['interactive', 'bulk-1', 'bulk-2'])
+
+    def test_flows_should_be_served_in_round_robin(self):
+        queue = FairQueue()
+        self.push_jobs(queue, [('big-1', {'owner': 'big'}),
+                               ('big-2', {'owner': 'big'}),
+                               ('big-3', {'owner': 'big'}),
+                               ('small-1', {'owner': 'small'})])
+        self.assertEquals(self.pop_all(queue),
+                          ['big-1', 'small-1', 'big-2', 'big-3'])
+
+    def test_flows_should_be_served_according_to_their_weights(self):
+        queue = FairQueue({'heavy': 2})
+        self.push_jobs(queue, [('light-1', {'owner': 'light'}),
+                               ('light-2', {'owner': 'light'}),
+                               ('heavy-1', {'owner': 'heavy'}),
+                               ('heavy-2', {'owner': 'heavy'}),
+                               ('heavy-3', {'owner': 'heavy'})])
+        self.assertEquals(self.pop_all(queue),
+                          ['light-1', 'heavy-1', 'heavy-2', 'light-2',
+                           'heavy-3'])
+
+    def test_corpora_of_the_same_owner_should_be_different_flows(self):
+        queue = FairQueue({'alice/big': 2})
+        self.push_jobs(queue, [('big-1', {'owner': 'alice', 'corpus': 'big'}),
+                               ('big-2', {'owner': 'alice', 'corpus': 'big'}),
+                               ('big-3', {'owner': 'alice', 'corpus': 'big'}),
+                               ('small-1', {'owner': 'alice',
+                                            'corpus': 'small'}),
+                               ('small-2', {'owner': 'alice',
+                                            'corpus': 'small'})])
+        self.assertEquals(self.pop_all(queue),
+                          ['big-1', 'big-2', 'small-1', 'big-3', 'small-2'])
+
+    def test_jobs_pushed_to_the_front_should_be_served_first(self):
+        queue = FairQueue()
+        self.push_jobs(queue, [('a', {}), ('b', {})])
+        queue.push(0, {'job id': 'requeued'}, front=True)
+        self.assertEquals(self.pop_all(queue), ['requeued', 'a', 'b'])
+
+    def test_jobs_that_are_not_pending_should_be_discarded(self):
+        queue = FairQueue()
+        self.push_jobs(queue, [('a', {}), ('b', {}), ('c', {})])
+        self.assertEquals(self.pop_all(queue, lambda job_id: job_id != 'b'),
+                          ['a', 'c'])
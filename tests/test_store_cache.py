@@ -0,0 +1,61 @@
+# coding: utf-8
+
+import unittest
+from pypln.stores.cache import FieldCache, value_size
+
+
+class TestFieldCache(unittest.TestCase):
+    def test_cached_fields_should_be_returned(self):
+        cache = FieldCache(1024)
+        cache.put('1', 'text', u'The cat.')
+        cache.put('1', 'tokens', [u'The', u'cat', u'.'])
+        self.assertEquals(cache.get_fields('1', ['text', 'tokens']),
+                          {'text': u'The cat.',
+                           'tokens': [u'The', u'cat', u'.']})
+        self.assertEquals(cache.hits, 1)
+        self.assertEquals(cache.misses, 0)
+
+    def test_should_miss_if_any_field_is_not_cached(self):
+        cache = FieldCache(1024)
+        cache.put('1', 'text', u'The cat.')
+        self.assertEquals(cache.get_fields('1', ['text', 'tokens']), None)
+        self.assertEquals(cache.get_fields('2', ['text']), None)
+        self.assertEquals(cache.misses, 2)
+
+    def test_size_should_be_accounted(self):
+        cache = FieldCache(1024)
+        cache.put('1', 'text', 'spam')
+        cache.put('2', 'text', 'eggs')
+        self.assertEquals(cache.size, 2 * value_size('spam'))
+        cache.put('1', 'text', 'spam and eggs')
+        self.assertEquals(cache.size, value_size('spam and eggs') + \
+                                      value_size('eggs'))
+        self.assertEquals(len(cache), 2)
+
+    def test_least_recently_used_fields_should_be_evicted(self):
+        cache = FieldCache(3 * value_size('spam'))
+        cache.put('1', 'text', 'spam')
+        cache.put('2', 'text', 'spam')
+        cache.put('3', 'text', 'spam')
+        cache.get_fields('1', ['text'])
+        cache.put('4', 'text', 'spam')
+        self.assertEquals(cache.evictions, 1)
+        self.assertEquals(cache.get_fields('2', ['text']), None)
+        self.assertEquals(cache.get_fields('1', ['text']), {'text': 'spam'})
+        self.assertEquals(cache.size, 3 * value_size('spam'))
+
+    def test_values_bigger_than_the_cache_should_not_be_cached(self):
+        cache = FieldCache(10)
+        cache.put('1', 'text', 'spam' * 10)
+        self.assertEquals(len(cache), 0)
+        self.assertEquals(cache.size, 0)
+
+    def test_invalidated_fields_should_be_removed(self):
+        cache = FieldCache(1024)
+        cache.put('1', 'text', 'spam')
+        cache.put('1', 'tokens', ['spam'])
+        cache.invalidate('1', ['text', 'tokens'])
+        self.assertEquals(cache.get_fields('1', ['text']), None)
+        self.assertEquals(len(cache), 0)
+        self.assertEquals(cache.size, 0)
+        self.assertEquals(cache.invalidations, 1)
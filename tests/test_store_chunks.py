@@ -0,0 +1,25 @@
+# coding: utf-8
+
+import unittest
+from pypln.stores.chunks import split_value, iter_chunks
+
+
+class TestChunks(unittest.TestCase):
+    def test_strings_should_not_be_split_inside_words(self):
+        text = u'The sky is blue,\nthe sun is yellow.'
+        chunks = list(split_value(text, 10))
+        self.assertEquals(u''.join(chunks), text)
+        self.assertEquals(chunks[:2], [u'The sky ', u'is blue,\n'])
+        self.assertTrue(all(len(chunk) <= 10 for chunk in chunks))
+
+    def test_words_bigger_than_chunk_size_should_be_split(self):
+        self.assertEquals(list(split_value('spamspam eggs', 4)),
+                          ['spam', 'spam', ' ', 'eggs'])
+
+    def test_lists_should_be_sliced(self):
+        self.assertEquals(list(split_value(range(5), 2)),
+                          [[0, 1], [2, 3], [4]])
+
+    def test_other_values_should_be_a_single_chunk(self):
+        self.assertEquals(list(iter_chunks({'a': 1}, 2)), [{'a': 1}])
+        self.assertEquals(list(iter_chunks('', 2)), [])
@@ -0,0 +1,68 @@
+# coding: utf-8
+
+import pickle
+import unittest
+from pymongo import Connection
+from pypln.stores.corpus import CorpusCursor
+
+
+config = {'host': 'localhost', 'port': 27017, 'database': 'pypln_test',
+          'collection': 'documents', 'gridfs collection': 'files',
+          'checkpoint collection': 'checkpoints'}
+
+class TestCorpusCursor(unittest.TestCase):
+    def setUp(self):
+        self.connection = Connection(config['host'], config['port'])
+        self.db = self.connection[config['database']]
+        self.collection = self.db[config['collection']]
+        self.corpus_id = 'corpus-1'
+        self.document_ids = [self.collection.insert({'corpora': [corpus],
+                                                     'tokens': [index],
+                                                     'text': 'spam'})
+                             for index, corpus in enumerate(['corpus-1',
+                                 'corpus-2', 'corpus-1', 'corpus-1'])]
+
+    def tearDown(self):
+        self.connection.drop_database(config['database'])
+        self.connection.close()
+
+    def cursor(self):
+        return CorpusCursor(config, self.corpus_id, ['tokens'], 'job-1',
+                            batch_size=2)
+
+    def test_should_iterate_over_projected_documents_of_the_corpus(self):
+        documents = list(self.cursor())
+        self.assertEquals([document['tokens'] for document in documents],
+                          [[0], [2], [3]])
+        self.assertNotIn('text', documents[0])
+
+    def test_should_resume_after_last_checkpoint(self):
+        cursor = self.cursor()
+        for document in cursor:
+            cursor.checkpoint({'seen': document['tokens']})
+            break
+        cursor = pickle.loads(pickle.dumps(self.cursor()))
+        self.assertEquals(cursor.state, {'seen': [0]})
+        self.assertEquals([document['tokens'] for document in cursor],
+                          [[2], [3]])
+
+    def test_connected_cursor_should_be_sent_without_its_connection(self):
+        cursor = self.cursor()
+        cursor.state
+        copy = pickle.loads(pickle.dumps(cursor))
+        self.assertEquals(copy._connection, None)
+        self.assertEquals(copy.corpus_id, self.corpus_id)
+
+    def test_big_states_should_be_stored_in_gridfs(self):
+        cursor = CorpusCursor(config, self.corpus_id, ['tokens'], 'job-1',
+                              max_state_size=100)
+        cursor.checkpoint(['spam'] * 100)
+        checkpoint = self.db[config['checkpoint collection']]\
+                         .find_one({'_id': 'job-1'})
+        self.assertNotEquals(checkpoint['state'], ['spam'] * 100)
+        cursor.checkpoint(['eggs'] * 100)
+        # the file of the previous state is deleted
+        files = self.db['{}.files'.format(config['gridfs collection'])]
+        self.assertEquals(files.find({'document': 'job-1'}).count(), 1)
+        copy = CorpusCursor(config, self.corpus_id, ['tokens'], 'job-1')
+        self.assertEquals(copy.state, ['eggs'] * 100)
@@ -5,6 +5,7 @@ import datetime
 import pymongo
 from gridfs import GridFS
 from pypln.stores.mongo import MongoDBStore, slug
+from pypln.stores.spill import spill_big_values
 from bson import ObjectId
 
 
@@ -203,3 +204,15 @@ class TestMongoStore(unittest.TestCase):
         self.assertEquals(results[0]['_id'], analysis._id)
         result = self.store.Analysis.find_by_document(document._id)
         self.assertEquals(analysis._id, result._id)
+
+    def test_document_get_result_should_load_spilled_results(self):
+        document = self.store.Document(filename='test.txt')
+        document.save()
+        tokens = ['this', 'is', 'a', 'test'] * 100
+        result = spill_big_values({'tokens': tokens, 'language': 'en'},
+                                  self.gridfs, threshold=100)
+        self.documents.update({'_id': document._id}, {'$set': result})
+        self.assertIn('_gridfs', self.documents.find_one()['tokens'])
+        self.assertEquals(document.get_result('tokens'), tokens)
+        self.assertEquals(document.get_result('language'), 'en')
+        self.assertEquals(document.get_result('pos'), None)
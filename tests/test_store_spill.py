@@ -0,0 +1,145 @@
+# coding: utf-8
+
+import unittest
+from pypln.stores.spill import (encode, decode, is_reference,
+                                spill_big_values, LazyDocument, put_chunk,
+                                chunked_reference, iter_reference,
+                                join_chunks, referenced_files,
+                                delete_stale_files)
+
+
+class FakeFile(object):
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+class DictGridFS(object):
+    def __init__(self):
+        self.files = {}
+        self.attributes = {}
+        self.next_id = 0
+
+    def put(self, data, **kwargs):
+        file_id = self.next_id
+        self.next_id += 1
+        self.files[file_id] = data
+        self.attributes[file_id] = kwargs
+        return file_id
+
+    def get(self, file_id):
+        return FakeFile(self.files[file_id])
+
+    def delete(self, file_id):
+        del self.files[file_id]
+        del self.attributes[file_id]
+
+class FakeFilesCollection(object):
+    '''Answers `delete_stale_files` queries from a `DictGridFS`'''
+    def __init__(self, gridfs):
+        self.gridfs = gridfs
+
+    def find(self, query, fields=None):
+        for file_id, attributes in self.gridfs.attributes.items():
+            for condition in query['$or']:
+                if attributes.get('document') == condition['document'] and \
+                   attributes.get('field') in condition['field']['$in']:
+                    yield {'_id': file_id}
+                    break
+
+class TestSpill(unittest.TestCase):
+    def test_encode_and_decode(self):
+        value = [[u'The', u'DT', 0], [u'sky', u'NN', 4]] * 1000
+        encoded = encode(value)
+        self.assertTrue(len(encoded) < len(repr(value)))
+        self.assertEquals(decode(encoded), value)
+
+    def test_only_big_values_should_be_spilled(self):
+        gridfs = DictGridFS()
+        data = spill_big_values({'tokens': [u'spam'] * 100,
+                                 'language': u'en'}, gridfs, 100)
+        self.assertEquals(data['language'], u'en')
+        self.assertTrue(is_reference(data['tokens']))
+        self.assertEquals(len(gridfs.files), 1)
+
+    def test_references_should_not_be_spilled_again(self):
+        gridfs = DictGridFS()
+        data = spill_big_values({'tokens': [u'spam'] * 100}, gridfs, 100)
+        data = spill_big_values(data, gridfs, 10)
+        self.assertEquals(len(gridfs.files), 1)
+
+    def test_fingerprints_should_be_computed_for_all_values(self):
+        gridfs = DictGridFS()
+        fingerprints = {}
+        spill_big_values({'tokens': [u'spam'] * 100, 'language': u'en'},
+                         gridfs, 100, fingerprints)
+        other_fingerprints = {}
+        spill_big_values({'tokens': [u'spam'] * 100, 'language': u'pt'},
+                         gridfs, None, other_fingerprints)
+        self.assertEquals(sorted(fingerprints.keys()), ['language', 'tokens'])
+        self.assertEquals(fingerprints['tokens'], other_fingerprints['tokens'])
+        self.assertNotEquals(fingerprints['language'],
+                             other_fingerprints['language'])
+
+    def test_biggest_values_should_be_spilled_if_update_is_too_big(self):
+        gridfs = DictGridFS()
+        data = spill_big_values({'tokens': [u'spam'] * 100,
+                                 'pos': [u'NN'] * 50, 'language': u'en'},
+                                gridfs, 10000, max_total=1000)
+        self.assertTrue(is_reference(data['tokens']))
+        self.assertEquals(data['pos'], [u'NN'] * 50)
+        self.assertEquals(data['language'], u'en')
+
+    def test_files_of_overwritten_values_should_be_deleted(self):
+        gridfs = DictGridFS()
+        files = FakeFilesCollection(gridfs)
+        old = spill_big_values({'tokens': [u'spam'] * 100,
+                                'pos': [u'NN'] * 100}, gridfs, 100,
+                               document_id='doc')
+        other = spill_big_values({'tokens': [u'spam'] * 100}, gridfs, 100,
+                                 document_id='other doc')
+        new = spill_big_values({'tokens': [u'eggs'] * 100}, gridfs, 100,
+                               document_id='doc')
+        deleted = delete_stale_files(gridfs, files, [('doc', 'tokens')],
+                                     set([new['tokens']['_gridfs']]))
+        self.assertEquals(deleted, 1)
+        self.assertEquals(sorted(gridfs.files.keys()),
+                          sorted([old['pos']['_gridfs'],
+                                  other['tokens']['_gridfs'],
+                                  new['tokens']['_gridfs']]))
+        self.assertEquals(referenced_files(new['tokens']),
+                          [new['tokens']['_gridfs']])
+        self.assertEquals(referenced_files(u'spam'), [])
+
+    def test_lazy_document_should_load_references_when_used(self):
+        gridfs = DictGridFS()
+        data = spill_big_values({'tokens': [u'spam'] * 100,
+                                 'text': u'spam ' * 100}, gridfs, 100)
+        document = LazyDocument(data, gridfs)
+        self.assertEquals(document['tokens'], [u'spam'] * 100)
+        self.assertTrue(is_reference(dict.__getitem__(document, 'text')))
+        resolved = document.resolve(['text'])
+        self.assertEquals(type(resolved), dict)
+        self.assertEquals(resolved['text'], u'spam ' * 100)
+
+    def test_chunked_values_should_be_loaded_joined(self):
+        gridfs = DictGridFS()
+        chunks = [put_chunk(gridfs, 'tokens', [u'spam'] * 10),
+                  put_chunk(gridfs, 'tokens', [u'eggs'] * 10)]
+        reference = chunked_reference([file_id for file_id, size in chunks],
+                                      sum(size for file_id, size in chunks))
+        self.assertTrue(is_reference(reference))
+        self.assertEquals(list(iter_reference(reference, gridfs)),
+                          [[u'spam'] * 10, [u'eggs'] * 10])
+        document = LazyDocument({'tokens': reference}, gridfs)
+        self.assertEquals(document['tokens'], [u'spam'] * 10 + [u'eggs'] * 10)
+        data = spill_big_values({'tokens': reference}, gridfs, 1)
+        self.assertEquals(data['tokens'], reference)
+
+    def test_join_chunks(self):
+        self.assertEquals(join_chunks([u'spam ', u'eggs']), u'spam eggs')
+        self.assertEquals(join_chunks([[1, 2], [3]]), [1, 2, 3])
+        self.assertEquals(join_chunks([{'a': 1}, {'b': 2}]),
+                          {'a': 1, 'b': 2})
+        self.assertEquals(join_chunks([]), None)
@@ -0,0 +1,36 @@
+# coding: utf-8
+
+import unittest
+from pypln.workers import corpus_freqdist
+
+
+class FakeCorpus(list):
+    def __init__(self, documents, state=None):
+        list.__init__(self, documents)
+        self.state = state
+        self.checkpoints = []
+
+    def checkpoint(self, state=None):
+        self.checkpoints.append(state)
+
+class TestCorpusFreqDistWorker(unittest.TestCase):
+    def test_should_sum_frequency_distributions_of_all_documents(self):
+        corpus = FakeCorpus([{'freqdist': [('the', 2), ('sky', 1)]},
+                             {'freqdist': [('the', 1), ('.', 1)]},
+                             {}])
+        result = corpus_freqdist.main({'corpus': corpus})
+        self.assertEquals(result['freqdist'][0], ('the', 3))
+        self.assertEquals(sorted(result['freqdist']),
+                          [('.', 1), ('sky', 1), ('the', 3)])
+
+    def test_should_resume_from_checkpoint_and_save_new_ones(self):
+        corpus_freqdist.checkpoint_every = 1
+        try:
+            corpus = FakeCorpus([{'freqdist': [('sky', 1)]}],
+                                state=[('the', 5)])
+            result = corpus_freqdist.main({'corpus': corpus})
+        finally:
+            corpus_freqdist.checkpoint_every = 1000
+        self.assertEquals(result['freqdist'], [('the', 5), ('sky', 1)])
+        self.assertEquals(sorted(corpus.checkpoints[0]),
+                          [('sky', 1), ('the', 5)])
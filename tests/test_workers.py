@@ -0,0 +1,151 @@
+# coding: utf-8
+
+import sys
+import unittest
+from subprocess import check_output
+from time import sleep
+from textwrap import dedent
+from pypln import workers
+from pypln.workers import read_manifest, Worker, persistent_wrapper
+
+
+class TestWorkerDiscovery(unittest.TestCase):
+    def test_manifest_should_be_read_without_importing_dependencies(self):
+        meta, names = read_manifest(dedent('''
+            import module_that_does_not_exist
+            __meta__ = {'from': 'document', 'requires': ['text'],
+                        'to': 'document', 'provides': ['spam'],
+                        'timeout': 10}
+            def warm_up():
+                pass
+            def main(document):
+                return {}
+        '''))
+        self.assertEquals(meta['provides'], ['spam'])
+        self.assertEquals(meta['timeout'], 10)
+        self.assertIn('warm_up', names)
+
+    def test_modules_without_main_or_meta_should_not_be_workers(self):
+        self.assertEquals(read_manifest('def main(document): pass'), None)
+        self.assertEquals(read_manifest(dedent('''
+            __meta__ = {'from': 'document', 'requires': [], 'to': 'document',
+                        'provides': []}
+        ''')), None)
+        self.assertEquals(read_manifest(dedent('''
+            __meta__ = {'from': 'document'}
+            def main(document): pass
+        ''')), None)
+
+    def test_broken_modules_should_not_be_workers(self):
+        self.assertEquals(read_manifest('def main(:'), None)
+        self.assertEquals(read_manifest(dedent('''
+            __meta__ = dict(requires=[])
+            def main(document): pass
+        ''')), None)
+
+    def test_worker_module_should_be_imported_on_first_use(self):
+        worker = workers.available['freqdist']
+        self.assertEquals(worker['provides'], ['freqdist'])
+        self.assertFalse(worker.has_warm_up)
+        self.assertTrue(workers.available['pos'].has_warm_up)
+        status, result = workers.run_worker('freqdist',
+                                            {'tokens': [('the', 'DT')]})
+        self.assertEquals(status, 'result')
+        self.assertIn('pypln.workers.freqdist', sys.modules)
+        self.assertEquals(worker['warm_up'], None)
+
+    def test_importing_workers_should_not_import_database_modules(self):
+        code = ('import sys, pypln.workers; '
+                'print [name for name in ("pymongo", "gridfs", "bson") '
+                'if name in sys.modules]')
+        self.assertEquals(check_output([sys.executable, '-c', code]).strip(),
+                          '[]')
+
+    def test_version_should_have_versions_of_dependencies(self):
+        meta = {'from': 'document', 'requires': [], 'to': 'document',
+                'provides': [], 'version': 3,
+                'dependencies': ['pymongo', 'package-that-does-not-exist']}
+        worker = Worker('spam', meta, set(['main']), 'source-md5')
+        version = worker['version'].split()
+        self.assertEquals(version[0], '3')
+        self.assertTrue(version[1].startswith('pymongo-'))
+        self.assertEquals(version[2], 'package-that-does-not-exist-None')
+        del meta['version']
+        worker = Worker('spam', meta, set(['main']), 'source-md5')
+        self.assertEquals(worker['version'].split()[0], 'source-md5')
+
+class TestPreload(unittest.TestCase):
+    def setUp(self):
+        self.warmed_up = []
+        for name, warm_up in [('warm_1', lambda: self.warm_up('warm_1')),
+                              ('warm_2', lambda: self.warm_up('warm_2')),
+                              ('cold', lambda: 1 / 0)]:
+            meta = {'from': 'document', 'requires': [], 'to': 'document',
+                    'provides': []}
+            worker = Worker(name, meta, set(['main', 'warm_up']), 'version')
+            worker['main'] = lambda document: {}
+            worker['warm_up'] = warm_up
+            workers.available[name] = worker
+
+    def tearDown(self):
+        for name in ('warm_1', 'warm_2', 'cold'):
+            del workers.available[name]
+
+    def warm_up(self, name):
+        sleep(0.01)
+        self.warmed_up.append(name)
+
+    def test_only_the_given_workers_should_be_warmed_up(self):
+        warm_up_times = workers.preload(['warm_1', 'freqdist'])
+        self.assertEquals(self.warmed_up, ['warm_1'])
+        self.assertEquals(warm_up_times.keys(), ['warm_1'])
+
+    def test_failed_warm_ups_should_be_skipped(self):
+        warm_up_times = workers.preload(['cold', 'warm_1', 'warm_2'])
+        self.assertEquals(sorted(self.warmed_up), ['warm_1', 'warm_2'])
+        self.assertEquals(sorted(warm_up_times.keys()), ['warm_1', 'warm_2'])
+
+    def test_time_spent_in_each_warm_up_should_be_returned(self):
+        warm_up_times = workers.preload(['warm_1'])
+        self.assertTrue(0.01 <= warm_up_times['warm_1'] < 1)
+
+class FakeConnection(object):
+    def __init__(self, messages):
+        self.messages = messages
+        self.sent = []
+
+    def recv(self):
+        return self.messages.pop(0)
+
+    def send(self, message):
+        self.sent.append(message)
+
+def count_words(document):
+    for text in document['text']:
+        yield {'words': [len(text.split())]}
+
+class TestChunkedWorkers(unittest.TestCase):
+    def setUp(self):
+        meta = {'from': 'document', 'requires': ['text'], 'to': 'document',
+                'provides': ['words'], 'chunked': True, 'chunk size': 10}
+        worker = Worker('count_words', meta, set(['main']), 'version')
+        worker['main'] = count_words
+        workers.available['count_words'] = worker
+
+    def tearDown(self):
+        del workers.available['count_words']
+
+    def test_partial_results_should_be_sent_as_they_are_yielded(self):
+        connection = FakeConnection([('count_words',
+                                      {'text': 'The sky is blue. The sun.'}),
+                                     None])
+        persistent_wrapper(connection)
+        self.assertEquals(connection.sent, [('chunk', {'words': [2]}),
+                                            ('chunk', {'words': [2]}),
+                                            ('chunk', {'words': [2]}),
+                                            ('result', {})])
+
+    def test_run_worker_should_join_partial_results(self):
+        self.assertEquals(workers.run_worker('count_words',
+                                             {'text': 'The sky is blue.'}),
+                          ('result', {'words': [2, 2]}))
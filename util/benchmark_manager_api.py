@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''Measure Manager API throughput (requests/sec) as the number of brokers grows
+
+Each simulated broker is a process with a pipelined (DEALER) ManagerClient
+that keeps `--depth` 'get job' requests in flight. Run it from the repository
+root:
+
+    python util/benchmark_manager_api.py --brokers 1,2,4,8,16,32,64
+'''
+
+import argparse
+from multiprocessing import Process, Queue
+from time import time
+from pypln.client import ManagerClient
+from pypln.manager import Manager
+
+
+def run_manager(api_host_port, broadcast_host_port):
+    manager = Manager({'monitoring interval': 60})
+    manager.bind(api_host_port, broadcast_host_port)
+    manager.run()
+
+def run_broker(api_host_port, requests, depth, results):
+    client = ManagerClient(pipelined=depth > 1)
+    client.connect(api_host_port)
+    in_flight = 0
+    sent = 0
+    received = 0
+    start_time = time()
+    while received < requests:
+        while sent < requests and in_flight < depth:
+            client.send_api_request({'command': 'get job'})
+            sent += 1
+            in_flight += 1
+        client.get_api_reply()
+        received += 1
+        in_flight -= 1
+    results.put((start_time, time()))
+    client.close_sockets()
+
+def benchmark(api_host_port, brokers, requests, depth):
+    results = Queue()
+    processes = [Process(target=run_broker,
+                         args=(api_host_port, requests, depth, results))
+                 for i in range(brokers)]
+    for process in processes:
+        process.start()
+    timings = [results.get() for process in processes]
+    for process in processes:
+        process.join()
+    start_time = min(timing[0] for timing in timings)
+    end_time = max(timing[1] for timing in timings)
+    return brokers * requests / (end_time - start_time)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--brokers', default='1,2,4,8,16,32,64')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='requests sent by each broker')
+    parser.add_argument('--depth', type=int, default=8,
+                        help='requests in flight per broker (1 = lockstep)')
+    parser.add_argument('--port', type=int, default=15555)
+    args = parser.parse_args()
+
+    api_host_port = ('localhost', args.port)
+    manager = Process(target=run_manager,
+                      args=(('*', args.port), ('*', args.port + 1)))
+    manager.start()
+    try:
+        print '{:>8} {:>14}'.format('brokers', 'requests/sec')
+        for brokers in [int(value) for value in args.brokers.split(',')]:
+            throughput = benchmark(api_host_port, brokers, args.requests,
+                                   args.depth)
+            print '{:>8} {:>14.1f}'.format(brokers, throughput)
+    finally:
+        manager.terminate()
+        manager.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''Measure the startup time of pypln.workers and of a broker's first job
+
+Each measure runs in a new Python process, so nothing is already imported:
+
+- `import pypln.workers` (workers' metadata is read without importing them);
+- the same import, followed by the import of all worker modules (as it was
+  done at import time before);
+- creating a `ManagerBroker` (without connecting to the manager);
+- latency of the first job of `--worker` in a new process pool.
+
+Run it from the repository root:
+
+    python util/benchmark_startup.py --worker freqdist --repeat 5
+'''
+
+import argparse
+import json
+import sys
+from subprocess import Popen, PIPE
+
+
+measures = {
+    'import pypln.workers': '''
+from time import time
+start_time = time()
+import pypln.workers
+duration = time() - start_time
+''',
+    'import all worker modules': '''
+from time import time
+start_time = time()
+from pypln import workers
+for worker in workers.available.values():
+    worker['main']
+duration = time() - start_time
+''',
+    'create broker': '''
+from time import time
+start_time = time()
+from pypln.broker import ManagerBroker
+broker = ManagerBroker(('localhost', 5555), ('localhost', 5556))
+duration = time() - start_time
+''',
+    'first job': '''
+from time import time
+start_time = time()
+from pypln.pool import WorkerPool
+pool = WorkerPool(1)
+process = pool.acquire()
+process.send(({worker!r}, {document!r}))
+process.recv()
+duration = time() - start_time
+pool.release(process)
+pool.close()
+''',}
+documents = {'freqdist': {'tokens': [('the', 'DT'), ('cat', 'NN'),
+                                     ('sat', 'VBD'), ('on', 'IN'),
+                                     ('the', 'DT'), ('mat', 'NN')]},
+             'tokenizer': {'text': 'The cat sat on the mat. It was happy.'},
+             'pos': {'tokens': ['The', 'cat', 'sat', 'on', 'the', 'mat']},}
+
+def measure(code):
+    code += '\nimport json, sys\nsys.stdout.write(json.dumps(duration))\n'
+    process = Popen([sys.executable, '-c', code], stdout=PIPE)
+    stdout, stderr = process.communicate()
+    return json.loads(stdout)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--worker', default='freqdist',
+                        choices=sorted(documents.keys()))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print '{:>26} {:>10}'.format('measure', 'best (ms)')
+    for name in ['import pypln.workers', 'import all worker modules',
+                 'create broker', 'first job']:
+        code = measures[name].format(worker=args.worker,
+                                     document=documents[args.worker])
+        best = min(measure(code) for i in range(args.repeat))
+        print '{:>26} {:>10.1f}'.format(name, best * 1000)
+
+
+if __name__ == '__main__':
+    main()
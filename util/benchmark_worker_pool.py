@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# coding: utf-8
+'''Compare jobs/sec of the preforked worker pool against one process per job
+
+Both models run `--jobs` jobs of `--worker` with up to `--concurrency` jobs at
+once (the broker uses one slot per CPU), without touching MongoDB or the
+Manager. With `--preload` the workers' `warm_up` functions are called before
+forking (as the broker does), so the first job of each process doesn't load
+models from disk. Run it from the repository root:
+
+    python util/benchmark_worker_pool.py --worker freqdist --jobs 2000
+    python util/benchmark_worker_pool.py --worker pos --jobs 200 --preload
+'''
+
+import argparse
+from multiprocessing import Process, Pipe, cpu_count
+from time import time
+from pypln import workers
+from pypln.pool import WorkerPool
+
+
+documents = {'freqdist': {'tokens': [('the', 'DT'), ('cat', 'NN'),
+                                     ('sat', 'VBD'), ('on', 'IN'),
+                                     ('the', 'DT'), ('mat', 'NN')]},
+             'tokenizer': {'text': 'The cat sat on the mat. It was happy.'},
+             'pos': {'tokens': ['The', 'cat', 'sat', 'on', 'the', 'mat']},}
+
+def process_per_job(worker, document, jobs, concurrency):
+    running = []
+    started = finished = 0
+    while finished < jobs:
+        while started < jobs and len(running) < concurrency:
+            parent_connection, child_connection = Pipe()
+            process = Process(target=workers.wrapper,
+                              args=(child_connection, ))
+            process.start()
+            parent_connection.send((worker, document))
+            running.append((process, parent_connection, child_connection))
+            started += 1
+        process, parent_connection, child_connection = running.pop(0)
+        parent_connection.recv()
+        parent_connection.close()
+        child_connection.close()
+        process.join()
+        finished += 1
+
+def first_job_latency(worker, document):
+    pool = WorkerPool(1)
+    start_time = time()
+    process = pool.acquire()
+    process.send((worker, document))
+    process.recv()
+    latency = time() - start_time
+    pool.release(process)
+    pool.close()
+    return latency
+
+def preforked_pool(worker, document, jobs, concurrency):
+    pool = WorkerPool(concurrency)
+    running = []
+    started = finished = 0
+    while finished < jobs:
+        while started < jobs and len(running) < concurrency:
+            process = pool.acquire()
+            process.send((worker, document))
+            running.append(process)
+            started += 1
+        process = running.pop(0)
+        process.recv()
+        pool.release(process)
+        finished += 1
+    pool.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--worker', default='freqdist',
+                        choices=sorted(documents.keys()))
+    parser.add_argument('--jobs', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=cpu_count())
+    parser.add_argument('--preload', action='store_true',
+                        help="call workers' warm_up before forking")
+    args = parser.parse_args()
+
+    document = documents[args.worker]
+    if args.preload:
+        for worker, duration in workers.preload().iteritems():
+            print 'warm up of {}: {:.3f}s'.format(worker, duration)
+    print 'first job latency: {:.3f}s'.format(first_job_latency(args.worker,
+                                                                document))
+    print '{:>16} {:>10}'.format('model', 'jobs/sec')
+    for name, function in [('process per job', process_per_job),
+                           ('preforked pool', preforked_pool)]:
+        start_time = time()
+        function(args.worker, document, args.jobs, args.concurrency)
+        throughput = args.jobs / (time() - start_time)
+        print '{:>16} {:>10.1f}'.format(name, throughput)
+
+
+if __name__ == '__main__':
+    main()